@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+
+# Timings and memory of the hot paths, on synthetic corpora scaled from labeledData.csv
+#
+# build:             generate_frequencies over the whole corpus
+# load:              json.load of term/doc_frequencies.json and TFidF construction
+# tfidf_call:        TFidF.__call__ on random (term, category) pairs
+# normalize:         normalizer.pairs, and each of its stages (tokenize, segment, filter, stem), with cold caches
+# classify_raw:      classify() without a semantic resource
+# classify_wordsim:  classify() with IndexedSimDB over a local stand-in of SEWordSim-r1.db
+# classify_word2vec: classify() with BatchedWord2Vec over local stand-in vectors
+# classify_ranked:   classify_ranked() without a semantic resource, top 3 categories
+#
+# Corpora: scale N has N times the rows of labeledData.csv, each row a copy of a random original row (same category)
+# with some of its words swapped for words of other rows of the category or for new variants ('build' -> 'build7'),
+# so the vocabulary grows with the corpus instead of staying that of the original data
+# Every case runs in its own spawned process (best of repeat runs), so memory is measured from the same empty state
+# Stand-ins are generated from the corpus, nothing is downloaded
+#
+# Results (json) hold seconds (total and per item) and memory (peak RSS and RSS growth, kB) of every case and scale,
+# classify cases also hold the peak memory allocated while classifying one message (tracemalloc, bytes)
+# Peak RSS and RSS growth are None where they can't be read (no resource module or /proc, ie. Windows)
+# With a baseline, cases slower or larger than the baseline by more than tolerance are reported as regressions
+# (exit status 1)
+#
+# Usage: ./benchmark_suite labeledData.csv [--scales 1 10 100] [--output benchmark_results.json]
+#                          [--baseline benchmark_baseline.json] [--tolerance 0.2] [--save-baseline]
+
+import argparse
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import tracemalloc
+from multiprocessing import get_context
+from time import perf_counter
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # Unix only, peak RSS is then not measured (None)
+    resource = None
+
+CASES = ['build', 'load', 'tfidf_call', 'normalize', 'classify_raw', 'classify_wordsim', 'classify_word2vec',
+         'classify_ranked']
+
+# Messages timed by the per message cases (and traced for memory), and pairs timed by tfidf_call
+SAMPLE_SIZE = 500
+TRACED_SIZE = 100
+NUM_CALLS = 100000
+
+# Words of the stand-in resources (most frequent first), neighbours per word and vector size
+STAND_IN_WORDS = 20000
+STAND_IN_NEIGHBOURS = 20
+STAND_IN_DIMENSIONS = 100
+
+
+def synthetic_corpus(rows, scale, seed=0):
+    rand = random.Random(seed)
+    by_category = {}
+    for row in rows:
+        by_category.setdefault(row['Category'], []).append(row['message'].split())
+
+    corpus = []
+    for _ in range(len(rows) * scale):
+        template = rand.choice(rows)
+        category_words = by_category[template['Category']]
+        words = []
+        for wd in template['message'].split():
+            draw = rand.random()
+            if draw < 0.1:
+                other = rand.choice(category_words)
+                wd = rand.choice(other) if other else wd
+            elif draw < 0.15 and wd.isalpha():
+                wd = wd + str(rand.randrange(10 * scale))
+            words.append(wd)
+        corpus.append({'Category': template['Category'], 'message': ' '.join(words)})
+    return corpus
+
+
+# Stand-in similarity resources in directory, made from the vocabulary of the corpus model
+# WordSimSEDB: sqlite database with the Word_Similarity table, stemmed terms
+# Word2VecSE: normalized random vectors (npy, memory mapped when loaded) and their words (json), unstemmed
+def make_stand_ins(directory, term_frequencies, messages, seed=0):
+    from normalize import normalizer
+
+    rand = random.Random(seed)
+    counts = {}
+    for cat in term_frequencies:
+        for word, count in term_frequencies[cat]['counts'].items():
+            counts[word] = counts.get(word, 0) + count
+    stems = sorted(counts, key=lambda word: -counts[word])[:STAND_IN_WORDS]
+
+    conn = sqlite3.connect(os.path.join(directory, 'stand_in_sim.db'))
+    conn.execute('create table Word_Similarity (term_1 text, term_2 text, similarity real)')
+    conn.executemany('insert into Word_Similarity values (?, ?, ?)',
+                     ((stem, rand.choice(stems), round(rand.random(), 4))
+                      for stem in stems for _ in range(STAND_IN_NEIGHBOURS)))
+    conn.commit()
+    conn.close()
+
+    words = {}
+    for message in messages:
+        for wd in normalizer.tokens(message):
+            if wd.isalpha():
+                words[wd] = words.get(wd, 0) + 1
+    words = sorted(words, key=lambda word: -words[word])[:STAND_IN_WORDS]
+
+    vectors = np.random.default_rng(seed).standard_normal((len(words), STAND_IN_DIMENSIONS)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1)[:, np.newaxis]
+    np.save(os.path.join(directory, 'stand_in_vectors.npy'), vectors)
+    with open(os.path.join(directory, 'stand_in_words.json'), 'w') as fi:
+        json.dump(words, fi)
+
+
+# Just enough of gensim's KeyedVectors for BatchedWord2Vec
+class StandInVectors(object):
+    def __init__(self, directory):
+        self.vectors = np.load(os.path.join(directory, 'stand_in_vectors.npy'), mmap_mode='r')
+        with open(os.path.join(directory, 'stand_in_words.json'), 'r') as fi:
+            self.index_to_key = json.load(fi)
+        self.key_to_index = {word: i for i, word in enumerate(self.index_to_key)}
+
+
+# Resident memory of this process in kB, None without /proc (as binary_model.memory_usage)
+def _rss():
+    if not os.path.exists('/proc/self/statm'):
+        return None
+    with open('/proc/self/statm', 'r') as fi:
+        return int(fi.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+
+
+# Peak resident memory of this process in kB, None without the resource module
+def _peak_rss():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _read_corpus(directory):
+    with open(os.path.join(directory, 'corpus.csv'), 'r', newline='') as fi:
+        return list(csv.DictReader(fi))
+
+
+def _load_model(directory):
+    from classify import TFidF
+
+    with open(os.path.join(directory, 'term_frequencies.json'), 'r') as fi:
+        term_frequencies = json.load(fi)
+    with open(os.path.join(directory, 'doc_frequencies.json'), 'r') as fi:
+        doc_frequencies = json.load(fi)
+    return TFidF(term_frequencies, doc_frequencies)
+
+
+# Loads what a case needs, returns the function to time, which returns the number of items it went through
+def _prepare_case(case, directory):
+    from classify import classify, classify_ranked, BatchedWord2Vec, IndexedSimDB
+    from make_model import generate_frequencies
+    from normalize import normalizer
+
+    normalizer.load()
+
+    if case == 'build':
+        rows = _read_corpus(directory)
+
+        def build():
+            generate_frequencies(rows)
+            return len(rows)
+        return build
+
+    if case == 'load':
+        def load():
+            _load_model(directory)
+            return 1
+        return load
+
+    messages = [row['message'] for row in _read_corpus(directory)]
+    sample = random.Random(1).sample(messages, min(SAMPLE_SIZE, len(messages)))
+
+    # stage times of the normalizer are those of the last run
+    if case == 'normalize':
+        def normalize():
+            normalizer.stem.cache_clear()
+            normalizer._segment.cache_clear()
+            normalizer.reset_stats()
+            for message in sample:
+                list(normalizer.pairs(message.lower()))
+            return len(sample)
+        return normalize
+
+    tf_idf = _load_model(directory)
+
+    if case == 'tfidf_call':
+        rand = random.Random(2)
+        terms = list(tf_idf.get_doc_frequencies())
+        categories = list(tf_idf.get_categories())
+        pairs = [(rand.choice(terms), rand.choice(categories)) for _ in range(NUM_CALLS)]
+
+        def call():
+            for word, category in pairs:
+                tf_idf(word, category)
+            return len(pairs)
+        return call
+
+    sim_func = None
+    stemmed_database = True
+    if case == 'classify_wordsim':
+        sim_func = IndexedSimDB(os.path.join(directory, 'stand_in_sim.db'))
+    elif case == 'classify_word2vec':
+        sim_func = BatchedWord2Vec(StandInVectors(directory))
+        stemmed_database = False
+    tf_idf.get_score_matrix()
+
+    def classify_one(message):
+        if case == 'classify_ranked':
+            classify_ranked(tf_idf, message.lower(), top_k=3)
+        else:
+            classify(tf_idf, message.lower(), sim_func, num_similar=3, min_similarity=0.2,
+                     stemmed_database=stemmed_database)
+
+    def classify_sample():
+        for message in sample:
+            classify_one(message)
+        return len(sample)
+    classify_sample.traced = (classify_one, sample[:TRACED_SIZE])
+    return classify_sample
+
+
+# Average over items of the peak memory allocated (bytes above what was in use before) while function(item) runs
+def _traced_peak(function, items):
+    tracemalloc.start()
+    total = 0
+    for item in items:
+        function(item)  # first call of a message fills the caches, they aren't what is measured
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        else:  # python 3.8, starting again resets the peak (and forgets what was traced so far, before is 0)
+            tracemalloc.stop()
+            tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        function(item)
+        total += tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return total / len(items)
+
+
+def _measure(que, case, directory, repeat):
+    timed = _prepare_case(case, directory)
+
+    best = None
+    rss_before = _rss()
+    for _ in range(repeat):
+        start = perf_counter()
+        num_items = timed()
+        seconds = perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+
+    rss_after = _rss()
+    result = {'seconds': best,
+              'items': num_items,
+              'seconds_per_item': best / num_items,
+              'peak_rss_kb': _peak_rss(),
+              'rss_growth_kb': rss_after - rss_before if rss_after is not None else None}
+    if hasattr(timed, 'traced'):
+        result['traced_peak_bytes_per_item'] = _traced_peak(*timed.traced)
+    if case == 'normalize':
+        from normalize import normalizer
+        result['stages'] = {stage: seconds / num_items for stage, seconds in normalizer.get_stats()['times'].items()}
+    que.put(result)
+
+
+def run_case(case, directory, repeat=3):
+    context = get_context('spawn')
+    que = context.Queue()
+    proc = context.Process(target=_measure, args=(que, case, directory, repeat))
+    proc.start()
+    result = que.get()
+    proc.join()
+    return result
+
+
+def run_suite(rows, scales=(1, 10, 100), repeat=3):
+    from make_model import generate_frequencies
+    results = []
+    for scale in scales:
+        directory = tempfile.mkdtemp(prefix='benchmark_')
+        try:
+            corpus = synthetic_corpus(rows, scale)
+            with open(os.path.join(directory, 'corpus.csv'), 'w', newline='') as fi:
+                writer = csv.DictWriter(fi, ['Category', 'message'])
+                writer.writeheader()
+                writer.writerows(corpus)
+
+            term_frequencies, doc_frequencies = generate_frequencies(corpus)
+            with open(os.path.join(directory, 'term_frequencies.json'), 'w') as fi:
+                json.dump(term_frequencies, fi, indent=4, sort_keys=True)
+            with open(os.path.join(directory, 'doc_frequencies.json'), 'w') as fi:
+                json.dump(doc_frequencies, fi, indent=4, sort_keys=True)
+            make_stand_ins(directory, term_frequencies, [row['message'] for row in corpus])
+            del corpus, term_frequencies, doc_frequencies
+
+            for case in CASES:
+                result = run_case(case, directory, repeat)
+                result.update({'case': case, 'scale': scale})
+                results.append(result)
+                print(case, scale, result['seconds'], result['seconds_per_item'], result['peak_rss_kb'],
+                      result['rss_growth_kb'], sep=', ')
+        finally:
+            shutil.rmtree(directory)
+
+    return results
+
+
+# Cases of results that are slower (seconds_per_item) or larger (peak_rss_kb) than baseline by more than tolerance
+def regressions(results, baseline, tolerance=0.2):
+    expected = {(result['case'], result['scale']): result for result in baseline['results']}
+    found = []
+    for result in results:
+        before = expected.get((result['case'], result['scale']))
+        if before is None:
+            continue
+        for measure in ['seconds_per_item', 'peak_rss_kb']:
+            if result[measure] is None or before[measure] is None:  # not measured on one of the platforms
+                continue
+            if result[measure] > before[measure] * (1 + tolerance):
+                found.append((result['case'], result['scale'], measure, before[measure], result[measure]))
+    return found
+
+
+def environment():
+    return {'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'numpy': np.__version__}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="./benchmark_suite labeledData.csv [--scales 1 10 100]"
+                                           " [--output benchmark_results.json] [--baseline benchmark_baseline.json]"
+                                           " [--tolerance 0.2] [--save-baseline]")
+    parser.add_argument("labeled_data")
+    parser.add_argument("--scales", type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default='benchmark_results.json')
+    parser.add_argument("--baseline", default='benchmark_baseline.json')
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown/growth, 0.2 is 20%%")
+    parser.add_argument("--save-baseline", action='store_true', help="also store the results as the baseline")
+    args = parser.parse_args()
+
+    with open(args.labeled_data, 'r') as csv_file:
+        labeled_rows = [{'Category': row['Category'], 'message': row['message']}
+                        for row in csv.DictReader(csv_file, delimiter=',')]
+
+    print('Case, Scale, Seconds, Seconds/Item, Peak RSS kB, RSS growth kB')
+    suite_results = {'environment': environment(), 'results': run_suite(labeled_rows, args.scales, args.repeat)}
+    with open(args.output, 'w') as fi:
+        json.dump(suite_results, fi, indent=4)
+
+    if args.save_baseline:
+        shutil.copyfile(args.output, args.baseline)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as fi:
+            found_regressions = regressions(suite_results['results'], json.load(fi), args.tolerance)
+        for case_name, case_scale, measure, old_value, new_value in found_regressions:
+            print("Regression:", case_name, "at scale", case_scale, measure, old_value, "->", new_value)
+        if found_regressions:
+            exit(1)
+        print("No regressions against", args.baseline)
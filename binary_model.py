@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+
+# Compact binary model format, replaces the term/doc_frequencies.json pair
+#
+# Terms are interned in a table sorted by their utf-8 bytes, a term's position is its integer id
+# Counts (0 when the term is absent from a category) and tf-idf weights are flat arrays with one column per category,
+# so MappedTFidF can memory map the file read only and hand the weights straight to classify_batch
+# Processes mapping the same file share one page-cached copy, nothing is copied into per process dictionaries
+#
+# File layout (little endian):
+# magic b'TFIDFBIN', header length (uint64), json header (padded to 8 bytes), then the arrays below,
+# each starting at the byte offset recorded in the header
+#   offsets   uint64 [num_terms + 1]  start of each term in blob
+#   doc_freqs int32  [num_terms]
+#   counts    int32  [num_terms, num_categories]
+#   weights   float64 [num_terms, num_categories]
+#   blob      utf-8 bytes of every term, in order
+#
+# Usage: ./binary_model term_frequencies.json doc_frequencies.json model.bin (converter)
+#        ./binary_model --benchmark [num_terms] (load time and memory against json, on a synthetic model)
+
+import sys
+import json
+import mmap
+import os
+import random
+from bisect import bisect_left
+from multiprocessing import get_context
+from time import time
+
+import numpy as np
+
+from classify import TFidF, ScoreMatrix
+
+MAGIC = b'TFIDFBIN'
+VERSION = 1
+
+
+def _encode(word):
+    return word.encode('utf-8', 'surrogatepass')
+
+
+def write_binary_model(term_freqs, doc_freqs, file_name):
+    # Category order is kept, classify breaks ties in favour of the first category
+    categories = list(term_freqs.keys())
+
+    vocabulary = set(doc_freqs)
+    for cat in categories:
+        vocabulary.update(term_freqs[cat]['counts'])
+    terms = sorted(vocabulary, key=_encode)
+    term_ids = {word: i for i, word in enumerate(terms)}
+
+    encoded = [_encode(word) for word in terms]
+    offsets = np.zeros(len(terms) + 1, dtype='<u8')
+    offsets[1:] = np.cumsum([len(word) for word in encoded])
+
+    doc_frequencies = np.array([doc_freqs.get(word, 0) for word in terms], dtype='<i4')
+
+    # weights are computed by TFidF itself, so both formats score exactly the same
+    tf_idf = TFidF(term_freqs, doc_freqs)
+    counts = np.zeros((len(terms), len(categories)), dtype='<i4')
+    weights = np.zeros((len(terms), len(categories)), dtype='<f8')
+    for c, cat in enumerate(categories):
+        for word, count in term_freqs[cat]['counts'].items():
+            counts[term_ids[word], c] = count
+            weights[term_ids[word], c] = tf_idf(word, cat)
+
+    sections = [('offsets', offsets), ('doc_freqs', doc_frequencies), ('counts', counts), ('weights', weights),
+                ('blob', np.frombuffer(b''.join(encoded), dtype='u1'))]
+
+    header = {'version': VERSION,
+              'categories': categories,
+              'num_docs': [term_freqs[cat]['num_docs'] for cat in categories],
+              'num_terms': len(terms)}
+
+    # Header size depends on the offsets written into it, so settle the offsets first with a generous estimate
+    header_size = _padded(len(json.dumps(header)) + 64 * len(sections) + 64)
+    position = len(MAGIC) + 8 + header_size
+    for name, array in sections:
+        header[name] = position
+        position = _padded(position + array.nbytes)
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * (header_size - len(header_bytes))
+
+    with open(file_name, 'wb') as fi:
+        fi.write(MAGIC)
+        fi.write(np.array([header_size], dtype='<u8').tobytes())
+        fi.write(header_bytes)
+        for name, array in sections:
+            fi.seek(header[name])
+            fi.write(array.tobytes())
+
+
+def _padded(size):
+    return (size + 7) // 8 * 8
+
+
+# Sorted term table read straight from the mapped file, get(word) returns the id of word (or None) by binary search
+class MappedTerms(object):
+    def __init__(self, offsets, blob):
+        self.offsets = offsets
+        self.blob = blob
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.blob[int(self.offsets[i]):int(self.offsets[i + 1])].tobytes()
+
+    def get(self, word, default=None):
+        key = _encode(word)
+        i = bisect_left(self, key)
+        if i < len(self) and self[i] == key:
+            return i
+        return default
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i].decode('utf-8', 'surrogatepass')
+
+
+# Drop-in replacement for TFidF reading a file written by write_binary_model
+# get_term_frequencies() and get_doc_frequencies() rebuild the dictionaries on first use, classifying doesn't need them
+class MappedTFidF(TFidF):
+    def __init__(self, file_name):
+        with open(file_name, 'rb') as fi:
+            self.buffer = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.buffer[:len(MAGIC)] != MAGIC:
+            raise ValueError(file_name + " is not a binary model")
+
+        header_size = int(np.frombuffer(self.buffer, dtype='<u8', count=1, offset=len(MAGIC))[0])
+        header = json.loads(self.buffer[len(MAGIC) + 8:len(MAGIC) + 8 + header_size].decode('utf-8'))
+        if header['version'] != VERSION:
+            raise ValueError(file_name + " has unsupported version " + str(header['version']))
+
+        num_terms = header['num_terms']
+        num_categories = len(header['categories'])
+        self.categories = header['categories']
+        self.category_ids = {cat: c for c, cat in enumerate(self.categories)}
+        self.num_docs = header['num_docs']
+
+        offsets = np.frombuffer(self.buffer, dtype='<u8', count=num_terms + 1, offset=header['offsets'])
+        blob = np.frombuffer(self.buffer, dtype='u1', count=int(offsets[-1]), offset=header['blob'])
+        self.terms = MappedTerms(offsets, blob)
+        self.doc_freqs = np.frombuffer(self.buffer, dtype='<i4', count=num_terms, offset=header['doc_freqs'])
+        self.counts = np.frombuffer(self.buffer, dtype='<i4', count=num_categories * num_terms,
+                                    offset=header['counts']).reshape(num_terms, num_categories)
+        self.weights = np.frombuffer(self.buffer, dtype='<f8', count=num_categories * num_terms,
+                                     offset=header['weights']).reshape(num_terms, num_categories)
+
+        super().__init__(None, None)
+        self.score_matrix = ScoreMatrix(self.categories, self.terms, self.weights)
+
+    def __call__(self, word, category):
+        term_id = self.terms.get(word)
+        cat_id = self.category_ids.get(category)
+        if term_id is None or cat_id is None or self.counts[term_id, cat_id] == 0:
+            return 0
+        return float(self.weights[term_id, cat_id])
+
+    def get_categories(self):
+        return self.categories
+
+    def get_term_frequencies(self):
+        if self.term_frequencies is None:
+            terms = list(self.terms)
+            self.term_frequencies = {}
+            for c, cat in enumerate(self.categories):
+                present = np.flatnonzero(self.counts[:, c])
+                self.term_frequencies[cat] = {'num_docs': self.num_docs[c],
+                                              'counts': {terms[i]: int(self.counts[i, c]) for i in present}}
+        return self.term_frequencies
+
+    def get_doc_frequencies(self):
+        if self.doc_frequencies is None:
+            self.doc_frequencies = {word: int(doc_freq) for word, doc_freq in zip(self.terms, self.doc_freqs)}
+        return self.doc_frequencies
+
+
+# Model with num_terms random terms spread over num_categories categories, shaped like the real one
+# (most terms in few categories)
+def synthetic_model(num_terms, num_categories=10, seed=0):
+    rand = random.Random(seed)
+    term_freqs = {'category ' + str(c): {'num_docs': rand.randint(100, 10000), 'counts': {}}
+                  for c in range(num_categories)}
+    doc_freqs = {}
+    categories = list(term_freqs)
+    for t in range(num_terms):
+        word = 'term' + str(t)
+        in_categories = rand.sample(categories, min(num_categories, 1 + int(rand.expovariate(1.0))))
+        for cat in in_categories:
+            term_freqs[cat]['counts'][word] = 1 + int(rand.expovariate(0.1))
+        doc_freqs[word] = len(in_categories)
+    return term_freqs, doc_freqs
+
+
+# Resident memory of this process in kB, (total, private dirty), None if /proc isn't available
+# Mapped model pages are clean and backed by the file, so they are shared by every process mapping it,
+# private dirty memory is what each extra worker process really costs
+def memory_usage():
+    if not os.path.exists('/proc/self/smaps_rollup'):
+        return None, None
+
+    fields = {}
+    with open('/proc/self/smaps_rollup', 'r') as fi:
+        for line in fi:
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == 'kB':
+                fields[parts[0].rstrip(':')] = int(parts[1])
+    return fields.get('Rss'), fields.get('Private_Dirty', 0)
+
+
+# Runs in its own (spawned, not forked) process so every measurement starts from the same empty state
+def _measure(que, files, words):
+    # First sparse product loads the rest of scipy, do it here so neither format is charged for it
+    ScoreMatrix([], {}, np.zeros((0, 0))).scores([{}])
+
+    rss_before, dirty_before = memory_usage()
+    start = time()
+    if len(files) == 2:
+        tf_idf = _load_json(files[0], files[1])
+    else:
+        tf_idf = MappedTFidF(files[0])
+    loaded = time() - start
+    score_matrix = tf_idf.get_score_matrix()
+    ready = time() - start
+    score_matrix.scores([{word: 1 for word in words}])
+    rss_after, dirty_after = memory_usage()
+    que.put((loaded, ready,
+             rss_after - rss_before if rss_before is not None else None,
+             dirty_after - dirty_before if dirty_before is not None else None))
+
+
+def _load_json(term_file, doc_file):
+    with open(term_file, 'r') as fi:
+        term_frequencies = json.load(fi)
+    with open(doc_file, 'r') as fi:
+        doc_frequencies = json.load(fi)
+    return TFidF(term_frequencies, doc_frequencies)
+
+
+def benchmark(num_terms, directory='.'):
+    term_file = os.path.join(directory, 'synthetic_term_frequencies.json')
+    doc_file = os.path.join(directory, 'synthetic_doc_frequencies.json')
+    bin_file = os.path.join(directory, 'synthetic_model.bin')
+
+    term_frequencies, doc_frequencies = synthetic_model(num_terms)
+    with open(term_file, 'w') as fi:
+        json.dump(term_frequencies, fi, indent=4, sort_keys=True)
+    with open(doc_file, 'w') as fi:
+        json.dump(doc_frequencies, fi, indent=4, sort_keys=True)
+    write_binary_model(term_frequencies, doc_frequencies, bin_file)
+    words = random.Random(1).sample(list(doc_frequencies), min(100, num_terms))
+    del term_frequencies, doc_frequencies
+
+    # Pages of a file that was just written are dirty until flushed, and would be counted as private once mapped
+    for file_name in [term_file, doc_file, bin_file]:
+        with open(file_name, 'rb') as fi:
+            os.fsync(fi.fileno())
+
+    print('Format, File MB, Load sec, Ready to classify sec, RSS kB, Private dirty kB')
+    for name, files in [('json', [term_file, doc_file]), ('binary', [bin_file])]:
+        context = get_context('spawn')
+        que = context.Queue()
+        proc = context.Process(target=_measure, args=(que, files, words))
+        proc.start()
+        loaded, ready, rss, dirty = que.get()
+        proc.join()
+        size = sum(os.path.getsize(f) for f in files) / 2 ** 20
+        print(name, size, loaded, ready, rss, dirty, sep=', ')
+
+    for f in [term_file, doc_file, bin_file]:
+        os.remove(f)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) in [2, 3] and sys.argv[1] == '--benchmark':
+        benchmark(int(sys.argv[2]) if len(sys.argv) == 3 else 200000)
+        exit(0)
+
+    if len(sys.argv) != 4:
+        print("Usage: ./binary_model term_frequencies.json doc_frequencies.json model.bin")
+        print("       ./binary_model --benchmark [num_terms]")
+        exit(1)
+
+    with open(sys.argv[1], 'r') as fi:
+        term_frequencies_json = json.load(fi)
+
+    with open(sys.argv[2], 'r') as fi:
+        doc_frequencies_json = json.load(fi)
+
+    write_binary_model(term_frequencies_json, doc_frequencies_json, sys.argv[3])
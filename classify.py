@@ -1,35 +1,163 @@
 #!/usr/bin/env python3
-import copy
+import argparse
+import csv
+import gzip
 import json
+import sqlite3
 import sys
+import threading
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from multiprocessing import Pool
+from time import perf_counter, time
 
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
-# from nltk.tokenize import RegexpTokenizer
-from nltk.stem.snowball import PorterStemmer
+import numpy as np
 
-import wordsegment
-
-# Global data to eliminate construction and destruction again and again
-stemmer = PorterStemmer()
-stop_words = set(stopwords.words('english'))
+# Global data to eliminate construction and destruction again and again (shared with make_model)
+from normalize import normalizer
+from metrics import metrics
 
 
 # Refactored out of original code, now applying strategy pattern
 # Functor that queries a similarity database with format (word1 : str, word2 : str, similarity_score : float)
 # Supply Database connection, originally used with an SQLite3 database called 'SEWordSim-r1.db'
 # similarity_score between 0 and 1
+#
+# Note: SQLite reads the range test 'a <= similarity <= b' as '(a <= similarity) <= b', which holds for every row when
+# b is 1, so min_similarity is not applied; every published result was made this way, so it stays the default
+# apply_range=True tests 'similarity between a and b' instead, which changes the results of any min_similarity above 0
+# Neighbours of equal similarity come in table (rowid) order
+# Filtered before limited, the answer for a smaller num_similar is the start of a larger one's (see SimCache)
 class SimDB(object):
-    def __init__(self, sim_db_conn):
+    prefix_limited = True
+
+    def __init__(self, sim_db_conn, apply_range=False):
         self.db_conn = sim_db_conn
+        self.apply_range = apply_range
 
-    def __call__(self, wd, num_similar, min_similarity, max_similarity=1.0):
-        self.db_conn.execute("select term_2 from Word_Similarity where term_1=\'" + wd + "\'"
-                             + " and " + str(min_similarity) + " <= similarity <= " + str(max_similarity)
-                             + " order by similarity "
+    # Same query as __call__, returns (term, similarity) pairs
+    def scored(self, wd, num_similar, min_similarity, max_similarity=1.0):
+        if self.apply_range:
+            range_test = " and similarity between " + str(min_similarity) + " and " + str(max_similarity)
+        else:
+            range_test = " and " + str(min_similarity) + " <= similarity <= " + str(max_similarity)
+        self.db_conn.execute("select term_2, similarity from Word_Similarity where term_1=\'" + wd + "\'"
+                             + range_test
+                             + " order by similarity, rowid "
                              + " limit " + str(num_similar) + ";")
-        res = self.db_conn.fetchall()
-        return [x[0] if isinstance(x, tuple) else x for x in res]
+        return self.db_conn.fetchall()
+
+    def __call__(self, wd, num_similar, min_similarity, max_similarity=1.0):
+        return [x[0] for x in self.scored(wd, num_similar, min_similarity, max_similarity)]
+
+
+# Faster SimDB, same results (same range test, see apply_range, ordered by similarity then rowid, then limited to
+# num_similar), so it is a drop-in replacement
+# Database is either copied into a shared in memory database by the sqlite3 backup API (in_memory=True, rowids are
+# kept), or opened read only and memory mapped from the file (in_memory=False)
+# Queries are parameterized (compiled once and cached by sqlite3) and served by an index on (term_1, similarity), which
+# holds the rowid as its last column and so is already in the order of the results; it is created in the in memory
+# copy if missing, a memory mapped file is never written to unless create_index=True adds the index to the file itself
+# (once, later opens use it)
+# Every thread gets its own connection, so one IndexedSimDB can be used from any thread (ie. the GUI's worker)
+# close() closes the connections of every thread (and so frees the in memory copy), call it once done with it
+class IndexedSimDB(object):
+    prefix_limited = True
+
+    index_sql = ("create index if not exists Word_Similarity_ordered"
+                 " on Word_Similarity (term_1, similarity)")
+
+    # Range test of SimDB's query for each apply_range
+    range_sql = {False: "? <= similarity <= ?", True: "similarity between ? and ?"}
+    query_sql = ("select term_2, similarity from Word_Similarity"
+                 " where term_1 = ? and {} order by similarity, rowid limit ?")
+
+    # One limited, index ordered subquery per word, in a single statement
+    many_part = ("select * from (select term_1, term_2 from Word_Similarity"
+                 " where term_1 = ? and {} order by similarity, rowid limit ?)")
+
+    # Words per statement, 4 parameters each: SQLite before 3.32 allows at most 999 parameters (and at most 500 terms
+    # in a compound select)
+    many_chunk = 999 // 4
+
+    # progress(message, fraction) is called as the file is copied into memory
+    def __init__(self, file_name='SEWordSim-r1.db', in_memory=True, mmap_size=2 ** 32, progress=None,
+                 create_index=False, apply_range=False):
+        self.apply_range = apply_range
+        self.query = self.query_sql.format(self.range_sql[apply_range])
+        self.many_query = self.many_part.format(self.range_sql[apply_range])
+        self.in_memory = in_memory
+        self.mmap_size = mmap_size
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = []
+        self.keep_alive = None
+
+        if in_memory:
+            self.uri = 'file:indexed_sim_db_' + str(id(self)) + '?mode=memory&cache=shared'
+            # Shared in memory database lives as long as one connection to it is open
+            self.keep_alive = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+            source = sqlite3.connect('file:' + file_name + '?mode=ro', uri=True)
+            if progress is None:
+                source.backup(self.keep_alive)
+            else:
+                source.backup(self.keep_alive, pages=4096,
+                              progress=lambda status, remaining, total: progress(
+                                  "Copying '" + file_name + "' into ram", 1 - remaining / total if total else 1.0))
+            source.close()
+            self.keep_alive.execute(self.index_sql)
+            self.keep_alive.commit()
+        else:
+            self.uri = 'file:' + file_name + '?mode=ro'
+            if create_index:
+                conn = sqlite3.connect(file_name)
+                try:
+                    conn.execute(self.index_sql)
+                    conn.commit()
+                finally:
+                    conn.close()
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            # only used from this thread, but close() closes it from another one
+            conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+            if not self.in_memory:
+                conn.execute('pragma mmap_size=' + str(int(self.mmap_size)))
+            self.local.conn = conn
+            with self.lock:
+                self.connections.append(conn)
+        return conn
+
+    def close(self):
+        with self.lock:
+            connections, self.connections = self.connections, []
+        if self.keep_alive is not None:
+            connections.append(self.keep_alive)
+            self.keep_alive = None
+        for conn in connections:
+            conn.close()
+
+    def scored(self, wd, num_similar, min_similarity, max_similarity=1.0):
+        return self.connection().execute(self.query, (wd, min_similarity, max_similarity, num_similar)).fetchall()
+
+    def __call__(self, wd, num_similar, min_similarity, max_similarity=1.0):
+        return [x[0] for x in self.scored(wd, num_similar, min_similarity, max_similarity)]
+
+    # Looks up every word in one query (per many_chunk words), returns dictionary of (word : same list as __call__)
+    def many(self, words, num_similar, min_similarity, max_similarity=1.0):
+        words = list(dict.fromkeys(words))
+        res = {wd: [] for wd in words}
+        conn = self.connection()
+        for i in range(0, len(words), self.many_chunk):
+            chunk = words[i:i + self.many_chunk]
+            sql = ' union all '.join([self.many_query] * len(chunk))
+            params = []
+            for wd in chunk:
+                params.extend((wd, min_similarity, max_similarity, num_similar))
+            for term_1, term_2 in conn.execute(sql, params):
+                res[term_1].append(term_2)
+        return res
 
 
 class Word2Vec(object):
@@ -37,17 +165,549 @@ class Word2Vec(object):
         self.model = model
         self.index = index
 
-    def __call__(self, wd, num_similar, min_similarity, max_similarity=1.0):
+    # Neighbours of wd as (word, score) pairs, before filtering on similarity
+    def ranked(self, wd, num_similar):
         assert(0 <= num_similar <= 10)
         if not wd.isalpha():
             return []
 
         try:
-            ret = self.model.most_similar(positive=wd, topn=num_similar, indexer=self.index)
+            return self.model.most_similar(positive=wd, topn=num_similar, indexer=self.index)
         except KeyError:
             return []
 
-        return [word for (word, score) in ret if min_similarity <= score <= max_similarity]
+    def __call__(self, wd, num_similar, min_similarity, max_similarity=1.0):
+        return [word for (word, score) in self.ranked(wd, num_similar) if min_similarity <= score <= max_similarity]
+
+
+# Word2Vec for batches of words, ranked_many() finds the neighbours of every distinct word of a batch together
+# exact=True multiplies the (normalized, memory mapped) vectors of the batch against the whole vocabulary, block by
+# block, keeping a running top num_similar per word, so the full similarity matrix is never held in memory
+# exact=False asks the Annoy index once per distinct word (Annoy has no batch query), through the indexer's own
+# most_similar with the word's unit vector, as gensim's most_similar(indexer=...) does, so neighbours and scores are
+# the same as Word2Vec's (gensim 3.8 scores 1 - distance / 2, gensim 4 1 - distance ** 2 / 2)
+#
+# Word2Vec with an AnnoyIndexer (as load_w2v builds it) lists the word itself as its own nearest neighbour, exact mode
+# does the same by default so both rank the same candidates, include_self=False matches Word2Vec without an index
+# Model can be gensim 3 (vocab, index2word) or 4 (key_to_index, index_to_key) KeyedVectors
+class BatchedWord2Vec(object):
+    def __init__(self, model, index=None, exact=True, include_self=True, batch_size=256, block_size=65536):
+        assert exact or index is not None
+        self.model = model
+        self.index = index
+        self.exact = exact
+        self.include_self = include_self
+        self.batch_size = batch_size
+        self.block_size = block_size
+
+        if hasattr(model, 'key_to_index'):
+            self.word_ids = model.key_to_index
+            self.words = model.index_to_key
+        else:
+            self.word_ids = {word: vocab.index for word, vocab in model.vocab.items()}
+            self.words = model.index2word
+        self.norms = None
+
+    # Length of every vector, computed block by block on first use (SO_vectors_normed is already normalized,
+    # but nothing else has to be)
+    def get_norms(self):
+        if self.norms is None:
+            vectors = self.model.vectors
+            self.norms = np.concatenate([np.linalg.norm(vectors[i:i + self.block_size], axis=1)
+                                         for i in range(0, len(vectors), self.block_size)])
+            self.norms[self.norms == 0] = 1
+        return self.norms
+
+    # Dictionary of (word : neighbours as (word, score) pairs, before filtering on similarity), as Word2Vec.ranked
+    def ranked_many(self, words, num_similar):
+        assert(0 <= num_similar <= 10)
+        res = {wd: [] for wd in words}
+        ids = list(dict.fromkeys(self.word_ids[wd] for wd in res if wd.isalpha() and wd in self.word_ids))
+        if num_similar == 0 or not ids:
+            return res
+
+        if self.exact:
+            neighbours = {}
+            for i in range(0, len(ids), self.batch_size):
+                neighbours.update(self._exact(ids[i:i + self.batch_size], num_similar))
+        else:
+            vectors = self.model.vectors
+            norms = self.get_norms()
+            neighbours = {word_id: self.index.most_similar(vectors[word_id] / norms[word_id], num_similar)
+                          for word_id in ids}
+
+        for wd in res:
+            word_id = self.word_ids.get(wd)
+            if word_id in neighbours:
+                res[wd] = neighbours[word_id]
+        return res
+
+    # Top num_similar (word, cosine similarity) of every vector in ids, ties in favour of the smaller word id
+    def _exact(self, ids, num_similar):
+        vectors = self.model.vectors
+        norms = self.get_norms()
+        queries = vectors[ids] / norms[ids, np.newaxis]
+        k = num_similar if self.include_self else num_similar + 1
+
+        best_ids = np.zeros((len(ids), 0), dtype=np.int64)
+        best_scores = np.zeros((len(ids), 0), dtype=queries.dtype)
+        for start in range(0, len(vectors), self.block_size):
+            block = vectors[start:start + self.block_size]
+            scores = (queries @ block.T) / norms[start:start + len(block)]
+            if len(block) > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+            else:
+                top = np.broadcast_to(np.arange(len(block)), (len(ids), len(block)))
+            best_ids = np.concatenate([best_ids, top + start], axis=1)
+            best_scores = np.concatenate([best_scores, np.take_along_axis(scores, top, axis=1)], axis=1)
+
+            order = np.lexsort((best_ids, -best_scores), axis=1)[:, :k]
+            best_ids = np.take_along_axis(best_ids, order, axis=1)
+            best_scores = np.take_along_axis(best_scores, order, axis=1)
+
+        # rounding can put a word's similarity to itself just above 1, which max_similarity would then filter out
+        np.clip(best_scores, -1, 1, out=best_scores)
+
+        neighbours = {}
+        for word_id, found, scores in zip(ids, best_ids.tolist(), best_scores.tolist()):
+            pairs = [(self.words[found_id], score) for found_id, score in zip(found, scores)
+                     if self.include_self or found_id != word_id]
+            neighbours[word_id] = pairs[:num_similar]
+        return neighbours
+
+    def ranked(self, wd, num_similar):
+        return self.ranked_many([wd], num_similar)[wd]
+
+    def many(self, words, num_similar, min_similarity, max_similarity=1.0):
+        return {wd: [word for (word, score) in ranked if min_similarity <= score <= max_similarity]
+                for wd, ranked in self.ranked_many(words, num_similar).items()}
+
+    def __call__(self, wd, num_similar, min_similarity, max_similarity=1.0):
+        return self.many([wd], num_similar, min_similarity, max_similarity)[wd]
+
+
+# Memoizing wrapper around any similarity functor (SimDB, Word2Vec, ...), size bounded by LRU eviction
+# Entries are keyed on (wd, num_similar, min_similarity, max_similarity) and report hit/miss counts
+# Contents can be dumped to a json file and loaded back, so a restarted process starts warm
+#
+# If the wrapped functor has a ranked(wd, num_similar) method (see Word2Vec), one entry per word is kept instead,
+# holding the unfiltered neighbours for the largest num_similar seen so far
+# Smaller queries, with any similarity bounds, are then answered by truncating and filtering that entry
+# Note: with an Annoy index the larger query is (slightly) more accurate, so results can differ from a direct call
+# If the functor filters on similarity before limiting (prefix_limited, see SimDB), one entry per (wd, min_similarity,
+# max_similarity) is kept the same way, smaller queries with the same bounds are answered by truncating it
+# Answers a functor marks as partial (PartialAnswer, see FusedSim) are returned but not kept
+# Entries and counts are read and written under a lock, so one cache can serve several threads (ie. the GUI's worker
+# pool), a word missing from it can then be looked up by two threads at once, and the last answer is kept
+class SimCache(object):
+    def __init__(self, sim_func, max_size=100000):
+        self.sim_func = sim_func
+        self.max_size = max_size
+        self.ranked = hasattr(sim_func, 'ranked')
+        self.prefix_limited = not self.ranked and getattr(sim_func, 'prefix_limited', False)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, wd, num_similar, min_similarity, max_similarity=1.0):
+        if self.ranked:
+            entry = self._get(wd, num_similar)
+            if entry is None:
+                entry = (num_similar, self.sim_func.ranked(wd, num_similar))
+                self._put(wd, entry)
+            return [word for (word, score) in entry[1][:num_similar] if min_similarity <= score <= max_similarity]
+
+        if self.prefix_limited:
+            key = (wd, min_similarity, max_similarity)
+            entry = self._get(key, num_similar)
+            if entry is None:
+                res = self.sim_func(wd, num_similar, min_similarity, max_similarity)
+                entry = (num_similar, list(res))
+                if not isinstance(res, PartialAnswer):
+                    self._put(key, entry)
+            return entry[1][:num_similar]
+
+        key = (wd, num_similar, min_similarity, max_similarity)
+        res = self._get(key)
+        if res is None:
+            res = self.sim_func(wd, num_similar, min_similarity, max_similarity)
+            if not isinstance(res, PartialAnswer):
+                self._put(key, list(res))
+
+        return list(res)
+
+    # Only offered when the wrapped functor has many() too (or ranked_many(), see BatchedWord2Vec),
+    # misses are looked up in one call
+    def __getattr__(self, name):
+        if name == 'many' and hasattr(self.sim_func, 'ranked_many' if self.ranked else 'many'):
+            return self._many
+        raise AttributeError(name)
+
+    def _many(self, words, num_similar, min_similarity, max_similarity=1.0):
+        if self.ranked:
+            return self._many_ranked(words, num_similar, min_similarity, max_similarity)
+        return self._many_filtered(words, num_similar, min_similarity, max_similarity)
+
+    def _many_filtered(self, words, num_similar, min_similarity, max_similarity):
+        def key_of(wd):
+            if self.prefix_limited:
+                return wd, min_similarity, max_similarity
+            return wd, num_similar, min_similarity, max_similarity
+
+        res = {}
+        missing = []
+        for wd in words:
+            entry = self._get(key_of(wd), num_similar if self.prefix_limited else None)
+            if entry is None:
+                missing.append(wd)
+            else:
+                res[wd] = entry[1][:num_similar] if self.prefix_limited else list(entry)
+
+        if missing:
+            fetched = self.sim_func.many(missing, num_similar, min_similarity, max_similarity)
+            for wd, entry in fetched.items():
+                if not isinstance(entry, PartialAnswer):
+                    self._put(key_of(wd), (num_similar, list(entry)) if self.prefix_limited else list(entry))
+                res[wd] = list(entry)
+
+        return res
+
+    def _many_ranked(self, words, num_similar, min_similarity, max_similarity):
+        entries = {}
+        missing = []
+        for wd in words:
+            entry = self._get(wd, num_similar)
+            if entry is None:
+                missing.append(wd)
+            else:
+                entries[wd] = entry
+
+        if missing:
+            for wd, ranked in self.sim_func.ranked_many(missing, num_similar).items():
+                entries[wd] = (num_similar, ranked)
+                self._put(wd, entries[wd])
+
+        return {wd: [word for (word, score) in entry[1][:num_similar] if min_similarity <= score <= max_similarity]
+                for wd, entry in entries.items()}
+
+    # Entry of key, counted as a hit, or None counted as a miss (also when it holds fewer than num_similar neighbours,
+    # entries of ranked and prefix_limited functors are (num_similar, neighbours) pairs)
+    def _get(self, key, num_similar=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (num_similar is None or entry[0] >= num_similar):
+                self.entries.move_to_end(key)
+                self.hits += 1
+            else:
+                entry = None
+                self.misses += 1
+
+        if metrics.enabled:
+            metrics.count('sim_cache_misses' if entry is None else 'sim_cache_hits')
+        return entry
+
+    def _put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def get_stats(self):
+        with self.lock:
+            hits, misses, size = self.hits, self.misses, len(self.entries)
+        total = hits + misses
+        return {'hits': hits,
+                'misses': misses,
+                'hit_rate': hits / total if total else 0.0,
+                'size': size}
+
+    def close(self):
+        close_sim_func(self.sim_func)
+
+    # Entries are written least recently used first, so loading them back restores the LRU order
+    def dump(self, file_name):
+        with self.lock:
+            entries = [[key, entry] for key, entry in self.entries.items()]
+        with open(file_name, 'w') as fi:
+            json.dump(entries, fi)
+
+    # Entries saved from another kind of functor (ranked, prefix_limited or neither) are skipped
+    def load(self, file_name):
+        with open(file_name, 'r') as fi:
+            for key, entry in json.load(fi):
+                if self.ranked and isinstance(key, str):
+                    self._put(key, (entry[0], [tuple(pair) for pair in entry[1]]))
+                elif self.prefix_limited and isinstance(key, list) and len(key) == 3:
+                    self._put(tuple(key), (entry[0], entry[1]))
+                elif not self.ranked and not self.prefix_limited and isinstance(key, list) and len(key) == 4:
+                    self._put(tuple(key), entry)
+
+
+# Similarity functor served from a table compiled by make_sim_table.py (see read_sim_table), so no semantic resource
+# (gensim, Annoy, SQLite) has to be loaded by the classifying process
+# The table only keeps neighbours whose stem is in the model vocabulary, but every entry keeps its score and its
+# position in the original results, so the answers score exactly like the resource the table was compiled from
+#
+# Modes follow the resource:
+# 'ranked': Word2Vec, top num_similar neighbours then filtered on similarity
+# 'filtered': SimDB, filtered on similarity then the first num_similar kept, with SimDB's range test (apply_range)
+class SimTable(object):
+    def __init__(self, data):
+        self.mode = data['mode']
+        self.limit = data['limit']
+        self.stemmed_database = data['stemmed_database']
+        self.apply_range = data.get('apply_range', False)
+
+        # Entries are [word id, score], id is -1 for neighbours outside the model vocabulary
+        words = data['words']
+        self.table = {key: [(words[word_id] if word_id >= 0 else None, score) for word_id, score in entries]
+                      for key, entries in data['table'].items()}
+
+    def __call__(self, wd, num_similar, min_similarity, max_similarity=1.0):
+        assert(0 <= num_similar <= self.limit)
+        entries = self.table.get(wd)
+        if entries is None:
+            return []
+
+        if self.mode == 'ranked':
+            return [word for (word, score) in entries[:num_similar]
+                    if word is not None and min_similarity <= score <= max_similarity]
+
+        res = []
+        position = 0
+        for word, score in entries:
+            if position == num_similar:
+                break
+            if in_range(score, min_similarity, max_similarity, self.apply_range):
+                if word is not None:
+                    res.append(word)
+                position += 1
+
+        return res
+
+
+# SimDB's range test on one similarity, as SQLite evaluates it (see SimDB)
+def in_range(similarity, min_similarity, max_similarity, apply_range=False):
+    if apply_range:
+        return min_similarity <= similarity <= max_similarity
+    return (min_similarity <= similarity) <= max_similarity
+
+
+def read_sim_table(file_name):
+    with gzip.open(file_name, 'rt') as fi:
+        return SimTable(json.load(fi))
+
+
+# Answer of a similarity functor that is missing part of its neighbours (ie. a FusedSim backend timed out), used as a
+# list, SimCache doesn't keep it
+class PartialAnswer(list):
+    pass
+
+
+# Releases what a similarity functor holds (FusedSim's threads, ...) when it has a close(), sim_func may be None
+def close_sim_func(sim_func):
+    if sim_func is not None and hasattr(sim_func, 'close'):
+        sim_func.close()
+
+
+# One resource of a FusedSim, with its own weight, key type and timeout (seconds, None waits for it)
+# stemmed=True looks words up by their stem (as WordSimSEDB), stemmed=False by the word itself (as Word2VecSE)
+# Lookups run on the backend's own worker thread, so a functor is only ever used from that thread
+# (and a slow backend never takes a thread from another one)
+class SimBackend(object):
+    def __init__(self, name, sim_func, weight=1.0, stemmed=False, timeout=None):
+        self.name = name
+        self.sim_func = sim_func
+        self.weight = weight
+        self.stemmed = stemmed
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sim_' + name)
+        self.pending = set()
+
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.words = 0
+        self.seconds = 0.0
+        self.waited = 0.0
+        self.timeouts = 0
+        self.neighbours = 0
+        self.kept = 0
+
+    # Dictionary of (key : neighbours as (word, similarity) pairs), with whatever scores the functor gives:
+    # ranked_many()/ranked() (BatchedWord2Vec, Word2Vec), scored() (IndexedSimDB, SimDB), or none (similarity 1)
+    def lookup(self, keys, num_similar, min_similarity, max_similarity):
+        start = perf_counter()
+        func = self.sim_func
+        if hasattr(func, 'ranked_many') or hasattr(func, 'ranked'):
+            if hasattr(func, 'ranked_many'):
+                ranked = func.ranked_many(keys, num_similar)
+            else:
+                ranked = {key: func.ranked(key, num_similar) for key in keys}
+            res = {key: [(word, score) for (word, score) in ranked[key] if min_similarity <= score <= max_similarity]
+                   for key in keys}
+        elif hasattr(func, 'scored'):
+            res = {key: func.scored(key, num_similar, min_similarity, max_similarity) for key in keys}
+        else:
+            if hasattr(func, 'many'):
+                found = func.many(keys, num_similar, min_similarity, max_similarity)
+            else:
+                found = {key: func(key, num_similar, min_similarity, max_similarity) for key in keys}
+            res = {key: [(word, 1.0) for word in found[key]] for key in keys}
+
+        elapsed = perf_counter() - start
+        with self.lock:
+            self.calls += 1
+            self.words += len(keys)
+            self.seconds += elapsed
+        return res
+
+    # lookup() on the backend's own thread, the future is tracked until it is done (see cancel_pending)
+    def submit(self, keys, num_similar, min_similarity, max_similarity):
+        future = self.executor.submit(self.lookup, keys, num_similar, min_similarity, max_similarity)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+
+    # Cancels the lookups that haven't started yet
+    def cancel_pending(self):
+        with self.lock:
+            pending = list(self.pending)
+        for future in pending:
+            future.cancel()
+
+    def get_stats(self):
+        with self.lock:
+            return {'calls': self.calls,
+                    'words': self.words,
+                    'seconds': self.seconds,
+                    'waited': self.waited,
+                    'timeouts': self.timeouts,
+                    'neighbours': self.neighbours,
+                    'kept': self.kept,
+                    'ms_per_call': 1000 * self.seconds / self.calls if self.calls else 0.0}
+
+
+# Similarity functor over several resources at once (see SimBackend), every lookup is sent to all backends in
+# parallel and their neighbours merged
+# Neighbours are deduplicated on their stem, a stem scores the weighted sum of its best similarity from each backend
+# (divided by the sum of the weights, so it stays between 0 and 1), the top num_similar are kept, highest first
+# A backend that hasn't answered by its timeout (counted from the start of the lookup) is left out of that lookup,
+# its call is cancelled if it didn't start yet, otherwise it finishes in the background
+#
+# Classify with stemmed_database=False, FusedSim needs the words themselves and stems them for stemmed backends
+# Answers are the neighbours as the backends gave them (one per stem), expand_words stems them as usual
+#
+# get_stats() reports per backend: seconds spent in lookups, seconds the lookups waited on it (its contribution to
+# the latency, the waits add up to the time of the fused lookups), timeouts, and neighbours found and kept
+# With metrics enabled the waits are also timed as stage 'similarity_' + name
+# Answers of a lookup that a backend timed out on are PartialAnswer lists, so SimCache doesn't keep them (the next
+# lookup of the word asks every backend again)
+# close() stops the backends' threads and closes their resources, call it once done with the FusedSim
+class FusedSim(object):
+    def __init__(self, backends):
+        assert backends and sum(backend.weight for backend in backends) > 0
+        self.backends = backends
+        self.total_weight = sum(backend.weight for backend in backends)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.seconds = 0.0
+
+    # Dictionary of (word : neighbours as (word, fused similarity) pairs)
+    def scored_many(self, words, num_similar, min_similarity, max_similarity=1.0):
+        words = list(dict.fromkeys(words))
+        start = perf_counter()
+
+        submitted = []
+        for backend in self.backends:
+            keys = {wd: normalizer.stem(wd) if backend.stemmed else wd for wd in words}
+            future = backend.submit(list(dict.fromkeys(keys.values())), num_similar, min_similarity, max_similarity)
+            submitted.append((backend, keys, future))
+
+        # best (word, similarity) per neighbour stem, from each backend that answered in time
+        candidates = {wd: OrderedDict() for wd in words}
+        partial = False
+        for backend, keys, future in submitted:
+            waiting = perf_counter()
+            try:
+                if backend.timeout is None:
+                    found = future.result()
+                else:
+                    found = future.result(timeout=max(0.0, start + backend.timeout - waiting))
+            except FutureTimeoutError:
+                future.cancel()
+                found = None
+                partial = True
+            waited = perf_counter() - waiting
+
+            neighbours = 0
+            for wd, key in ([] if found is None else keys.items()):
+                best = {}
+                for word, score in found[key]:
+                    stem = normalizer.stem(word)
+                    if stem not in best or score > best[stem][1]:
+                        best[stem] = (word, score)
+                neighbours += len(best)
+                for stem, (word, score) in best.items():
+                    entry = candidates[wd].setdefault(stem, [word, 0.0, []])
+                    entry[1] += backend.weight * score
+                    entry[2].append(backend)
+
+            with backend.lock:
+                backend.waited += waited
+                backend.timeouts += found is None
+                backend.neighbours += neighbours
+            if metrics.enabled:
+                metrics.time('similarity_' + backend.name, waited)
+                if found is None:
+                    metrics.count('similarity_timeouts')
+
+        res = {}
+        kept = Counter()
+        answer = PartialAnswer if partial else list
+        for wd, entries in candidates.items():
+            # stable sort, ties keep the order of the backends and of their answers
+            top = sorted(entries.values(), key=lambda entry: -entry[1])[:num_similar]
+            res[wd] = answer((word, score / self.total_weight) for word, score, sources in top)
+            kept.update(backend.name for word, score, sources in top for backend in sources)
+        for backend in self.backends:
+            with backend.lock:
+                backend.kept += kept[backend.name]
+
+        with self.lock:
+            self.calls += 1
+            self.seconds += perf_counter() - start
+        return res
+
+    def scored(self, wd, num_similar, min_similarity, max_similarity=1.0):
+        return self.scored_many([wd], num_similar, min_similarity, max_similarity)[wd]
+
+    def many(self, words, num_similar, min_similarity, max_similarity=1.0):
+        return {wd: type(pairs)(word for (word, score) in pairs)
+                for wd, pairs in self.scored_many(words, num_similar, min_similarity, max_similarity).items()}
+
+    def __call__(self, wd, num_similar, min_similarity, max_similarity=1.0):
+        pairs = self.scored(wd, num_similar, min_similarity, max_similarity)
+        return type(pairs)(word for (word, score) in pairs)
+
+    def get_stats(self):
+        with self.lock:
+            stats = {'calls': self.calls, 'seconds': self.seconds}
+        stats['backends'] = {backend.name: backend.get_stats() for backend in self.backends}
+        return stats
+
+    def close(self):
+        # cancel_futures of shutdown() needs python 3.9
+        for backend in self.backends:
+            backend.cancel_pending()
+            backend.executor.shutdown(wait=False)
+            close_sim_func(backend.sim_func)
 
 
 # term/doc_frequencies are dictionaries as generated by make_model
@@ -62,6 +722,8 @@ class TFidF(object):
     def __init__(self, term_freqs, doc_freqs):
         self.term_frequencies = term_freqs
         self.doc_frequencies = doc_freqs
+        self.score_matrix = None
+        self.posting_index = None
 
     # word is a string, category is a string and must be a valid category name
     def __call__(self, word, category):
@@ -86,109 +748,565 @@ class TFidF(object):
     def get_doc_frequencies(self):
         return self.doc_frequencies
 
+    # Built on first use, then shared by every classify/classify_batch call on this model
+    def get_score_matrix(self):
+        if self.score_matrix is None:
+            self.score_matrix = build_score_matrix(self)
+        return self.score_matrix
+
+    def get_posting_index(self):
+        if self.posting_index is None:
+            self.posting_index = PostingIndex(self)
+        return self.posting_index
+
+
+# Tokenize, segment and filter a message, returns the (unstemmed) words that take part in classification
+def filter_words(message, segment=True):
+    return list(normalizer.tokens(message, segment))
+
+
+# Expand a message into a dictionary of (stemmed term : weight) as seen by the scoring step
+# Weight reproduces the original per-category loop, each occurrence of a filtered word added count * tf_idf(sub)
+# for every one of its substitutes, so a word seen n times contributes n * n per substitute
+def expand_message(message, sim_func=None, num_similar=1, min_similarity=0.3, stemmed_database=True, segment=True):
+    # NOTE: 2/19/20, discovered typo, was message, not words (now segmented_words), 1% filter hit 46% match rate
+    filtered = Counter(normalizer.pairs(message, segment))
+    return expand_words(filtered, sim_func, num_similar, min_similarity, stemmed_database)
+
+
+# Words of a normalized message that expand_words looks up in the semantic resource
+def lookup_words(filtered, stemmed_database=True):
+    return [stem if stemmed_database else wd for (wd, stem) in filtered if wd.isalnum()]
+
+
+# Same as expand_message, for a message already normalized into a Counter of (word, stemmed word) pairs
+# prefetched is an optional dictionary of (lookup word : result of sim_func), see classify_batch
+# returns dictionary of (stemmed term : weight)
+def expand_words(filtered, sim_func=None, num_similar=1, min_similarity=0.3, stemmed_database=True, prefetched=None):
+    use_sim = sim_func is not None and num_similar > 0
+
+    # Functors with a many() method (see IndexedSimDB, BatchedWord2Vec) look up the whole message at once
+    if use_sim and prefetched is None and hasattr(sim_func, 'many'):
+        start = perf_counter()
+        prefetched = sim_func.many(lookup_words(filtered, stemmed_database), num_similar, min_similarity)
+        if metrics.enabled:
+            metrics.time('similarity', perf_counter() - start)
+
+    # For each term query once for num_similar and min_similarity
+    # If term not found in model data, and not found in subs, then ignore it (score of 0)
+    expansion = {}
+    for (wd, stem), count in filtered.items():
+        if not use_sim or not wd.isalnum():
+            expansion[stem] = expansion.get(stem, 0) + count * count
+            continue
+
+        sim_words = [stem]
+        if stemmed_database:
+            lkup = stem
+        else:
+            lkup = wd
+
+        if prefetched is not None:
+            res = prefetched[lkup]
+        elif metrics.enabled:
+            start = perf_counter()
+            res = sim_func(lkup, num_similar, min_similarity)
+            metrics.time('similarity', perf_counter() - start)
+        else:
+            res = sim_func(lkup, num_similar, min_similarity)
+        if metrics.enabled:
+            metrics.count('lookups')
+            metrics.count('substitutes', len(res))
+        if res:
+            # convoluted code to avoid duplicates
+            sim_words.extend(w for w in map(normalizer.stem, res) if w not in sim_words)
+
+        for sub in sim_words:
+            expansion[sub] = expansion.get(sub, 0) + count * count
+
+    # TODO: maybe put a "merge" phase here, if one of the subs for a term is also a term, then combine their counts
+    # NOTE: "merge" code was never hit in DB implementation, so either loops+test are wrong, or just very unlucky
+
+    return expansion
+
+
+# Dense category-by-term matrix of tf-idf weights, built once from the term/doc frequencies of a TFidF
+# A batch of expanded messages becomes a sparse (message x term) matrix, one product then scores every category
+# weights are stored term major (num_terms x num_categories), so the product only reads rows of terms in the batch
+# term_ids only needs a get(word) method, returning the row of word or None
+# Batches of up to dense_batch messages skip the sparse matrix, the weight rows of each message are added to its scores
+# one at a time through a single preallocated row (building a scipy matrix costs more than the product itself for a
+# message or two, and gathering the rows first allocates all of them at once)
+class ScoreMatrix(object):
+    dense_batch = 8
+
+    def __init__(self, categories, term_ids, weights):
+        self.categories = categories
+        self.term_ids = term_ids
+        self.weights = weights
+
+    # Rows and weights of the terms of one expansion (term : weight) as returned by expand_message
+    # terms outside the model vocabulary can never score, so they are dropped here
+    def lookup(self, expansion):
+        term_ids = []
+        counts = []
+        for word, weight in expansion.items():
+            term_id = self.term_ids.get(word)
+            if term_id is not None:
+                term_ids.append(term_id)
+                counts.append(weight)
+        return term_ids, counts
+
+    # expansions is a list of dictionaries (term : weight) as returned by expand_message
+    def count_matrix(self, expansions):
+        indptr = [0]
+        indices = []
+        data = []
+        for expansion in expansions:
+            term_ids, counts = self.lookup(expansion)
+            indices.extend(term_ids)
+            data.extend(counts)
+            indptr.append(len(indices))
+
+        from scipy import sparse  # imported here, single messages (the dense path) never need scipy
+        return sparse.csr_matrix((data, indices, indptr), shape=(len(expansions), self.weights.shape[0]), dtype=float)
+
+    # returns (message x category) array of scores
+    def scores(self, expansions):
+        if len(expansions) > self.dense_batch:
+            return np.asarray(self.count_matrix(expansions) @ self.weights)
+
+        scores = np.zeros((len(expansions), self.weights.shape[1]))
+        row = np.empty(self.weights.shape[1])
+        for i, expansion in enumerate(expansions):
+            term_ids, counts = self.lookup(expansion)
+            # rows are added one after the other, the same order of additions as the sparse product (and the
+            # original per category loop), so exact ties still go to the first category
+            for term_id, count in zip(term_ids, counts):
+                np.multiply(self.weights[term_id], count, out=row)
+                scores[i] += row
+        return scores
+
+
+def build_score_matrix(tf_idf):
+    categories = list(tf_idf.get_categories())
+    term_ids = {}
+
+    term_frequencies = tf_idf.get_term_frequencies()
+    for cat in categories:
+        for word in term_frequencies[cat]['counts']:
+            if word not in term_ids:
+                term_ids[word] = len(term_ids)
+
+    weights = np.zeros((len(term_ids), len(categories)))
+    for c, cat in enumerate(categories):
+        for word in term_frequencies[cat]['counts']:
+            weights[term_ids[word], c] = tf_idf(word, cat)
+
+    return ScoreMatrix(categories, term_ids, weights)
+
+
+# Relative margin of PostingIndex's early stop, well above the rounding of a sum of a few thousand postings
+EARLY_STOP_MARGIN = 1e-9
+
+
+# Inverted index of a TFidF, term -> [(category index, tf-idf weight)] sorted by weight (largest first)
+# Only categories containing a term are listed, so scoring a message only touches categories sharing its terms
+class PostingIndex(object):
+    def __init__(self, tf_idf):
+        self.categories = list(tf_idf.get_categories())
+        self.postings = {}
+
+        term_frequencies = tf_idf.get_term_frequencies()
+        for c, cat in enumerate(self.categories):
+            for word in term_frequencies[cat]['counts']:
+                weight = tf_idf(word, cat)
+                if weight != 0:
+                    self.postings.setdefault(word, []).append((c, weight))
+
+        for posting in self.postings.values():
+            posting.sort(key=lambda x: -x[1])
+
+    # Best (category, score) of an expansion (see expand_message), (None, 0) if nothing matched
+    # With early_stop, terms are walked by their largest possible contribution and the walk stops once the leading
+    # category is further ahead of the second than all remaining terms could add, the leader's score is then completed
+    # from the remaining postings alone
+    # remaining is a float kept by subtraction and can end up below what is really left, so the lead must also clear
+    # a relative margin: a gap that is a near tie walks to the end, the walk never stops on a leader it wouldn't keep
+    # Note: scores are still float sums made in another order than the matrix's (and, as terms are sorted for the
+    # early stop, than early_stop=False's), so on a near tie (scores equal to within rounding) they can pick different
+    # categories, with the same score to within rounding
+    def score(self, expansion, early_stop=True):
+        terms = [(self.postings[word], count) for word, count in expansion.items() if word in self.postings]
+        if early_stop:
+            terms.sort(key=lambda x: -x[0][0][1] * x[1])
+            remaining = sum(posting[0][1] * count for posting, count in terms)
+
+        # Scores only grow, so the leader (first in category order on ties) and the second best score can be kept
+        # up to date as each posting is added
+        scores = {}
+        best = None
+        second = 0
+        for i, (posting, count) in enumerate(terms):
+            for c, weight in posting:
+                score = scores.get(c, 0) + count * weight
+                scores[c] = score
+                if c == best:
+                    continue
+                if best is None or score > scores[best] or (score == scores[best] and c < best):
+                    if best is not None:
+                        second = scores[best]
+                    best = c
+                elif score > second:
+                    second = score
+
+            if early_stop:
+                remaining -= posting[0][1] * count
+                if scores[best] - second > remaining + EARLY_STOP_MARGIN * (scores[best] + remaining):
+                    for rest, rest_count in terms[i + 1:]:
+                        for c, weight in rest:
+                            if c == best:
+                                scores[best] += rest_count * weight
+                                break
+                    break
+
+        if best is None or scores[best] == 0:
+            return None, 0
+        return self.categories[best], scores[best]
+
+
+# Expansions (see expand_message) of every message, the similarity lookups of the whole batch made at once when
+# sim_func has a many() method
+def expand_batch(messages, sim_func=None, num_similar=1, min_similarity=0.3, stemmed_database=True, segment=True):
+    # Stage times of the normalizer (tokenize, segment, filter, stem) are passed on to metrics, see metrics.py
+    instrument = metrics.enabled
+    if instrument:
+        normalizer_times = dict(normalizer.times)
+
+    # NOTE: 2/19/20, discovered typo, was message, not words (now segmented_words), 1% filter hit 46% match rate
+    filtered = [Counter(normalizer.pairs(message, segment)) for message in messages]
+
+    if instrument:
+        for stage in ['tokenize', 'segment', 'filter', 'stem']:
+            metrics.time(stage, normalizer.times[stage] - normalizer_times.get(stage, 0))
+        metrics.count('messages', len(messages))
+        metrics.count('tokens', sum(sum(words_of_message.values()) for words_of_message in filtered))
+
+    # Functors with a many() method look up the distinct words of the whole batch at once
+    prefetched = None
+    if sim_func is not None and num_similar > 0 and hasattr(sim_func, 'many'):
+        start = perf_counter()
+        words = {}
+        for words_of_message in filtered:
+            words.update(dict.fromkeys(lookup_words(words_of_message, stemmed_database)))
+        prefetched = sim_func.many(list(words), num_similar, min_similarity)
+        if instrument:
+            metrics.time('similarity', perf_counter() - start)
+
+    start = perf_counter()
+    expansions = [expand_words(words_of_message, sim_func, num_similar, min_similarity, stemmed_database, prefetched)
+                  for words_of_message in filtered]
+    if instrument:
+        metrics.time('expand', perf_counter() - start)
+
+    return expansions
+
 
 # TFidF must be a functor that takes two strings, word and category
-# Also must have a get_categories() method
-# returns pair (category name : string, score : float)
+# Also must have get_categories() and get_score_matrix() (or get_posting_index()) methods
+# returns list of pairs (category name : string, score : float), one for each message
+#
+# scoring is 'matrix' (one sparse matrix product for the whole batch) or 'postings' (walks the inverted index of the
+# model, message by message, stopping early when the best category is decided), both return the same categories
+# except on near ties, where the scores add up in another order and can round to a different best category (with the
+# same score to within rounding, see PostingIndex.score)
 #
 # Possible concern, examples are stemmed so should I stem the input here?
 # Answer: Data in SEWordSim DB is stemmed, so yes
 # Now what about word2vec?
-def classify(tf_idf, message, sim_func=None, num_similar=1, min_similarity=0.3, stemmed_database=True, segment=True):
+def classify_batch(tf_idf, messages, sim_func=None, num_similar=1, min_similarity=0.3, stemmed_database=True,
+                   segment=True, scoring='matrix'):
     assert(num_similar >= 0)
     assert(0.0 <= min_similarity <= 100.0)
 
-    # NOTE: 2/27/20, added fixes like in make_model
-    words = word_tokenize(message.lower().strip())
+    expansions = expand_batch(messages, sim_func, num_similar, min_similarity, stemmed_database, segment)
 
-    segmented_words = []
-    if segment:
-        for wd in words:  # example 'artstation' --> ['art', 'station']
-            segmented_words.append(wd)
-            segments = wordsegment.segment(wd)
-            if len(segments) > 1:
-                segmented_words.extend(segments)
+    start = perf_counter()
+    if scoring == 'postings':
+        posting_index = tf_idf.get_posting_index()
+        results = [posting_index.score(expansion) for expansion in expansions]
     else:
-        segmented_words = copy.deepcopy(words)
-    del words
+        results = score_expansions(tf_idf, expansions)
+    if metrics.enabled:
+        metrics.time('score', perf_counter() - start)
 
-    # NOTE: 2/19/20, discovered typo, was message, not words (now segmented_words), 1% filter hit 46% match rate
-    filtered = [wd for wd in segmented_words
-                if wd not in stop_words and 0 < sum(map((lambda x: 1 if x[1].isalnum() else 0), enumerate(wd)))]
+    return results
 
-    del segmented_words
 
-    # For each term query once for num_similar and min_similarity
-    # If term not found in model data, and not found in subs, then ignore it (score of 0)
-    subs = {}
-    for wd in filtered:
-        sim_words = [stemmer.stem(wd)]
-        if sim_func is not None and num_similar > 0 and wd.isalnum():
-            if stemmed_database:
-                lkup = sim_words[0]
+# Best (category, score) of every expansion (see expand_message), (None, 0) if nothing matched
+def score_expansions(tf_idf, expansions):
+    score_matrix = tf_idf.get_score_matrix()
+    scores = score_matrix.scores(expansions)
+
+    results = []
+    for row in scores:
+        # argmax keeps the first maximum in category order, same as max() over the old dictionary
+        best = int(np.argmax(row))
+        if row[best] <= 0:  # nothing matched, or only negative scores (signed hashed models)
+            results.append((None, 0))
+        else:
+            results.append((score_matrix.categories[best], float(row[best])))
+
+    return results
+
+
+# (message x category) array of scores of every message, columns in the order of get_score_matrix().categories
+# Same arguments as classify_batch, scored by the matrix (the postings walk doesn't complete every category)
+def score_batch(tf_idf, messages, sim_func=None, num_similar=1, min_similarity=0.3, stemmed_database=True,
+                segment=True):
+    assert(num_similar >= 0)
+    assert(0.0 <= min_similarity <= 100.0)
+
+    expansions = expand_batch(messages, sim_func, num_similar, min_similarity, stemmed_database, segment)
+
+    start = perf_counter()
+    scores = tf_idf.get_score_matrix().scores(expansions)
+    if metrics.enabled:
+        metrics.time('score', perf_counter() - start)
+
+    return scores
+
+
+# Categories of one row of scores that scored above 0, best first (ties in category order, as classify), at most top_k
+# returns list of triples (category name : string, score : float, share of the total score of the row : float)
+# Shares are of the total of the positive scores, so they stay between 0 and 1 when some categories score below 0
+# (signed hashed models, see hashed_model.py)
+def rank_scores(categories, row, top_k=None):
+    total = row[row > 0].sum()
+    order = np.lexsort((np.arange(len(row)), -row))
+    if top_k is not None:
+        order = order[:top_k]
+    return [(categories[c], float(row[c]), float(row[c] / total)) for c in order if row[c] > 0]
+
+
+# Ranked version of classify_batch, scores every category in the same pass
+# returns one list of (category name, score, share of the total score) per message, see rank_scores
+def rank_batch(tf_idf, messages, sim_func=None, num_similar=1, min_similarity=0.3, stemmed_database=True,
+               segment=True, top_k=None):
+    categories = tf_idf.get_score_matrix().categories
+    scores = score_batch(tf_idf, messages, sim_func, num_similar, min_similarity, stemmed_database, segment)
+    return [rank_scores(categories, row, top_k) for row in scores]
+
+
+# Single message version of rank_batch, the first entry (if any) is what classify returns
+def classify_ranked(tf_idf, message, sim_func=None, num_similar=1, min_similarity=0.3, stemmed_database=True,
+                    segment=True, top_k=None):
+    return rank_batch(tf_idf, [message], sim_func, num_similar, min_similarity, stemmed_database, segment, top_k)[0]
+
+
+# Single message version of classify_batch, returns pair (category name : string, score : float)
+def classify(tf_idf, message, sim_func=None, num_similar=1, min_similarity=0.3, stemmed_database=True, segment=True,
+             scoring='matrix'):
+    return classify_batch(tf_idf, [message], sim_func, num_similar, min_similarity, stemmed_database, segment,
+                          scoring)[0]
+
+
+# Model files are either a binary or hashed model (see binary_model.py, hashed_model.py) or term_frequencies.json and
+# doc_frequencies.json
+def load_tf_idf(file_names):
+    if len(file_names) == 1:
+        from hashed_model import MAGIC as HASHED_MAGIC, read_hashed_model
+        with open(file_names[0], 'rb') as fi:
+            if fi.read(len(HASHED_MAGIC)) == HASHED_MAGIC:
+                return read_hashed_model(file_names[0])
+
+        from binary_model import MappedTFidF
+        return MappedTFidF(file_names[0])
+
+    with open(file_names[0], 'r') as fi:
+        term_frequencies = json.load(fi)
+
+    with open(file_names[1], 'r') as fi:
+        doc_frequencies = json.load(fi)
+
+    return TFidF(term_frequencies, doc_frequencies)
+
+
+# Records of a message file, read one line at a time, as (record, message) pairs
+# jsonl: one json object per line, message in field
+# csv: header row, then one row per record, message in column field
+# text: one message per line
+# Records that can't be read (bad json, not an object, no message string in field) are skipped, each is passed to
+# skipped(line number, reason) when given, and printed to stderr otherwise
+def read_records(fi, input_format='jsonl', field='message', skipped=None):
+    if skipped is None:
+        skipped = (lambda line_number, reason: print("Skipped line", line_number, reason, file=sys.stderr))
+
+    if input_format == 'csv':
+        reader = csv.DictReader(fi)
+        for row in reader:
+            if isinstance(row.get(field), str):
+                yield row, row[field]
+            else:
+                skipped(reader.line_num, "(no column '" + field + "')")
+    elif input_format == 'jsonl':
+        for line_number, line in enumerate(fi, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                skipped(line_number, "(" + str(e) + ")")
+                continue
+            if isinstance(record, dict) and isinstance(record.get(field), str):
+                yield record, record[field]
             else:
-                lkup = wd
+                skipped(line_number, "(not an object with a string '" + field + "')")
+    else:
+        for line in fi:
+            line = line.rstrip('\n')
+            yield line, line
 
-            res = sim_func(lkup, num_similar, min_similarity)
-            if res:
-                # convoluted code to avoid duplicates
-                sim_words.extend(w for w in map(stemmer.stem, res) if w not in sim_words)
 
-        if wd in subs:
-            subs[wd]["count"] += 1
+# Writes each record back out in its input format, with the category and score it was given
+class RecordWriter(object):
+    def __init__(self, fi, output_format='jsonl'):
+        self.fi = fi
+        self.output_format = output_format
+        self.csv_writer = None
+
+    def write(self, record, category, score):
+        if self.output_format == 'csv':
+            if self.csv_writer is None:
+                self.csv_writer = csv.DictWriter(self.fi, list(record.keys()) + ['category', 'score'])
+                self.csv_writer.writeheader()
+            self.csv_writer.writerow(dict(record, category=category, score=score))
+        elif self.output_format == 'jsonl':
+            if not isinstance(record, dict):  # records not read by read_records
+                record = {'message': record}
+            self.fi.write(json.dumps(dict(record, category=category, score=score)) + '\n')
         else:
-            subs[wd] = {"words": sim_words, "count": 1}
+            self.fi.write(str(category) + '\t' + str(score) + '\n')
+
+
+# Model, semantic resource and options of the streaming process (or of each pool worker), set by init_stream
+_stream = {}
+
+
+# resource is a key of classify_test.valid_models
+def init_stream(model_files, resource='Raw', num_similar=1, min_similarity=0.3, segment=True):
+    from classify_test import valid_models
+
+    loading_func, stemmed_database = valid_models[resource]
+    _stream['tf_idf'] = load_tf_idf(model_files)
+    _stream['options'] = {'sim_func': loading_func(),
+                          'num_similar': num_similar,
+                          'min_similarity': min_similarity,
+                          'stemmed_database': stemmed_database,
+                          'segment': segment}
+
+
+def _classify_messages(messages):
+    return classify_batch(_stream['tf_idf'], [message.lower() for message in messages], **_stream['options'])
+
+
+def _batches(records, batch_size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
-    # TODO: maybe put a "merge" phase here, if one of the subs for a term is also a term, then combine their counts
-    # NOTE: "merge" code was never hit in DB implementation, so either loops+test are wrong, or just very unlucky
-    # merged = deepcopy(subs)
-    # for sub in subs:
-    #    for wd in subs[sub]["words"]:
-    #        if wd in subs:
-    #            merged[sub] = {"words": set(subs[sub]["words"] + subs[wd]["words"]).remove(wd),
-    #                          "count": subs[sub]["count"] + subs[wd]["words"]}
-    #            del merged[wd]
-
-    # dictionary of words and number of times they occur in the message
-    similar_scores = {}
-
-    for cur_cat in tf_idf.get_categories():
-        score = 0
-        for wd in filtered:
-            # term_freq = tf_idf.get_term_frequencies()[cur_cat]['counts'][wd]
-            # if term_freq != 0:
-            #    score += subs[wd]["count"] * tf_idf(wd, cur_cat)
-            # if sim_func is not None and num_similar > 0:
-            score += sum(map((lambda sub: subs[wd]["count"] * tf_idf(sub, cur_cat)),
-                             subs[wd]["words"]))
-
-        similar_scores[cur_cat] = score
-
-    del filtered
-    best_cat = max(similar_scores, key=lambda k: similar_scores[k])
-
-    if similar_scores[best_cat] == 0:
-        return None, 0
-    else:
-        return best_cat, similar_scores[best_cat]
+
+# Generator of (record, (category, score)), in the order of records (pairs of (record, message), see read_records)
+# Batches go to pool when given (initialized by init_stream), with at most max_pending batches in flight, so memory
+# stays bounded however many records there are
+def classify_stream(records, batch_size=256, pool=None, max_pending=2):
+    pending = deque()
+    for batch in _batches(records, batch_size):
+        messages = [message for record, message in batch]
+        if pool is None:
+            yield from zip([record for record, message in batch], _classify_messages(messages))
+            continue
+
+        pending.append(([record for record, message in batch], pool.apply_async(_classify_messages, (messages,))))
+        while len(pending) >= max_pending:
+            batch_records, result = pending.popleft()
+            yield from zip(batch_records, result.get())
+
+    while pending:
+        batch_records, result = pending.popleft()
+        yield from zip(batch_records, result.get())
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4:
-        print("Usage: ./classify term_frequencies.json doc_frequencies.json message.txt")
-        exit(1)
+    if len(sys.argv) > 1 and sys.argv[1] == '--stream':
+        parser = argparse.ArgumentParser(usage="./classify --stream [model.bin | term_frequencies.json "
+                                               "doc_frequencies.json] [messages.jsonl | messages.csv | -] "
+                                               "[--format jsonl | csv | text] [--workers N] [--output results]")
+        parser.add_argument("files", nargs='+', help="model file(s), then the message file (- for stdin)")
+        parser.add_argument("--format", choices=['jsonl', 'csv', 'text'], default='jsonl')
+        parser.add_argument("--field", default='message', help="json field or csv column of the message")
+        parser.add_argument("--output", help="default is stdout")
+        parser.add_argument("--workers", type=int, default=1)
+        parser.add_argument("--batch-size", type=int, default=256)
+        parser.add_argument("--resource", default='Raw', help="semantic resource, see classify_test")
+        parser.add_argument("--num-similar", type=int, default=1)
+        parser.add_argument("--min-similarity", type=float, default=0.3)
+        parser.add_argument("--no-segment", action='store_true')
+        parser.add_argument("--report-every", type=float, default=10, help="seconds between rows/sec reports")
+        args = parser.parse_args(sys.argv[2:])
+        if len(args.files) not in [2, 3]:
+            parser.error("expected model.bin or term_frequencies.json doc_frequencies.json, then the message file")
 
-    wordsegment.load()
+        stream_options = (args.files[:-1], args.resource, args.num_similar, args.min_similarity, not args.no_segment)
+        in_file = sys.stdin if args.files[-1] == '-' else open(args.files[-1], 'r', newline='')
+        out_file = sys.stdout if args.output is None else open(args.output, 'w', newline='')
 
-    with open(sys.argv[1], 'r') as fi:
-        term_frequencies = json.load(fi)
+        stream_pool = None
+        if args.workers > 1:
+            stream_pool = Pool(args.workers, initializer=init_stream, initargs=stream_options)
+        else:
+            init_stream(*stream_options)
 
-    with open(sys.argv[2], 'r') as fi:
-        doc_frequencies = json.load(fi)
+        writer = RecordWriter(out_file, args.format)
+        num_rows = 0
+        num_skipped = 0
+
+        def skip(line_number, reason):
+            global num_skipped
+            num_skipped += 1
+            print("Skipped line", line_number, reason, file=sys.stderr)
+
+        start_time = last_report = time()
+        for my_record, (cat, score) in classify_stream(read_records(in_file, args.format, args.field, skip),
+                                                       args.batch_size, stream_pool, 2 * args.workers):
+            writer.write(my_record, cat, score)
+            num_rows += 1
+            if time() - last_report >= args.report_every:
+                last_report = time()
+                print(num_rows, "rows,", num_rows / (last_report - start_time), "rows/sec", file=sys.stderr)
+
+        if stream_pool is not None:
+            stream_pool.close()
+        out_file.flush()
+        print(num_rows, "rows,", num_rows / max(time() - start_time, 1e-9), "rows/sec,", num_skipped, "skipped",
+              file=sys.stderr)
+        exit(0)
+
+    if len(sys.argv) not in [3, 4]:
+        print("Usage: ./classify term_frequencies.json doc_frequencies.json message.txt")
+        print("       ./classify model.bin message.txt")
+        print("       ./classify --stream [model.bin | term_frequencies.json doc_frequencies.json] messages.jsonl")
+        exit(1)
+
+    my_idF = load_tf_idf(sys.argv[1:-1])
 
-    with open(sys.argv[3], 'r') as fi:
+    with open(sys.argv[-1], 'r') as fi:
         new_message = fi.read()
 
-    my_idF = TFidF(term_frequencies, doc_frequencies)
     cat = classify(my_idF, new_message.lower())
     print('Category: "', cat[0], '" Score: ', cat[1], sep='')
@@ -0,0 +1,71 @@
+# asyncio version of classify, for one event loop serving many concurrent requests
+#
+# Async similarity providers have a coroutine lookup(wd, num_similar, min_similarity, max_similarity=1.0), returning
+# the same list as calling a similarity functor (see classify.SimDB), any functor can be adapted with AsyncSim
+# The lookups of a message run concurrently, normalization and scoring run in an executor so the loop is never blocked
+# Results are the same as classify() with the same arguments
+
+import asyncio
+from collections import Counter
+
+from classify import expand_words, lookup_words, score_expansions
+from normalize import normalizer
+
+
+# Adapts a similarity functor to the async protocol, each call runs in executor (default: the loop's thread pool)
+# Concurrent lookups of the same word and options share one call instead of each running their own
+# Note: functor must be safe to call from the executor's threads, SimDB (one connection) is not, give it a
+# ThreadPoolExecutor(1); IndexedSimDB opens one connection per thread, and SimCache keeps its entries under a lock
+# (it is as safe as the functor it wraps)
+class AsyncSim(object):
+    def __init__(self, sim_func, executor=None):
+        self.sim_func = sim_func
+        self.executor = executor
+        self.in_flight = {}
+        self.calls = 0
+        self.shared = 0
+
+    async def lookup(self, wd, num_similar, min_similarity, max_similarity=1.0):
+        key = (wd, num_similar, min_similarity, max_similarity)
+        future = self.in_flight.get(key)
+        if future is None:
+            self.calls += 1
+            future = asyncio.get_running_loop().run_in_executor(self.executor, self.sim_func, wd, num_similar,
+                                                                 min_similarity, max_similarity)
+            self.in_flight[key] = future
+            future.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        else:
+            self.shared += 1
+
+        # shielded, so a cancelled request doesn't cancel the lookup for the others waiting on it
+        return list(await asyncio.shield(future))
+
+    def get_stats(self):
+        return {'calls': self.calls, 'shared': self.shared, 'in_flight': len(self.in_flight)}
+
+
+# Same arguments as classify, sim_func is either an async provider or a functor (wrapped in an AsyncSim on each call,
+# pass an AsyncSim to share in flight lookups between requests)
+async def classify_async(tf_idf, message, sim_func=None, num_similar=1, min_similarity=0.3, stemmed_database=True,
+                         segment=True, scoring='matrix', executor=None):
+    assert(num_similar >= 0)
+    assert(0.0 <= min_similarity <= 100.0)
+    loop = asyncio.get_running_loop()
+
+    filtered = await loop.run_in_executor(executor, lambda: Counter(normalizer.pairs(message, segment)))
+
+    prefetched = None
+    if sim_func is not None and num_similar > 0:
+        if not hasattr(sim_func, 'lookup'):
+            sim_func = AsyncSim(sim_func, executor)
+        words = list(dict.fromkeys(lookup_words(filtered, stemmed_database)))
+        results = await asyncio.gather(*[sim_func.lookup(wd, num_similar, min_similarity) for wd in words])
+        prefetched = dict(zip(words, results))
+
+    def score():
+        expansion = expand_words(filtered, sim_func, num_similar, min_similarity, stemmed_database, prefetched)
+        if scoring == 'postings':
+            return tf_idf.get_posting_index().score(expansion)
+        return score_expansions(tf_idf, [expansion])[0]
+
+    return await loop.run_in_executor(executor, score)
@@ -4,29 +4,45 @@
 import csv
 import json
 import gc
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
-from queue import Queue
+from queue import Queue, Empty
 from os import path
+from time import perf_counter
 from tkinter import *
 from tkinter import messagebox
-
-# 3rd party
-import wordsegment
+from tkinter import ttk
 
 # Our code
 from make_model import generate_frequencies
-from classify import classify
+from classify import classify_ranked, close_sim_func, SimCache
 from classify_test import valid_models, TFidF
+from binary_model import MappedTFidF
 
 DEFAULT_FILE = "labeledData.csv"
 
+POLL_MS = 20  # how often the Tk thread reads the queue of worker events
+DEBOUNCE_MS = 300  # text is classified once typing pauses this long
+NUM_WORKERS = 2
+NUM_RANKED = 3  # categories shown
+
 
 # Template for long running async task from: http://zetcode.com/articles/tkinterlongruntask/
 # Though that used Process which proved useless with our code as SQLite3 and pickle don't agree at all
 # Switched to oldschool python thread version, we want to share address space anyway
+#
+# Tk is only ever touched from its own thread, every other thread puts events on queue, which poll() handles:
+# ('progress', message, fraction), ('model', tf_idf), ('resource', sim_func), ('failed', message) from the loading
+# thread (model and semantic resource), ('classified', generation, key, ranked, seconds) and
+# ('classify_failed', generation, message) from the worker pool
+# Every change of the text or the configuration bumps generation, a classification still waiting in the pool is
+# cancelled and the results of older generations are dropped, so only the latest input is ever shown
+# Swapping the model or the resource bumps it right away (see drop_results), not once the debounce is over
+# The semantic resource is wrapped in a SimCache for the session (until another resource is loaded), so retyping a
+# message only looks up its new words, the old resource is closed when it's swapped out
 class Gui(Frame):
 
-    def __init__(self, parent, queue):
+    def __init__(self, parent, queue, workers=NUM_WORKERS):
         Frame.__init__(self, parent)
 
         self.parent = parent
@@ -35,9 +51,17 @@ class Gui(Frame):
         self.stemmed_database = True
         self.my_idf = None
 
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='classify')
+        self.generation = 0
+        self.pending = None
+        self.shown_key = None
+        self.debounce_id = None
+
         # Limited use members, declaration here to suppress warnings
         self.thread = None
         self.wait_message = None
+        self.wait_label = None
+        self.progress_bar = None
 
         self.frame_a = Frame()
 
@@ -63,6 +87,7 @@ class Gui(Frame):
 
         self.textbox = Text(master=self.frame_b)
         self.textbox.pack()
+        self.textbox.bind('<<Modified>>', self.text_modified)
 
         self.frame_b.pack(side=LEFT, anchor=N)
 
@@ -71,7 +96,7 @@ class Gui(Frame):
         self.lst_label = Label(master=self.frame_c, text="Configuration")
         self.lst_label.pack(side=TOP, anchor=W)
 
-        self.model_list = Listbox(master=self.frame_c, selectmode=SINGLE)
+        self.model_list = Listbox(master=self.frame_c, selectmode=SINGLE, exportselection=False)
         self.model_list.pack()
 
         for model in valid_models.keys():
@@ -82,23 +107,26 @@ class Gui(Frame):
         self.model_list.bind('<<ListboxSelect>>', self.load_resource_callback)
 
         self.seg_var = BooleanVar()
-        self.seg_button = Checkbutton(master=self.frame_c, text="Segment Words", variable=self.seg_var)
+        self.seg_button = Checkbutton(master=self.frame_c, text="Segment Words", variable=self.seg_var,
+                                      command=self.input_changed)
         self.seg_button.pack()
 
         self.num_sim_label = Label(master=self.frame_c, text="Num Similar")
         self.num_sim_label.pack()
 
-        self.num_sim_box = Spinbox(master=self.frame_c, from_=0, to_=10)
+        self.num_sim_box = Spinbox(master=self.frame_c, from_=0, to_=10, command=self.input_changed)
         self.num_sim_box.delete(0, "end")
         self.num_sim_box.insert(0, 3)
+        self.num_sim_box.bind('<KeyRelease>', self.input_changed)
         self.num_sim_box.pack()
 
         self.min_sim_label = Label(master=self.frame_c, text="Min Similarity %")
         self.min_sim_label.pack()
 
-        self.min_sim_box = Spinbox(master=self.frame_c, from_=0, to_=100)
+        self.min_sim_box = Spinbox(master=self.frame_c, from_=0, to_=100, command=self.input_changed)
         self.min_sim_box.delete(0, "end")
         self.min_sim_box.insert(0, 20)
+        self.min_sim_box.bind('<KeyRelease>', self.input_changed)
         self.min_sim_box.pack()
 
         self.run_button = Button(master=self.frame_c, text="Classify", command=self.classify_callback)
@@ -108,70 +136,111 @@ class Gui(Frame):
         self.class_label = Label(master=self.frame_c, text="No Class Chosen", fg='red')
         self.class_label.pack()
 
+        # Runner up categories and their share of the total score
+        self.ranked_label = Label(master=self.frame_c, text="", justify=LEFT)
+        self.ranked_label.pack()
+
+        self.status_label = Label(master=self.frame_c, text="")
+        self.status_label.pack()
+
         self.frame_c.pack(side=RIGHT, anchor=N)
 
+        self.parent.protocol("WM_DELETE_WINDOW", self.close)
+        self.after(POLL_MS, self.poll)
+
     def load_resource_callback(self, _event):
+        # Listbox also sends this when its selection is cleared
+        if not self.model_list.curselection():
+            return
 
         self.class_label.configure(text="No Class Chosen")
 
-        # If old resource exists, delete it
+        # If old resource exists, close and delete it
         if self.resource_function is not None:
+            self.drop_results()
+            close_sim_func(self.resource_function)
             self.resource_function = None
             gc.collect()
 
         # Grab the name from the text stored in the model_list, via curselection (index)
         name = self.model_list.get(self.model_list.curselection()[0])
-        if name == ():
-            print("Odd selection event happened again")
-            name = 'Raw'
-            # TODO: Make model_list select 'Raw'
 
         # Grab stemmed_database value, which is 1st item in valid_models dictionary
         self.stemmed_database = valid_models[name][1]
 
         # Raw requires no work
         if name == 'Raw':
-            self.model_list.configure(state='normal')
+            self.input_changed()
         else:
-            # Create new toplevel window for loading message, make it take control and be unclosable until done
-            self.wait_message = Toplevel(master=self.parent)
-            self.wait_message.protocol("WM_DELETE_WINDOW", (lambda: None))
-            self.wait_message.grab_set()
+            self.run_in_background(lambda progress: ('resource', valid_models[name][0](progress=progress)))
+
+    # Loading dialog, takes control and is unclosable until target is done
+    # target(progress) runs on its own thread and returns the event for poll(), progress(message, fraction) updates
+    # the dialog (fraction None while the share done is unknown)
+    def run_in_background(self, target):
+        self.model_list.configure(state='disable')
+
+        self.wait_message = Toplevel(master=self.parent)
+        self.wait_message.protocol("WM_DELETE_WINDOW", (lambda: None))
+        self.wait_message.grab_set()
+
+        width = self.parent.winfo_width() / 2
+        height = self.parent.winfo_height() / 2
+        self.wait_message.geometry("+%d+%d" % (width, height))
+
+        self.wait_label = Label(master=self.wait_message, text="Loading", width=60)
+        self.wait_label.pack()
 
-            width = self.parent.winfo_width() / 2
-            height = self.parent.winfo_height() / 2
-            self.wait_message.geometry("+%d+%d" % (width, height))
+        self.progress_bar = ttk.Progressbar(master=self.wait_message, length=300, maximum=100)
+        self.progress_bar.pack(padx=10, pady=10)
 
-            wait_label = Label(master=self.wait_message, text="Loading")
-            wait_label.pack()
+        def run(que):
+            try:
+                que.put(target(lambda message, fraction=None: que.put(('progress', message, fraction))))
+            except Exception as e:
+                que.put(('failed', str(e) or type(e).__name__))
 
-            self.thread = Thread(target=(lambda que: que.put(valid_models[name][0]())), args=(self.queue,))
-            self.thread.start()
-            self.after(20, self.loading_loop)
+        self.thread = Thread(target=run, args=(self.queue,), daemon=True)
+        self.thread.start()
 
-    def loading_loop(self):
-        if self.thread.is_alive():
-            self.after(20, self.loading_loop)
+    def end_background(self):
+        self.model_list.configure(state='normal')
+        self.wait_message.grab_release()
+        self.wait_message.destroy()
+        self.wait_message = None
+
+    def show_progress(self, message, fraction):
+        if self.wait_message is None:
+            return
+        self.wait_label.configure(text=message)
+        if fraction is None:
+            if str(self.progress_bar['mode']) != 'indeterminate':
+                self.progress_bar.configure(mode='indeterminate')
+                self.progress_bar.start(POLL_MS)
         else:
-            self.model_list.configure(state='normal')
-            self.resource_function = q.get()
-            self.wait_message.grab_release()
-            self.wait_message.destroy()
+            self.progress_bar.stop()
+            self.progress_bar.configure(mode='determinate', value=100 * fraction)
 
     def load_model_callback(self):
-        if not path.exists("doc_frequencies.json") or not path.exists("term_frequencies.json"):
+        # Binary model (see binary_model.py) is preferred when present, it maps instead of parsing json
+        if path.exists("model.bin"):
+            self.run_in_background(lambda progress: ('model', MappedTFidF("model.bin")))
+        elif not path.exists("doc_frequencies.json") or not path.exists("term_frequencies.json"):
             self.run_button.configure(state='disable')
             messagebox.showerror("doc/term Frequency Files Missing")
         else:
-            self.run_button.configure(state='active')
+            self.run_in_background(self.load_model)
 
-            with open('term_frequencies.json', 'r') as fi:
-                term_frequencies = json.load(fi)
+    def load_model(self, progress):
+        progress("Loading term_frequencies.json", 0.0)
+        with open('term_frequencies.json', 'r') as fi:
+            term_frequencies = json.load(fi)
 
-            with open('doc_frequencies.json', 'r') as fi:
-                doc_frequencies = json.load(fi)
+        progress("Loading doc_frequencies.json", 0.5)
+        with open('doc_frequencies.json', 'r') as fi:
+            doc_frequencies = json.load(fi)
 
-            self.my_idf = TFidF(term_frequencies, doc_frequencies)
+        return 'model', TFidF(term_frequencies, doc_frequencies)
 
     def make_model_callback(self):
         valid = path.isfile(self.entry.get())
@@ -179,55 +248,144 @@ class Gui(Frame):
             self.run_button.configure(state='disable')
         else:
             if self.my_idf is not None:
+                self.drop_results()
                 self.my_idf = None
                 gc.collect()
 
-            self.wait_message = Toplevel(master=self.parent)
-            self.wait_message.protocol("WM_DELETE_WINDOW", (lambda: None))
-            self.wait_message.grab_set()
-
-            width = self.parent.winfo_width() / 2
-            height = self.parent.winfo_height() / 2
-            self.wait_message.geometry("+%d+%d" % (width, height))
-
-            wait_label = Label(master=self.wait_message, text="Loading")
-            wait_label.pack()
-
-            self.thread = Thread(target=self.make_model, args=(q,))
-            self.thread.start()
-            self.after(20, self.model_loop)
+            self.run_in_background(self.make_model)
 
-    def make_model(self, que):
+    def make_model(self, progress):
+        progress("Reading " + self.entry.get(), None)
         with open(self.entry.get(), 'r') as fi:
-            labeled_data = csv.DictReader(fi, delimiter=',')
-
-            (term_frequencies, doc_frequencies) = generate_frequencies(labeled_data)
-            que.put(TFidF(term_frequencies, doc_frequencies))
-
-    def model_loop(self):
-        if self.thread.is_alive():
-            self.after(20, self.model_loop)
-        else:
-            self.run_button.configure(state='active')
-            self.my_idf = q.get()
-            self.wait_message.grab_release()
-            self.wait_message.destroy()
+            labeled_data = list(csv.DictReader(fi, delimiter=','))
+
+        (term_frequencies, doc_frequencies) = generate_frequencies(labeled_data, progress=progress)
+        return 'model', TFidF(term_frequencies, doc_frequencies)
+
+    # Handles every event put on queue by other threads, see the top of the class
+    def poll(self):
+        while True:
+            try:
+                event = self.queue.get_nowait()
+            except Empty:
+                break
+
+            if event[0] == 'progress':
+                self.show_progress(*event[1:])
+            elif event[0] == 'model':
+                self.end_background()
+                self.drop_results()
+                self.my_idf = event[1]
+                self.run_button.configure(state='active')
+                self.input_changed()
+            elif event[0] == 'resource':
+                self.end_background()
+                self.drop_results()
+                old_function = self.resource_function
+                self.resource_function = SimCache(event[1]) if event[1] is not None else None
+                close_sim_func(old_function)
+                self.input_changed()
+            elif event[0] == 'failed':
+                self.end_background()
+                messagebox.showerror("Loading failed", event[1])
+            elif event[0] == 'classified':
+                self.show_result(*event[1:])
+            elif event[0] == 'classify_failed' and event[1] == self.generation:
+                self.status_label.configure(text="Failed: " + event[2])
+
+        self.after(POLL_MS, self.poll)
+
+    # Results of the classifications submitted so far are never shown, the one still waiting is cancelled
+    # shown_key is cleared as well, the ids in it may be reused by the next model or resource
+    def drop_results(self):
+        self.generation += 1
+        self.shown_key = None
+        if self.pending is not None:
+            self.pending.cancel()
+            self.pending = None
+
+    # Text widget sends <<Modified>> once, until its modified flag is reset
+    def text_modified(self, _event):
+        if self.textbox.edit_modified():
+            self.textbox.edit_modified(False)
+            self.input_changed()
+
+    # Restarts the debounce timer, the text is classified once the input stops changing
+    def input_changed(self, _event=None):
+        if self.debounce_id is not None:
+            self.after_cancel(self.debounce_id)
+            self.debounce_id = None
+        if self.my_idf is not None:
+            self.debounce_id = self.after(DEBOUNCE_MS, self.classify_callback)
 
     def classify_callback(self):
-        category = classify(self.my_idf,
-                            self.textbox.get("1.0", "end-1c"),
-                            sim_func=self.resource_function,
-                            num_similar=int(self.num_sim_box.get()),
-                            min_similarity=0.01 * int(self.min_sim_box.get()),
-                            stemmed_database=self.stemmed_database,
-                            segment=bool(self.seg_var.get()))
-
-        self.class_label.configure(text=str(category[0]))
+        if self.debounce_id is not None:
+            self.after_cancel(self.debounce_id)
+            self.debounce_id = None
+        if self.my_idf is None:
+            return
+
+        try:
+            num_similar = int(self.num_sim_box.get())
+            min_similarity = 0.01 * int(self.min_sim_box.get())
+        except ValueError:
+            self.status_label.configure(text="Num Similar and Min Similarity % must be whole numbers")
+            return
+
+        text = self.textbox.get("1.0", "end-1c")
+        segment = bool(self.seg_var.get())
+        key = (text, num_similar, min_similarity, segment, id(self.my_idf), id(self.resource_function))
+        if key == self.shown_key:
+            return
+
+        self.generation += 1
+        if self.pending is not None:
+            self.pending.cancel()
+        self.status_label.configure(text="Classifying")
+        self.pending = self.pool.submit(self.classify, self.generation, key, self.my_idf, text,
+                                        self.resource_function, num_similar, min_similarity, self.stemmed_database,
+                                        segment)
+
+    # Runs in the worker pool
+    def classify(self, generation, key, tf_idf, text, sim_func, num_similar, min_similarity, stemmed_database,
+                 segment):
+        if generation != self.generation:  # newer input came in while this waited
+            return
+
+        start = perf_counter()
+        try:
+            ranked = classify_ranked(tf_idf, text,
+                                     sim_func=sim_func,
+                                     num_similar=num_similar,
+                                     min_similarity=min_similarity,
+                                     stemmed_database=stemmed_database,
+                                     segment=segment,
+                                     top_k=NUM_RANKED)
+        except Exception as e:
+            self.queue.put(('classify_failed', generation, str(e) or type(e).__name__))
+            return
+        self.queue.put(('classified', generation, key, ranked, perf_counter() - start))
+
+    def show_result(self, generation, key, ranked, seconds):
+        if generation != self.generation:
+            return
+
+        self.shown_key = key
+        self.class_label.configure(text=str(ranked[0][0]) if ranked else "None")
+        self.ranked_label.configure(text="\n".join(category + ": " + str(round(100 * share)) + "%"
+                                                   for category, score, share in ranked))
+        self.status_label.configure(text="Classified in " + str(round(1000 * seconds)) + " ms")
+
+    # cancel_futures of shutdown() needs python 3.9, the only classification that can still be waiting is pending
+    def close(self):
+        if self.pending is not None:
+            self.pending.cancel()
+        self.pool.shutdown(wait=False)
+        close_sim_func(self.resource_function)
+        self.parent.destroy()
 
 
 if __name__ == '__main__':
-    wordsegment.load()
-
     window = Tk()
     q = Queue()
     app = Gui(window, q)
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+# Resident classification service, loads the model and semantic resource once and answers over local HTTP
+#
+# POST /classify  {"message": "..."} or {"messages": ["...", ...]}
+#                 optional "num_similar", "min_similarity" (0 to 1) and "segment" (true or false) override the server
+#                 defaults, messages that aren't strings or parameters of the wrong type are answered 400
+#                 answers {"category": ..., "score": ...} (or a list of them, for "messages")
+#                 with --models, "model" picks the model of a channel (see model_registry.py)
+# POST /reload    {"model": "..."} loads the channel's model again and swaps it in, requests already queued finish
+#                 on the version they started with
+# GET  /stats     latency percentiles (p50/p99, ms), throughput and batch sizes (and loaded models, with --models)
+#
+# Requests are handled by one thread each, they queue their messages for a single batching thread which waits up to
+# max_wait for max_batch messages, then classifies them with one classify_batch call per set of parameters
+# A call that fails is made again one message at a time, so only the requests that fail get the error
+# The batching thread also loads the semantic resource, so SQLite (WordSimSEDB) is only ever used from one thread
+#
+# Usage: ./classify_server [Raw | WordSimSEDB | Word2VecSE | ...] [True | False] [--model model.bin] [--port 8000]
+#                         [--models DIR [--budget MB]]
+
+import argparse
+import json
+import math
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue, Empty
+from threading import Thread, Lock, Event
+from time import perf_counter, time
+
+from classify import classify_batch, close_sim_func, load_tf_idf
+from classify_test import valid_models
+from normalize import normalizer
+
+
+# Nearest rank percentile, p between 0 and 100
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+# Latencies of the last window requests, and totals since start
+class LatencyStats(object):
+    def __init__(self, window=10000):
+        self.lock = Lock()
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.num_messages = 0
+        self.num_batches = 0
+        self.start = time()
+
+    def add_batch(self, latencies):
+        with self.lock:
+            self.latencies.extend(latencies)
+            self.batch_sizes.append(len(latencies))
+            self.num_messages += len(latencies)
+            self.num_batches += 1
+
+    def get_stats(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            batch_sizes = list(self.batch_sizes)
+            num_messages = self.num_messages
+            num_batches = self.num_batches
+
+        uptime = time() - self.start
+        return {'messages': num_messages,
+                'batches': num_batches,
+                'uptime_sec': uptime,
+                'messages_per_sec': num_messages / uptime if uptime else 0.0,
+                'p50_ms': 1000 * percentile(latencies, 50),
+                'p99_ms': 1000 * percentile(latencies, 99),
+                'mean_batch_size': sum(batch_sizes) / len(batch_sizes) if batch_sizes else 0.0}
+
+
+# Collects messages from any number of threads into micro batches for classify_batch
+# load_resource is called from the batching thread (see valid_models in classify_test)
+class BatchClassifier(object):
+    def __init__(self, tf_idf, load_resource=(lambda: None), stemmed_database=True, num_similar=3,
+                 min_similarity=0.2, segment=True, max_batch=64, max_wait=0.005):
+        self.tf_idf = tf_idf
+        self.load_resource = load_resource
+        self.stemmed_database = stemmed_database
+        self.defaults = {'num_similar': num_similar, 'min_similarity': min_similarity, 'segment': segment}
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+        self.sim_func = None
+        self.error = None
+        self.requests = Queue()
+        self.stats = LatencyStats()
+        self.ready = Event()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # returns a Future of (category, score), tf_idf overrides the model of the classifier
+    # raises TypeError or ValueError for a message that isn't a string, or parameters of the wrong type
+    def submit(self, message, num_similar=None, min_similarity=None, segment=None, tf_idf=None):
+        if not isinstance(message, str):
+            raise TypeError('message must be a string')
+        if segment is not None and not isinstance(segment, bool):
+            raise TypeError('segment must be true or false')
+        params = (self.defaults['num_similar'] if num_similar is None else int(num_similar),
+                  self.defaults['min_similarity'] if min_similarity is None else float(min_similarity),
+                  self.defaults['segment'] if segment is None else segment,
+                  self.tf_idf if tf_idf is None else tf_idf)
+        future = Future()
+        self.requests.put((perf_counter(), message, params, future))
+        return future
+
+    def run(self):
+        try:
+            self.sim_func = self.load_resource()
+        except Exception as e:
+            self.error = e
+            return
+        finally:
+            self.ready.set()
+
+        while True:
+            batch = [self.requests.get()]
+            deadline = perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=timeout))
+                except Empty:
+                    break
+
+            self.classify(batch)
+
+    def classify(self, batch):
+        groups = {}
+        for request in batch:
+            groups.setdefault(request[2], []).append(request)
+
+        for params, requests in groups.items():
+            try:
+                results = self.classify_group(params, [request[1] for request in requests])
+            except Exception:
+                # one bad request fails the whole call, classify them one by one so only that one gets the error
+                results = []
+                for request in requests:
+                    try:
+                        results.append(self.classify_group(params, [request[1]])[0])
+                    except Exception as e:
+                        results.append(e)
+
+            end = perf_counter()
+            done = []
+            for request, result in zip(requests, results):
+                if isinstance(result, Exception):
+                    request[3].set_exception(result)
+                else:
+                    request[3].set_result(result)
+                    done.append(request)
+            if done:
+                self.stats.add_batch([end - request[0] for request in done])
+
+    # Releases the semantic resource (see close_sim_func), once no more requests are submitted
+    def close(self):
+        close_sim_func(self.sim_func)
+
+    def classify_group(self, params, messages):
+        num_similar, min_similarity, segment, tf_idf = params
+        return classify_batch(tf_idf, messages,
+                              sim_func=self.sim_func,
+                              num_similar=num_similar,
+                              min_similarity=min_similarity,
+                              stemmed_database=self.stemmed_database,
+                              segment=segment)
+
+
+# registry (a ModelRegistry) answers requests naming a "model"
+def make_handler(classifier, registry=None):
+    def get_model(name, reload=False):
+        if registry is None:
+            raise KeyError(name)
+        return registry.reload(name) if reload else registry.get(name)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/stats':
+                self.send_error(404)
+                return
+            stats = classifier.stats.get_stats()
+            if registry is not None:
+                stats['registry'] = registry.get_stats()
+            self.reply(stats)
+
+        def do_POST(self):
+            if self.path == '/reload':
+                self.reload()
+                return
+            if self.path != '/classify':
+                self.send_error(404)
+                return
+
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                if not isinstance(request, dict):
+                    raise TypeError('request must be an object')
+                params = {name: request.get(name) for name in ['num_similar', 'min_similarity', 'segment']}
+                messages = request['messages'] if 'messages' in request else [request['message']]
+                if not isinstance(messages, list) or not all(isinstance(message, str) for message in messages):
+                    raise TypeError('messages must be strings')
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_error(400, str(e))
+                return
+
+            # the model is picked here, so a swap while the request waits in the queue doesn't change it
+            tf_idf = None
+            if 'model' in request:
+                try:
+                    tf_idf = get_model(request['model'])
+                except LookupError as e:
+                    self.send_error(404, 'unknown model ' + str(e))
+                    return
+            elif classifier.tf_idf is None:
+                self.send_error(400, 'no model in request')
+                return
+
+            try:
+                futures = [classifier.submit(message, tf_idf=tf_idf, **params) for message in messages]
+            except (ValueError, TypeError) as e:
+                self.send_error(400, str(e))
+                return
+
+            try:
+                results = [{'category': category, 'score': score}
+                           for category, score in (future.result() for future in futures)]
+            except AssertionError as e:  # parameters out of range, see classify_batch
+                self.send_error(400, str(e))
+                return
+            except Exception as e:
+                self.send_error(500, str(e) or type(e).__name__)
+                return
+
+            self.reply(results if 'messages' in request else results[0])
+
+        def reload(self):
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                if not isinstance(request, dict):
+                    raise TypeError('request must be an object')
+                name = request['model']
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_error(400, str(e))
+                return
+
+            try:
+                model = get_model(name, reload=True)
+            except LookupError as e:
+                self.send_error(404, 'unknown model ' + str(e))
+                return
+            self.reply({'model': name, 'version': model.version})
+
+        def reply(self, data):
+            body = json.dumps(data).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+# model_file is a binary or hashed model (see classify.load_tf_idf), term/doc_frequencies.json when None
+def load_model(model_file=None):
+    return load_tf_idf([model_file] if model_file is not None else ['term_frequencies.json', 'doc_frequencies.json'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="./classify_server [" + " | ".join(valid_models.keys()) + "] [True | False]"
+                                           " [--model model.bin] [--port 8000] [--models DIR [--budget MB]]")
+    parser.add_argument("resource", choices=valid_models.keys())
+    parser.add_argument("segment", choices=['True', 'False'])
+    parser.add_argument("--model", help="binary or hashed model, default is term/doc_frequencies.json")
+    parser.add_argument("--models", help="directory of channel models (./make_model --channels DIR), requests pick one"
+                                         " by name, the server's own model is then only loaded if --model is given")
+    parser.add_argument("--budget", type=float, default=256, help="MB of channel models kept loaded")
+    parser.add_argument("--host", default='127.0.0.1')
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--num-similar", type=int, default=3)
+    parser.add_argument("--min-similarity", type=float, default=0.2)
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--max-wait", type=float, default=5, help="ms to wait for a batch to fill")
+    args = parser.parse_args()
+
+    normalizer.load()  # so the first requests don't wait on NLTK and the segmentation data
+
+    model_registry = None
+    if args.models is not None:
+        from model_registry import ModelRegistry, channel_loader
+        model_registry = ModelRegistry(channel_loader(args.models), int(args.budget * 2 ** 20))
+    default_model = load_model(args.model) if args.models is None or args.model is not None else None
+
+    loading_func, stemmed = valid_models[args.resource]
+    batch_classifier = BatchClassifier(default_model, loading_func, stemmed,
+                                       num_similar=args.num_similar,
+                                       min_similarity=args.min_similarity,
+                                       segment=(args.segment == 'True'),
+                                       max_batch=args.max_batch,
+                                       max_wait=args.max_wait / 1000)
+    batch_classifier.ready.wait()
+    if batch_classifier.error is not None:
+        raise batch_classifier.error
+
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batch_classifier, model_registry))
+    print("Serving on http://" + args.host + ":" + str(args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batch_classifier.close()
@@ -5,49 +5,44 @@ from time import time
 # imports for classification
 from make_model import *
 from classify import *
+from metrics import metrics, profiling
 
-# imports for load_sim_db()
-import sqlite3
-from io import StringIO
 
-# imports for load_w2v()
-from gensim.models import KeyedVectors
-from gensim.similarities.index import AnnoyIndexer
+# Loaders report what they are doing through progress(message, fraction) when given (fraction is None when
+# unknown, see classify_gui), and print it otherwise
+def _report(progress, message, fraction=None):
+    if progress is None:
+        print(message)
+    else:
+        progress(message, fraction)
 
 
-def load_sim_db():
-    print("Loading 'SEWordSim-r1.db' into ram")
+def load_sim_db(progress=None):
+    _report(progress, "Loading 'SEWordSim-r1.db' into ram")
+    return IndexedSimDB('SEWordSim-r1.db', progress=progress)
 
-    # Next two sections from Stack-Overflow:
-    # https://stackoverflow.com/questions/3850022/how-to-load-existing-db-file-to-memory-in-python-sqlite3/53253110
-    temp_db = sqlite3.connect('SEWordSim-r1.db')
-    temp_file: StringIO = StringIO()
-    # noinspection PyTypeChecker
-    for line in temp_db.iterdump():
-        temp_file.write('%s\n' % line)
-    temp_db.close()
-    temp_file.seek(0)
 
-    print("Transferring data into in memory database")
+# exact=True returns BatchedWord2Vec, exact neighbours by matrix products over the vectors (no Annoy index needed)
+# Subset made by make_w2v_subset.py loads the same way, from its own files
+def load_w2v(exact=False, model_file='SO_vectors_normed', index_file='SO_vectors_normed_annoy_index', progress=None):
+    # imported here so that configurations without word2vec never load gensim
+    if progress is not None:
+        progress("Importing gensim", None)
+    from gensim.models import KeyedVectors
+    from gensim.similarities.index import AnnoyIndexer
 
-    similarity_database = sqlite3.connect(":memory:")
-    sim_db_conn = similarity_database.cursor()
-    sim_db_conn.executescript(temp_file.read())
-    similarity_database.commit()
-    similarity_database.row_factory = sqlite3.Row
-
-    return SimDB(sim_db_conn)
-
-
-def load_w2v():
-    print("Loading gensim pre-trained model")
+    _report(progress, "Loading gensim pre-trained model '" + model_file + "'")
     # model = KeyedVectors.load_word2vec_format("SO_vectors_200.bin", binary=True)
     # Above is intolerably slow and large, normed by code found here: https://stackoverflow.com/a/56963501
-    model = KeyedVectors.load("SO_vectors_normed", mmap='r')
+    model = KeyedVectors.load(model_file, mmap='r')
+
+    if exact:
+        return BatchedWord2Vec(model)
 
     # Use this to load the provided AnnoyIndex
+    _report(progress, "Loading Annoy index '" + index_file + "'")
     annoy_index = AnnoyIndexer()
-    annoy_index.load('SO_vectors_normed_annoy_index')
+    annoy_index.load(index_file)
 
     # Use this to generate a new AnnoyIndex in ram, number is n-gram size (2 is recommended and seems to work best here)
     # annoy_index = AnnoyIndexer(model, 3)
@@ -55,20 +50,50 @@ def load_w2v():
     return Word2Vec(model, index=annoy_index)
 
 
+# Tables are compiled from the resources above by make_sim_table.py
+def load_sim_table(file_name, progress=None):
+    _report(progress, "Loading '" + file_name + "'")
+    return read_sim_table(file_name)
+
+
+# Both resources at once (see FusedSim), WordSimSEDB looked up by stem and Word2VecSE by word, neither is waited on
+# for more than timeout seconds per message
+def load_fused(weights=(1.0, 1.0), timeout=0.1, progress=None):
+    return FusedSim([SimBackend('WordSimSEDB', load_sim_db(progress), weights[0], stemmed=True, timeout=timeout),
+                     SimBackend('Word2VecSE', load_w2v(progress=progress), weights[1], stemmed=False,
+                                timeout=timeout)])
+
+
 # List of valid models, data loading functions above correspond in order (RAW loads no additional data)
 valid_models = {'WordSimSEDB': (load_sim_db, True),
                 'Word2VecSE': (load_w2v, False),
-                'Raw': (lambda: None, True)}
+                'Word2VecSEExact': (lambda progress=None: load_w2v(exact=True, progress=progress), False),
+                'Word2VecSESubset': (lambda progress=None: load_w2v(model_file='SO_vectors_subset',
+                                                                   index_file='SO_vectors_subset_annoy_index',
+                                                                   progress=progress), False),
+                'WordSimSEDBTable': (lambda progress=None: load_sim_table('WordSimSEDB_table.json.gz', progress),
+                                     True),
+                'Word2VecSETable': (lambda progress=None: load_sim_table('Word2VecSE_table.json.gz', progress), False),
+                'Fused': (load_fused, False),
+                'Raw': (lambda progress=None: None, True)}
 
 if __name__ == "__main__":
-    if len(sys.argv) != 4 or sys.argv[2] not in valid_models.keys() or sys.argv[3] not in ['True', 'False']:
-        print('Usage: ./classify_test labeledData.csv [Raw | WordSimSEDB | Word2VecSE] [True | False]')
+    # Optional flags after the three arguments
+    # --breakdown adds the seconds per document of every stage (see metrics.py) to each row
+    # --profile cprofile | sampling profiles the whole sweep
+    options = sys.argv[4:]
+    breakdown = '--breakdown' in options
+    profile_mode = None
+    if '--profile' in options and options.index('--profile') + 1 < len(options):
+        profile_mode = options[options.index('--profile') + 1]
+
+    if len(sys.argv) < 4 or sys.argv[2] not in valid_models.keys() or sys.argv[3] not in ['True', 'False'] \
+            or profile_mode not in [None, 'cprofile', 'sampling'] \
+            or len(options) != breakdown + 2 * ('--profile' in options):
+        print('Usage: ./classify_test labeledData.csv [' + ' | '.join(valid_models.keys()) + '] [True | False]'
+              ' [--breakdown] [--profile cprofile | sampling]')
         exit(1)
 
-    # Segmentation data must always be loaded, as make_model depends upon it
-    print("Loading wordsegment data")
-    wordsegment.load()
-
     # Enable Segmentation depending on option
     segment = (sys.argv[3] == "True")
 
@@ -76,6 +101,10 @@ if __name__ == "__main__":
     loading_func, stemmed_database = valid_models[sys.argv[2]]
     my_sim_func = loading_func()
 
+    # Each token is expanded again for every cell of the sweep, serve repeats from memory
+    if my_sim_func is not None:
+        my_sim_func = SimCache(my_sim_func)
+
     print("Beginning experiments\n")
 
     print('Accuracy percentage, ', end='')
@@ -85,65 +114,90 @@ if __name__ == "__main__":
     print('Num similar terms, ', end='')
     print('Min similarity %, ', end='')
     print('Sec/Document, ', end='')
+    if breakdown:
+        stages = ['tokenize', 'segment', 'filter', 'stem', 'similarity', 'expand', 'score']
+        for stage in stages:
+            print(stage.capitalize() + ' sec/Document, ', end='')
+        print('Tokens/Document, Substitutes/Lookup, Cache hit %, ', end='')
+        aggregator = metrics.enable()
     print()
 
-    # Here put loops that depend on regenerating model
-    # for filter_threshold in range(0, 101, 10):
-    filter_threshold = 0.0
-
-    # TODO: Make this load trainData
-    with open(sys.argv[1], 'r') as fi:
-        labeled_data = csv.DictReader(fi, delimiter=',')
-
-        (term_frequencies, doc_frequencies) = generate_frequencies(labeled_data,
-                                                                   filter_threshold=(filter_threshold * 0.0001))
-        my_idf = TFidF(term_frequencies, doc_frequencies)
-
-    # Here put loops that don't depend on regenerating model
-    # for num_similar in range(1, 2):
-    for num_similar in range(1, 11, 1):
-        # for min_similarity in range(0, 1):
-        for min_similarity in range(0, 101, 10):
-
-            # TODO: Make this load testData
-            with open(sys.argv[1], 'r') as fi:
-                labeled_data = csv.DictReader(fi, delimiter=',')
-
-                # Loop data, counts of total score and num_docs for average score, num_match and num_docs for accuracy
-                # num_zero for tracking number of documents that failed to match against anything at all
-                sum_score = 0
-                num_match = 0
-                num_docs = 0
-                num_zero = 0
-
-                start = time()
-
-                for doc in labeled_data:
-                    expected_cat = doc["Category"].lower()  # some of the labels are inconsistent in case
-                    new_message = doc["message"].lower()
-
-                    category = classify(my_idf,
-                                        new_message,
-                                        sim_func=my_sim_func,
-                                        num_similar=num_similar,
-                                        min_similarity=0.01*min_similarity,
-                                        stemmed_database=stemmed_database,
-                                        segment=segment)
-
-                    if category[0] == expected_cat:
-                        num_match += 1
-                    sum_score += category[1]
-                    if category[1] == 0:
-                        num_zero += 1
-                    num_docs += 1
-
-                end = time()
-
-                # Main information
-                match_percent = 100 * num_match / num_docs
-                zeros_percent = 100 * num_zero / num_docs
-                average = sum_score / num_docs
-                sec_per_doc = (end-start)/num_docs
-
-                print(match_percent, zeros_percent, average, filter_threshold/100,
-                      num_similar, min_similarity, sec_per_doc, sep=", ")
+    with profiling(profile_mode):
+        # Here put loops that depend on regenerating model
+        # for filter_threshold in range(0, 101, 10):
+        filter_threshold = 0.0
+
+        # TODO: Make this load trainData
+        with open(sys.argv[1], 'r') as fi:
+            labeled_data = csv.DictReader(fi, delimiter=',')
+
+            (term_frequencies, doc_frequencies) = generate_frequencies(labeled_data,
+                                                                       filter_threshold=(filter_threshold * 0.0001))
+            my_idf = TFidF(term_frequencies, doc_frequencies)
+
+        # Here put loops that don't depend on regenerating model
+        # for num_similar in range(1, 2):
+        for num_similar in range(1, 11, 1):
+            # for min_similarity in range(0, 1):
+            for min_similarity in range(0, 101, 10):
+
+                # TODO: Make this load testData
+                with open(sys.argv[1], 'r') as fi:
+                    labeled_data = csv.DictReader(fi, delimiter=',')
+
+                    # Loop data, counts of total score and num_docs for average score,
+                    # num_match and num_docs for accuracy
+                    # num_zero for tracking number of documents that failed to match against anything at all
+                    sum_score = 0
+                    num_match = 0
+                    num_docs = 0
+                    num_zero = 0
+
+                    if breakdown:
+                        aggregator.reset()
+                    start = time()
+
+                    for doc in labeled_data:
+                        expected_cat = doc["Category"].lower()  # some of the labels are inconsistent in case
+                        new_message = doc["message"].lower()
+
+                        category = classify(my_idf,
+                                            new_message,
+                                            sim_func=my_sim_func,
+                                            num_similar=num_similar,
+                                            min_similarity=0.01*min_similarity,
+                                            stemmed_database=stemmed_database,
+                                            segment=segment)
+
+                        if category[0] == expected_cat:
+                            num_match += 1
+                        sum_score += category[1]
+                        if category[1] == 0:
+                            num_zero += 1
+                        num_docs += 1
+
+                    end = time()
+
+                    # Main information
+                    match_percent = 100 * num_match / num_docs
+                    zeros_percent = 100 * num_zero / num_docs
+                    average = sum_score / num_docs
+                    sec_per_doc = (end-start)/num_docs
+
+                    row = [match_percent, zeros_percent, average, filter_threshold/100,
+                           num_similar, min_similarity, sec_per_doc]
+                    if breakdown:
+                        cell = aggregator.get_stats()
+                        row += [cell['sec_per_message'].get(stage, 0.0) for stage in stages]
+                        row += [cell['tokens_per_message'], cell.get('substitutes_per_lookup', 0.0),
+                                100 * cell.get('sim_cache_hit_rate', 0.0)]
+
+                    print(*row, sep=", ")
+
+    print()
+    print('Normalization: ', normalizer.get_stats())
+    if my_sim_func is not None:
+        print('Similarity cache: ', my_sim_func.get_stats())
+        if isinstance(my_sim_func.sim_func, FusedSim):
+            print('Similarity backends: ', my_sim_func.sim_func.get_stats())
+        my_sim_func.close()
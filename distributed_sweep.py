@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+
+# The classify_test.py experiments (same columns as sweep.py) spread over worker processes, on this host or others
+#
+# The coordinator splits the grid into work units, one per (cell, document shard), and hands them out to the workers
+# that connect to it; a cell's row is written to the output csv once all its shards are in
+# A worker gets the labeled data and the resource to use from the coordinator when it connects, prepares them once
+# (see sweep.prepare: normalized documents, the semantic resource compiled to a table) and keeps them, and the model
+# of each filter threshold, for every unit it is given. With --persistent it also keeps them across coordinators
+# (a resumed or repeated sweep of the same data and resource)
+#
+# Transport is multiprocessing.connection, pickled messages over TCP authenticated by authkey:
+#   worker                          coordinator
+#   ('ready',)                  ->
+#                               <-  ('setup', key, labeled data, resource, segment)
+#   ('prepared',)               ->  (leases only start once the worker is done preparing)
+#                               <-  ('unit', unit, cell, (start, end))   or ('stop',) once every unit is done
+#   ('result', unit, counts)    ->  (then the next unit or stop)
+#   ('error', unit, traceback)  ->  instead of prepared (unit None) or of a result, when the worker's code raised
+#
+# Retries are idempotent: a unit whose worker disconnects, or hasn't answered within --lease seconds, goes back in the
+# queue for another worker. Units have no side effects and the first result of a unit is kept (a late answer from the
+# slow worker still counts if it comes first), later ones are dropped, so every shard of a cell is counted once
+# A unit that fails (its worker raised or went away) max_failures times aborts the sweep with the last error, as does
+# a failed preparation when no other worker is working or after max_failures of them (ie. resource files missing)
+# Like sweep.py, cells already in the output are skipped, so an interrupted or aborted coordinator resumes
+# Sec/Document is the time workers spent on the cell's shards (expansion and scoring) over its documents
+# Note: authkey only authenticates the peers, messages are pickles, so only let trusted workers reach the listener
+# The default authkey is public, it is only used on loopback addresses; any other address needs --authkey or
+# $SWEEP_AUTHKEY (on the coordinator and the workers)
+#
+# Usage: ./distributed_sweep coordinator labeledData.csv [Raw | WordSimSEDB | Word2VecSE] [True | False]
+#                            [--listen 127.0.0.1:6000] [--local-workers N] [--shards 4] [--lease 600]
+#                            [--max-failures 3] [--output sweep.csv] [--thresholds 0 10 ...] [--authkey KEY]
+#        ./distributed_sweep worker [--connect 127.0.0.1:6000] [--persistent] [--authkey KEY]
+
+import argparse
+import csv
+import ipaddress
+import json
+import os
+import socket
+import sys
+import threading
+import traceback
+import zlib
+from collections import deque
+from multiprocessing import get_context
+from multiprocessing.connection import Client, Listener, AuthenticationError
+from time import monotonic, sleep, time
+
+from classify_test import valid_models
+from sweep import COLUMNS, cell_row, count_cell, prepare, remaining_cells
+
+# Only for loopback addresses, see get_authkey
+DEFAULT_AUTHKEY = 'tfidf-sweep'
+COUNTS = ['docs', 'matches', 'zeros', 'score', 'seconds']
+
+
+def parse_address(address):
+    host, port = address.rsplit(':', 1)
+    return host, int(port)
+
+
+def is_loopback(host):
+    try:
+        return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+    except (OSError, ValueError):
+        return False
+
+
+# authkey, else $SWEEP_AUTHKEY, else the default key if host is a loopback address (raises ValueError otherwise),
+# as bytes
+def get_authkey(authkey, host):
+    authkey = authkey or os.environ.get('SWEEP_AUTHKEY')
+    if authkey is None:
+        if not is_loopback(host):
+            raise ValueError(host + " isn't a loopback address, give an --authkey (or $SWEEP_AUTHKEY),"
+                                    " the default key is public")
+        authkey = DEFAULT_AUTHKEY
+    return authkey.encode('utf-8')
+
+
+# Work units of cells, split in (up to) shards ranges of documents each, as {(cell, shard): (start, end)}
+def make_units(cells, num_docs, shards):
+    bounds = [(s * num_docs // shards, (s + 1) * num_docs // shards) for s in range(shards)]
+    bounds = [(start, end) for start, end in bounds if end > start]
+    return {(cell, s): bound for cell in cells for s, bound in enumerate(bounds)}
+
+
+class Coordinator(object):
+    # setup is the message every worker gets first, on_row is called with the row of each finished cell
+    def __init__(self, setup, units, on_row, lease=600, max_failures=3):
+        if lease <= 0:
+            raise ValueError("lease must be positive, a unit of a dead worker would never be handed out again")
+        self.setup = setup
+        self.units = units
+        self.on_row = on_row
+        self.lease = lease
+        self.max_failures = max_failures
+
+        self.pending = deque(units)
+        self.results = {}
+        self.shards = {}
+        for cell, shard in units:
+            self.shards[cell] = self.shards.get(cell, 0) + 1
+        self.condition = threading.Condition()
+
+        self.workers = 0
+        self.working = 0
+        self.retries = 0
+        self.duplicates = 0
+        self.failures = {}
+        self.failed_setups = 0
+        self.error = None
+
+    # Every unit is done, or the sweep was aborted (error is set)
+    def finished(self):
+        return self.error is not None or len(self.results) == len(self.units)
+
+    # Next unit to hand out, waits while every unit left is out with a worker, None once all are done
+    def take(self):
+        with self.condition:
+            while not self.pending and not self.finished():
+                self.condition.wait()
+            return self.pending.popleft() if self.pending else None
+
+    # Unit back in the queue (front, it's the oldest), unless it's done or queued already
+    def release(self, unit):
+        with self.condition:
+            if unit not in self.results and unit not in self.pending:
+                self.pending.appendleft(unit)
+                self.retries += 1
+                self.condition.notify()
+
+    # Unit (None: the preparation) failed with error, released again or, too many failures in, the sweep is aborted
+    def fail(self, unit, error):
+        with self.condition:
+            if unit is None:
+                self.failed_setups += 1
+                abort = self.failed_setups >= self.max_failures or self.working == 0
+            else:
+                self.failures[unit] = self.failures.get(unit, 0) + 1
+                abort = self.failures[unit] >= self.max_failures
+            if abort:
+                if self.error is None:
+                    self.error = error
+                self.condition.notify_all()
+            elif unit is not None:
+                self.release(unit)
+
+    def complete(self, unit, counts):
+        with self.condition:
+            if unit in self.results:
+                self.duplicates += 1
+                return
+            self.results[unit] = counts
+            if unit in self.pending:  # requeued after its lease ran out, no need to run it again
+                self.pending.remove(unit)
+
+            cell = unit[0]
+            shards = [self.results.get((cell, s)) for s in range(self.shards[cell])]
+            if all(shards):
+                self.on_row(cell_row(*cell, {name: sum(counts[name] for counts in shards) for name in COUNTS}))
+
+            if self.finished():
+                self.condition.notify_all()
+
+    # Talks to one worker until every unit is done or the worker goes away
+    def serve(self, conn):
+        unit = None
+        working = False
+        try:
+            conn.recv()  # ('ready',)
+            conn.send(self.setup)
+            message = conn.recv()
+            if message[0] == 'error':
+                self.fail(None, message[2])
+                return
+            with self.condition:
+                self.workers += 1
+                self.working += 1
+                working = True
+
+            while True:
+                unit = self.take()
+                if unit is None:
+                    conn.send(('stop',))
+                    return
+                conn.send(('unit', unit, unit[0], self.units[unit]))
+
+                deadline = monotonic() + self.lease
+                while not conn.poll(1):
+                    if deadline is not None and monotonic() >= deadline:
+                        self.release(unit)  # another worker may take it, this one's answer is still taken
+                        deadline = None
+                    if self.finished():
+                        return
+
+                message = conn.recv()
+                if message[0] == 'error':
+                    self.fail(unit, message[2])
+                else:
+                    self.complete(message[1], message[2])
+                unit = None
+        except (EOFError, OSError) as e:
+            if unit is not None or not working:
+                self.fail(unit, "worker lost (" + (str(e) or type(e).__name__) + ")")
+        finally:
+            if working:
+                with self.condition:
+                    self.working -= 1
+            conn.close()
+
+    def _accept(self, listener, handlers):
+        while True:
+            try:
+                conn = listener.accept()
+            except AuthenticationError:
+                continue
+            except OSError:  # listener closed
+                return
+            handler = threading.Thread(target=self.serve, args=(conn,), daemon=True)
+            handler.start()
+            handlers.append(handler)
+
+    # Serves workers on listener until every unit is done
+    def run(self, listener):
+        handlers = []
+        threading.Thread(target=self._accept, args=(listener, handlers), daemon=True).start()
+        with self.condition:
+            while not self.finished():
+                self.condition.wait()
+        listener.close()
+        for handler in handlers:
+            handler.join(5)  # workers get their stop
+
+
+# Connects to the coordinator at address and works units until it says stop (or goes away)
+# prepared keeps the shared data and models of the last setup, for the next coordinator when persistent
+# Errors of the preparation or of a unit are sent to the coordinator, the worker goes on with the next unit
+def run_worker(address, authkey=None, persistent=False, prepared=None):
+    prepared = {} if prepared is None else prepared
+    authkey = get_authkey(authkey, address[0])
+    while True:
+        try:
+            conn = Client(address, authkey=authkey)
+        except (ConnectionRefusedError, FileNotFoundError):
+            if not persistent:
+                return
+            sleep(1)
+            continue
+
+        try:
+            conn.send(('ready',))
+            _, key, labeled_data, resource, segment = conn.recv()
+            if key not in prepared:
+                prepared.clear()
+                try:
+                    prepared[key] = (prepare(labeled_data, resource, segment), {})
+                except Exception:
+                    error = traceback.format_exc()
+                    print(error, file=sys.stderr)
+            if key in prepared:
+                shared, models = prepared[key]
+                conn.send(('prepared',))
+            else:
+                conn.send(('error', None, error))
+
+            while key in prepared:
+                message = conn.recv()
+                if message[0] == 'stop':
+                    break
+                _, unit, cell, (start, end) = message
+                try:
+                    counts = count_cell(shared, models, *cell, start=start, end=end)
+                except Exception:
+                    conn.send(('error', unit, traceback.format_exc()))
+                    continue
+                conn.send(('result', unit, counts))
+        except (EOFError, OSError):
+            pass
+        finally:
+            conn.close()
+
+        if not persistent:
+            return
+        sleep(1)  # the coordinator that stopped us is closing its listener
+
+
+# Runs the sweep of the cells not in output yet, with the workers that connect to address and local_workers more
+# started here. Returns (number of cells, coordinator), raises RuntimeError with the worker's error when aborted
+# (the rows of the cells finished so far are in output)
+def coordinate(labeled_data, resource, segment, output, thresholds=(0,), address=('127.0.0.1', 6000),
+               authkey=None, local_workers=0, shards=4, lease=600, max_failures=3):
+    authkey_bytes = get_authkey(authkey, address[0])
+    cells = remaining_cells(output, thresholds)
+    if not cells:
+        return 0, None
+
+    # same data and resource, same key: a persistent worker keeps what it prepared
+    key = zlib.crc32(json.dumps([labeled_data, resource, segment], sort_keys=True).encode('utf-8'))
+    setup = ('setup', key, labeled_data, resource, segment)
+
+    new_file = not os.path.exists(output) or os.path.getsize(output) == 0  # killed before the header was written
+    with open(output, 'a', newline='') as fi:
+        writer = csv.writer(fi)
+        if new_file:
+            writer.writerow(COLUMNS)
+
+        def write_row(row):
+            writer.writerow(row)
+            fi.flush()
+            print(*row, sep=", ")
+
+        coordinator = Coordinator(setup, make_units(cells, len(labeled_data), shards), write_row, lease, max_failures)
+        listener = Listener(address, authkey=authkey_bytes)
+
+        # spawned, not forked: the coordinator's threads and listener stay out of the workers
+        context = get_context('spawn')
+        processes = [context.Process(target=run_worker, args=(listener.address, authkey_bytes.decode('utf-8')))
+                     for _ in range(local_workers)]
+        for process in processes:
+            process.start()
+
+        print("Listening on", ':'.join(str(part) for part in listener.address), "for", len(coordinator.units),
+              "units\n")
+        print(*COLUMNS, sep=", ")
+        coordinator.run(listener)
+
+        for process in processes:
+            process.join()
+
+    if coordinator.error is not None:
+        raise RuntimeError("sweep aborted, a worker failed:\n" + coordinator.error)
+    return len(cells), coordinator
+
+
+if __name__ == "__main__":
+    # the resource is compiled to a table (see sweep.prepare), which Fused answers can't be
+    resources = [name for name in valid_models if name != 'Fused']
+    parser = argparse.ArgumentParser(usage="./distributed_sweep coordinator labeledData.csv [" + " | ".join(resources)
+                                           + "] [True | False] [--listen 127.0.0.1:6000] [--local-workers N]"
+                                           " [--shards 4] [--lease 600] [--max-failures 3] [--output sweep.csv]"
+                                           " [--thresholds 0 10 ...] [--authkey KEY]\n"
+                                           "       ./distributed_sweep worker [--connect 127.0.0.1:6000]"
+                                           " [--persistent] [--authkey KEY]")
+    modes = parser.add_subparsers(dest="mode", required=True)
+    authkey_help = "shared by coordinator and workers, default $SWEEP_AUTHKEY (needed off loopback addresses)"
+
+    coordinator_parser = modes.add_parser("coordinator")
+    coordinator_parser.add_argument("labeled_data")
+    coordinator_parser.add_argument("resource", choices=resources)
+    coordinator_parser.add_argument("segment", choices=['True', 'False'])
+    coordinator_parser.add_argument("--listen", default='127.0.0.1:6000', help="host:port workers connect to")
+    coordinator_parser.add_argument("--local-workers", type=int, default=0, help="workers to start on this host")
+    coordinator_parser.add_argument("--shards", type=int, default=4, help="document shards per cell")
+    coordinator_parser.add_argument("--lease", type=int, default=600,
+                                    help="seconds a worker has for a unit before it's handed to another")
+    coordinator_parser.add_argument("--max-failures", type=int, default=3,
+                                    help="failures of a unit (or of preparing) before the sweep is aborted")
+    coordinator_parser.add_argument("--output", default='sweep.csv')
+    coordinator_parser.add_argument("--thresholds", type=int, nargs='+', default=[0],
+                                    help="filter thresholds, in classify_test.py units (0 to 100)")
+    coordinator_parser.add_argument("--authkey", help=authkey_help)
+
+    worker_parser = modes.add_parser("worker")
+    worker_parser.add_argument("--connect", default='127.0.0.1:6000', help="host:port of the coordinator")
+    worker_parser.add_argument("--persistent", action="store_true",
+                               help="keep (re)connecting, and the prepared data, across coordinators")
+    worker_parser.add_argument("--authkey", help=authkey_help)
+    args = parser.parse_args()
+
+    address = parse_address(args.listen if args.mode == 'coordinator' else args.connect)
+    try:
+        get_authkey(args.authkey, address[0])
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.mode == 'coordinator' and args.lease <= 0:
+        coordinator_parser.error("--lease must be a positive number of seconds")
+
+    if args.mode == 'worker':
+        run_worker(address, args.authkey, args.persistent)
+        exit(0)
+
+    with open(args.labeled_data, 'r') as csv_file:
+        rows = list(csv.DictReader(csv_file, delimiter=','))
+    start_time = time()
+    try:
+        num_cells, done = coordinate(rows, args.resource, args.segment == 'True', args.output, args.thresholds,
+                                     address, args.authkey, args.local_workers, args.shards, args.lease,
+                                     args.max_failures)
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        exit(1)
+    print("\n" + str(num_cells), "cells in", time() - start_time, "sec")
+    if done is not None:
+        print(done.workers, "workers,", done.retries, "units retried,", done.duplicates, "duplicate results dropped")
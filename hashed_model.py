@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+
+# Hashed feature model (the hashing trick), a fixed number of buckets per category whatever the vocabulary size
+#
+# Every term is mapped to a bucket by the crc32 of its utf-8 bytes (the same in every process, unlike hash()), the
+# tf-idf weights of all terms of a bucket are added up, so the model is one (num_buckets x num_categories) array
+# and the vocabulary itself is never stored
+# Terms of a message (stems and substitutes alike) are looked up by the same hash, a term the model never saw scores
+# whatever landed in its bucket
+# With signed hashing (the default) the top bit of the crc32 gives each term a sign, its weight is added with that
+# sign and multiplied by it again when scored, so terms sharing a bucket cancel out on average instead of adding up
+# Scores can then be negative: classify answers (None, 0) when no category scores above 0, and ranked shares are of
+# the positive scores only (see classify.rank_scores)
+#
+# Weights are computed by TFidF itself from the usual term/doc frequencies, only then folded into buckets, so the
+# filter threshold still applies per term
+# Note: scoring='postings' walks the vocabulary, hashed models are scored by their matrix only
+#
+# File layout (little endian):
+# magic b'TFIDFHSH', header length (uint64), json header (padded to 8 bytes), then
+#   weights   float64 [num_buckets, num_categories] at the byte offset recorded in the header
+#
+# Usage: ./hashed_model term_frequencies.json doc_frequencies.json hashed_model.bin [--buckets N] [--unsigned]
+#        ./hashed_model --report labeledData.csv [--buckets N ...] (accuracy and memory at several bucket counts)
+
+import argparse
+import csv
+import json
+import mmap
+import sys
+import zlib
+from time import perf_counter, time
+
+import numpy as np
+
+from binary_model import _encode, _padded
+from classify import TFidF, ScoreMatrix, classify, expand_message
+
+MAGIC = b'TFIDFHSH'
+VERSION = 1
+
+
+# (bucket, sign) of word
+def feature_hash(word, num_buckets, signed=True):
+    h = zlib.crc32(_encode(word))
+    return h % num_buckets, (1 - 2 * (h >> 31) if signed else 1)
+
+
+# Categories and the (num_buckets x num_categories) weights of a model given by its term/doc frequencies
+def hash_weights(term_freqs, doc_freqs, num_buckets, signed=True):
+    # Category order is kept, classify breaks ties in favour of the first category
+    categories = list(term_freqs.keys())
+    tf_idf = TFidF(term_freqs, doc_freqs)
+
+    weights = np.zeros((num_buckets, len(categories)), dtype='<f8')
+    for c, cat in enumerate(categories):
+        for word in term_freqs[cat]['counts']:
+            bucket, sign = feature_hash(word, num_buckets, signed)
+            weights[bucket, c] += sign * tf_idf(word, cat)
+    return categories, weights
+
+
+def write_hashed_model(term_freqs, doc_freqs, file_name, num_buckets=2 ** 16, signed=True):
+    categories, weights = hash_weights(term_freqs, doc_freqs, num_buckets, signed)
+
+    header = {'version': VERSION,
+              'categories': categories,
+              'num_docs': [term_freqs[cat]['num_docs'] for cat in categories],
+              'num_buckets': num_buckets,
+              'signed': signed}
+    header_size = _padded(len(json.dumps(header)) + 64)
+    header['weights'] = len(MAGIC) + 8 + header_size
+
+    header_bytes = json.dumps(header).encode('utf-8')
+    header_bytes += b' ' * (header_size - len(header_bytes))
+
+    with open(file_name, 'wb') as fi:
+        fi.write(MAGIC)
+        fi.write(np.array([header_size], dtype='<u8').tobytes())
+        fi.write(header_bytes)
+        fi.write(weights.tobytes())
+
+
+# ScoreMatrix over the buckets, each term of an expansion counts with the sign of its hash
+class HashedScoreMatrix(ScoreMatrix):
+    def __init__(self, categories, weights, signed=True):
+        super().__init__(categories, None, weights)
+        self.num_buckets = weights.shape[0]
+        self.signed = signed
+
+    def lookup(self, expansion):
+        term_ids = []
+        counts = []
+        for word, weight in expansion.items():
+            bucket, sign = feature_hash(word, self.num_buckets, self.signed)
+            term_ids.append(bucket)
+            counts.append(sign * weight)
+        return term_ids, counts
+
+
+# TFidF over hashed weights (from hash_weights or a file written by write_hashed_model, see read_hashed_model)
+# get_term_frequencies() and get_doc_frequencies() return None, the terms aren't kept
+class HashedTFidF(TFidF):
+    def __init__(self, categories, weights, signed=True):
+        super().__init__(None, None)
+        self.categories = categories
+        self.category_ids = {cat: c for c, cat in enumerate(categories)}
+        self.weights = weights
+        self.signed = signed
+        self.nbytes = weights.nbytes
+        self.score_matrix = HashedScoreMatrix(categories, weights, signed)
+
+    def __call__(self, word, category):
+        cat_id = self.category_ids.get(category)
+        if cat_id is None:
+            return 0
+        bucket, sign = feature_hash(word, self.weights.shape[0], self.signed)
+        return sign * float(self.weights[bucket, cat_id])
+
+    def get_categories(self):
+        return self.categories
+
+    def get_posting_index(self):
+        raise ValueError("hashed models have no vocabulary to index, use scoring='matrix'")
+
+
+# Weights are memory mapped read only, like MappedTFidF
+def read_hashed_model(file_name):
+    with open(file_name, 'rb') as fi:
+        buffer = mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError(file_name + " is not a hashed model")
+
+    header_size = int(np.frombuffer(buffer, dtype='<u8', count=1, offset=len(MAGIC))[0])
+    header = json.loads(buffer[len(MAGIC) + 8:len(MAGIC) + 8 + header_size].decode('utf-8'))
+    if header['version'] != VERSION:
+        raise ValueError(file_name + " has unsupported version " + str(header['version']))
+
+    num_buckets = header['num_buckets']
+    num_categories = len(header['categories'])
+    weights = np.frombuffer(buffer, dtype='<f8', count=num_buckets * num_categories,
+                            offset=header['weights']).reshape(num_buckets, num_categories)
+    return HashedTFidF(header['categories'], weights, header['signed'])
+
+
+# Memory the exact model needs to classify: its score matrix, term dictionary (with the terms) included
+def _exact_bytes(tf_idf):
+    score_matrix = tf_idf.get_score_matrix()
+    return (score_matrix.weights.nbytes + sys.getsizeof(score_matrix.term_ids)
+            + sum(sys.getsizeof(word) for word in score_matrix.term_ids))
+
+
+# Row of classify_test's metrics (accuracy, zeros and average score) for tf_idf over the labeled data,
+# plus sec/document and usec per term lookup (term to row of the score matrix, fastest of 5 passes)
+def evaluate(tf_idf, labeled_data, segment=True):
+    num_match = 0
+    num_zero = 0
+    sum_score = 0
+
+    start = time()
+    for doc in labeled_data:
+        category, score = classify(tf_idf, doc['message'].lower(), segment=segment)
+        num_match += category == doc['Category'].lower()
+        num_zero += score == 0
+        sum_score += score
+    elapsed = time() - start
+
+    expansions = [expand_message(doc['message'].lower(), segment=segment) for doc in labeled_data]
+    score_matrix = tf_idf.get_score_matrix()
+    lookup = None
+    for _ in range(5):  # fastest pass, lookups alone are quick enough to be noisy
+        start = perf_counter()
+        for expansion in expansions:
+            score_matrix.lookup(expansion)
+        lookup = min(lookup or float('inf'), perf_counter() - start)
+
+    num_docs = len(labeled_data)
+    num_terms = sum(len(expansion) for expansion in expansions)
+    return [100 * num_match / num_docs, 100 * num_zero / num_docs, sum_score / num_docs, elapsed / num_docs,
+            1e6 * lookup / num_terms]
+
+
+# Exact model, then hashed (signed and unsigned) at every bucket count, trained and tested on labeled_data with
+# filter threshold 0 (as the first rows of classify_test)
+def report(labeled_data, bucket_counts, segment=True):
+    from make_model import generate_frequencies
+
+    term_freqs, doc_freqs = generate_frequencies(labeled_data, filter_threshold=0.0)
+    vocabulary = set(doc_freqs)
+
+    print('Buckets, Signed, Model kB, Colliding terms %, Accuracy percentage, Zeros percentage, Average score,'
+          ' Sec/Document, Usec/Term lookup')
+    exact = TFidF(term_freqs, doc_freqs)
+    print('exact (' + str(len(vocabulary)) + ' terms)', '', _exact_bytes(exact) / 1024, 0.0,
+          *evaluate(exact, labeled_data, segment), sep=', ')
+
+    for num_buckets in bucket_counts:
+        buckets = np.bincount([feature_hash(word, num_buckets)[0] for word in vocabulary], minlength=num_buckets)
+        colliding = 100 * buckets[buckets > 1].sum() / len(vocabulary)
+        for signed in [True, False]:
+            hashed = HashedTFidF(*hash_weights(term_freqs, doc_freqs, num_buckets, signed), signed=signed)
+            print(num_buckets, signed, hashed.nbytes / 1024, colliding, *evaluate(hashed, labeled_data, segment),
+                  sep=', ')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="./hashed_model term_frequencies.json doc_frequencies.json hashed_model.bin"
+                                           " [--buckets N] [--unsigned]\n"
+                                           "       ./hashed_model --report labeledData.csv [--buckets N ...]")
+    parser.add_argument("files", nargs='*')
+    parser.add_argument("--report", metavar="CSV", help="labeled data to train and test on at each bucket count")
+    parser.add_argument("--buckets", type=int, nargs='+', help="buckets per category, default 65536 "
+                                                               "(--report: 1024 4096 16384 65536 262144)")
+    parser.add_argument("--unsigned", action="store_true", help="no signs, weights of a bucket just add up")
+    args = parser.parse_args()
+
+    if args.report is not None:
+        if args.files:
+            parser.error("--report takes no model files")
+        with open(args.report, 'r') as csv_file:
+            report(list(csv.DictReader(csv_file, delimiter=',')), args.buckets or [1024, 4096, 16384, 65536, 262144])
+        exit(0)
+
+    if len(args.files) != 3 or (args.buckets is not None and len(args.buckets) != 1):
+        parser.error("expected term_frequencies.json doc_frequencies.json hashed_model.bin, and one bucket count")
+
+    with open(args.files[0], 'r') as fi:
+        term_frequencies_json = json.load(fi)
+
+    with open(args.files[1], 'r') as fi:
+        doc_frequencies_json = json.load(fi)
+
+    write_hashed_model(term_frequencies_json, doc_frequencies_json, args.files[2],
+                       args.buckets[0] if args.buckets else 2 ** 16, not args.unsigned)
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+# Sends messages from labeled data to a running classify_server as fast as it answers, from several client threads
+# Reports sustained messages per second and client side latency, then the server's own /stats
+#
+# Usage: ./load_generator labeledData.csv [--url http://127.0.0.1:8000] [--clients 16] [--duration 30]
+
+import argparse
+import csv
+import json
+from itertools import cycle
+from threading import Thread, Lock
+from time import perf_counter
+from urllib.request import Request, urlopen
+
+from classify_server import percentile
+
+
+def post(url, data):
+    request = Request(url, data=json.dumps(data).encode('utf-8'), headers={'Content-Type': 'application/json'})
+    with urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def run_load(url, messages, clients=16, duration=30.0, per_request=1):
+    lock = Lock()
+    source = cycle(messages)
+    latencies = []
+    errors = [0]
+    stop = perf_counter() + duration
+
+    def client():
+        while perf_counter() < stop:
+            with lock:
+                batch = [next(source) for _ in range(per_request)]
+            start = perf_counter()
+            try:
+                if per_request == 1:
+                    post(url + '/classify', {'message': batch[0]})
+                else:
+                    post(url + '/classify', {'messages': batch})
+            except OSError:
+                with lock:
+                    errors[0] += 1
+                continue
+            with lock:
+                latencies.append(perf_counter() - start)
+
+    start = perf_counter()
+    threads = [Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = perf_counter() - start
+
+    return {'messages': len(latencies) * per_request,
+            'errors': errors[0],
+            'messages_per_sec': len(latencies) * per_request / elapsed,
+            'p50_ms': 1000 * percentile(latencies, 50),
+            'p99_ms': 1000 * percentile(latencies, 99)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="./load_generator labeledData.csv [--url http://127.0.0.1:8000]"
+                                           " [--clients 16] [--duration 30]")
+    parser.add_argument("labeled_data")
+    parser.add_argument("--url", default='http://127.0.0.1:8000')
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds")
+    parser.add_argument("--per-request", type=int, default=1, help="messages sent in each request")
+    args = parser.parse_args()
+
+    with open(args.labeled_data, 'r') as fi:
+        labeled_messages = [doc["message"] for doc in csv.DictReader(fi, delimiter=',')]
+
+    print('Client:', run_load(args.url, labeled_messages, args.clients, args.duration, args.per_request))
+    with urlopen(args.url + '/stats') as stats_response:
+        print('Server:', json.loads(stats_response.read()))
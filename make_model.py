@@ -4,7 +4,10 @@
 # Produces the model from the provided labeled data (labeledData.csv)
 #
 # Input: labeledData.csv, csv file that must have columns labeled "message" and "Category"
-# Output: term/doc_frequency.json files
+# Output: term/doc_frequency.json files, and category_counts.json (unfiltered counts, used by --update)
+#         with --channels DIR, the same files for each channel (first column) in a directory of DIR, and
+#         DIR/channels.json (channel name : directory), as read by model_registry.channel_loader
+#         with --hashed BUCKETS, also hashed_model.bin (see hashed_model.py)
 #
 # Note: Normalizes case of category names
 # We produce for each category 1) number of docs (messages) in that category, 2) Counter of the words
@@ -34,93 +37,579 @@
 # nltk.download('stopwords')
 # nltk.download('punkt')
 
-import sys
+import argparse
 import csv
+import heapq
 import json
-from copy import deepcopy
-from collections import Counter
+import os
+import re
+import shutil
+import tempfile
+from collections import Counter, deque
+from functools import partial
+from itertools import groupby
+from multiprocessing import Pool, get_context
+from operator import itemgetter
+from time import perf_counter, time
 
-from nltk.corpus import stopwords
-from nltk.tokenize import word_tokenize
-from nltk.stem.snowball import PorterStemmer
+from metrics import metrics
+from normalize import normalizer
 
-import wordsegment
 
-
-def generate_frequencies(labeled_data,  filter_threshold=0.03):
-    stemmer = PorterStemmer()
-    stop_words = stopwords.words('english')
+# Count words of every document, before any filtering on frequency
+# returns dict(category_name, {num_docs : int, counts : Counter(words)})
+def count_documents(labeled_data):
     categories = dict()  # dict(category_name, {num_docs : int, counts : Counter(words)})
-    # word_tokenize = lambda x: RegexpTokenizer(r'\w+').tokenize(x)
 
     for doc in labeled_data:
-        category = doc["Category"].lower()  # some of the labels are inconsistent in case
-        # if category == 'uninformative':
-        #    continue
-        if category not in categories.keys():
-            categories[category] = {'num_docs': 1, 'counts': Counter()}
-        else:
-            categories[category]['num_docs'] += 1
-
-        # use word_tokenize to parse words, make unique, remove stopwords
-        # leaves non word things like '?', and "`", in input
-        # NOTE: 2/27/20 -- Found forgot to call lower here
-        message = doc["message"].lower().strip()
-        message = word_tokenize(message)
-
-        segmented_message = []
-        for wd in message:
-            segmented_message.append(wd)
-            segments = wordsegment.segment(wd)
-            if len(segments) > 1:
-                segmented_message.extend(segments)
-
-        processed_message = [stemmer.stem(wd) for wd in segmented_message
-                             if wd not in stop_words and
-                             sum(map((lambda x: 1 if x[1].isalnum() else 0),
-                                     enumerate(wd))) > 0]
-
-        for wd in processed_message:
-            categories[category]['counts'][wd] += 1
-
-    term_freqs = deepcopy(categories)
+        add_document(categories, doc)
+
+    return categories
+
+
+# Per channel version of count_documents, in one pass over labeled_data
+# returns dict(channel, dict(category_name, {num_docs : int, counts : Counter(words)}))
+def count_channel_documents(labeled_data, key='Channel'):
+    channels = dict()
+
+    for doc in labeled_data:
+        if doc[key] not in channels:
+            channels[doc[key]] = dict()
+        add_document(channels[doc[key]], doc)
+
+    return channels
+
+
+# Passes rows through, calling progress(message, fraction) every `every` rows (fraction is None without total)
+def _reporting(rows, progress, total=None, every=200):
+    done = 0
+    for row in rows:
+        yield row
+        done += 1
+        if done % every == 0:
+            progress("Counted " + str(done) + " messages", done / total if total else None)
+
+
+# Count the words of one document into categories (in place)
+def add_document(categories, doc):
+    category = doc["Category"].lower()  # some of the labels are inconsistent in case
+    # if category == 'uninformative':
+    #    return
+    if category not in categories.keys():
+        categories[category] = {'num_docs': 1, 'counts': Counter()}
+    else:
+        categories[category]['num_docs'] += 1
+
+    # tokenize, segment, remove stopwords and non word things like '?', and "`", then stem (see normalize.py)
+    categories[category]['counts'].update(normalizer.stems(doc["message"]))
+
+
+# Add the partial counts of one shard into categories (in place)
+# Shards must be merged in input order, so categories keep the order of their first appearance (as in serial build)
+def merge_counts(categories, partial):
+    for cat in partial:
+        if cat not in categories:
+            categories[cat] = {'num_docs': 0, 'counts': Counter()}
+        categories[cat]['num_docs'] += partial[cat]['num_docs']
+        categories[cat]['counts'].update(partial[cat]['counts'])
+
+    return categories
+
+
+def merge_channel_counts(channels, partial):
+    for channel in partial:
+        if channel not in channels:
+            channels[channel] = dict()
+        merge_counts(channels[channel], partial[channel])
+
+    return channels
+
+
+# Only the columns used by count_documents are sent to the workers
+def _shards(labeled_data, shard_size, columns=("Category", "message")):
+    shard = []
+    for doc in labeled_data:
+        shard.append({column: doc[column] for column in columns})
+        if len(shard) == shard_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+
+# Same as count_documents, but shards of the labeled data are counted by a pool of processes
+# At most 2 shards per worker are in flight, so labeled_data is still read as a stream
+# With key, same as count_channel_documents
+def count_documents_parallel(labeled_data, workers, shard_size=1000, key=None):
+    count, merge, columns = count_documents, merge_counts, ("Category", "message")
+    if key is not None:
+        count, merge, columns = partial(count_channel_documents, key=key), merge_channel_counts, columns + (key,)
+
+    counted = dict()
+    pending = deque()
+
+    with Pool(workers) as pool:
+        for shard in _shards(labeled_data, shard_size, columns):
+            pending.append(pool.apply_async(count, (shard,)))
+            if len(pending) >= 2 * workers:
+                merge(counted, pending.popleft().get())
+
+        while pending:
+            merge(counted, pending.popleft().get())
+
+    return counted
+
+
+# Thresholded view of one category, words appearing in less than filter_threshold of its documents are dropped
+def threshold_category(category, filter_threshold=0.03):
+    # calculate term frequency % (within a single category)
+    # Note: can also do number of times word appears across all categories
+    num_docs = category['num_docs']
+    return {'num_docs': num_docs,
+            'counts': Counter({wd: count for wd, count in category['counts'].items()
+                               if count / num_docs >= filter_threshold})}
+
+
+def apply_threshold(categories, filter_threshold=0.03):
+    term_freqs = dict()
     doc_freqs = Counter()
 
     for cat in categories:
-        category = categories[cat]
-        for wd in category['counts']:
-
-            # calculate term frequency % (within a single category)
-            # Note: can also do number of times word appears across all categories
-            count = category['counts'][wd]
-            freq = count / category['num_docs']
-            if freq < filter_threshold:
-                del term_freqs[cat]['counts'][wd]
-            # else:
-                # print(cat, " : ('", wd, "', ", freq, ")", sep='')
-
-            # Increase document frequency (here doc refers to category)
-            # each word should appear only once per category,
-            # so this counts number of categories a word appears in
+        term_freqs[cat] = threshold_category(categories[cat], filter_threshold)
 
+        # Increase document frequency (here doc refers to category)
+        # each word should appear only once per category,
+        # so this counts number of categories a word appears in
+        for wd in categories[cat]['counts']:
             doc_freqs[wd] += 1
 
     return term_freqs, doc_freqs
 
 
+# The model keeps the unfiltered counts next to the term/doc frequencies derived from them,
+# so new labeled data can be added later by update() without recounting everything
+# progress(message, fraction) is told how many messages are counted (see _reporting), a fraction when labeled_data is
+# a list
+def build_model(labeled_data, filter_threshold=0.03, workers=1, progress=None):
+    start = perf_counter()
+    if progress is not None:
+        progress("Counting messages", 0.0 if isinstance(labeled_data, list) else None)
+        labeled_data = _reporting(labeled_data, progress, len(labeled_data) if isinstance(labeled_data, list) else None)
+    if workers > 1:
+        categories = count_documents_parallel(labeled_data, workers)
+    else:
+        categories = count_documents(labeled_data)
+    counted = perf_counter()
+
+    if progress is not None:
+        progress("Applying filter threshold", None)
+    model = threshold_model(categories, filter_threshold)
+
+    if metrics.enabled:
+        metrics.time('build_count', counted - start)
+        metrics.time('build_threshold', perf_counter() - counted)
+        metrics.count('build_documents', sum(category['num_docs'] for category in categories.values()))
+    return model
+
+
+# One model (as returned by build_model) per channel, from a single pass over labeled_data
+# returns dict(channel, model), channels in order of first appearance
+def build_channel_models(labeled_data, filter_threshold=0.03, workers=1, key='Channel'):
+    start = perf_counter()
+    if workers > 1:
+        channels = count_documents_parallel(labeled_data, workers, key=key)
+    else:
+        channels = count_channel_documents(labeled_data, key)
+    counted = perf_counter()
+
+    models = {channel: threshold_model(categories, filter_threshold) for channel, categories in channels.items()}
+
+    if metrics.enabled:
+        metrics.time('build_count', counted - start)
+        metrics.time('build_threshold', perf_counter() - counted)
+        metrics.count('build_documents', sum(category['num_docs'] for categories in channels.values()
+                                             for category in categories.values()))
+    return models
+
+
+def threshold_model(categories, filter_threshold=0.03):
+    term_freqs, doc_freqs = apply_threshold(categories, filter_threshold)
+    return {'filter_threshold': filter_threshold,
+            'categories': categories,
+            'term_frequencies': term_freqs,
+            'doc_frequencies': doc_freqs}
+
+
+# workers > 1 counts with a process pool, output is identical to the serial build
+def generate_frequencies(labeled_data,  filter_threshold=0.03, workers=1, progress=None):
+    model = build_model(labeled_data, filter_threshold, workers, progress)
+    return model['term_frequencies'], model['doc_frequencies']
+
+
+# Fold new labeled documents into a model (in place), same result as building it again from all the data
+# Only the thresholded views of categories with new documents, and the document frequency of words new to a
+# category, are recomputed
+# Note: a TFidF made from the model before the update must be made again
+def update(model, new_rows, workers=1):
+    if workers > 1:
+        partial = count_documents_parallel(new_rows, workers)
+    else:
+        partial = count_documents(new_rows)
+
+    categories = model['categories']
+    doc_freqs = model['doc_frequencies']
+    for cat in partial:
+        known = categories[cat]['counts'] if cat in categories else {}
+        for wd in partial[cat]['counts']:
+            if wd not in known:
+                doc_freqs[wd] = doc_freqs.get(wd, 0) + 1
+
+    merge_counts(categories, partial)
+
+    for cat in partial:
+        model['term_frequencies'][cat] = threshold_category(categories[cat], model['filter_threshold'])
+
+    return model
+
+
+def write_model(model, directory='.'):
+    with open(os.path.join(directory, "term_frequencies.json"), 'w') as fi:
+        json.dump(model['term_frequencies'], fi, indent=4, sort_keys=True)
+
+    with open(os.path.join(directory, "doc_frequencies.json"), 'w') as fi:
+        json.dump(model['doc_frequencies'], fi, indent=4, sort_keys=True)
+
+    with open(os.path.join(directory, "category_counts.json"), 'w') as fi:
+        json.dump({'filter_threshold': model['filter_threshold'], 'categories': model['categories']},
+                  fi, indent=4, sort_keys=True)
+
+
+# Each model in a directory of directory named after its channel (characters other than letters, digits, '.' and '-'
+# replaced), channels.json maps channel names to their directory
+def write_channel_models(models, directory):
+    index = {}
+    for channel, model in models.items():
+        name = re.sub(r'[^\w.-]+', '_', channel).strip('._') or 'channel'
+        while name in index.values():
+            name += '_'
+        index[channel] = name
+
+        os.makedirs(os.path.join(directory, name), exist_ok=True)
+        write_model(model, os.path.join(directory, name))
+
+    with open(os.path.join(directory, 'channels.json'), 'w') as fi:
+        json.dump(index, fi, indent=4, sort_keys=True)
+
+
+# Counts are loaded back as Counters, so merge_counts adds to them instead of replacing them
+def load_model(directory='.'):
+    with open(os.path.join(directory, "category_counts.json"), 'r') as fi:
+        model = json.load(fi)
+
+    for cat in model['categories']:
+        model['categories'][cat]['counts'] = Counter(model['categories'][cat]['counts'])
+
+    with open(os.path.join(directory, "term_frequencies.json"), 'r') as fi:
+        model['term_frequencies'] = json.load(fi)
+
+    with open(os.path.join(directory, "doc_frequencies.json"), 'r') as fi:
+        model['doc_frequencies'] = json.load(fi)
+
+    return model
+
+
+# Out of core build, for labeled data whose counts don't fit in memory
+# Counts are held in memory until they take about memory_budget bytes, then each category's are written to a run
+# file sorted by word and dropped; at the end the runs of each category are merged (one line per run in memory),
+# counts of the same word summed, and category_counts.json is written as the merge goes
+# filter_threshold is applied to each merged count as it comes out of the merge, the kept words are written to a
+# file of their own (term_frequencies.json is written from those), then the merged categories are merged again by
+# word for doc_frequencies.json, so no step holds more than one line per run or category
+# Files are identical to write_model(build_model(labeled_data, filter_threshold)), written to directory
+# Note: The budget covers the counts, the normalizer's caches (which grow with the same words) are cleared at each spill
+# returns dict(filter_threshold, runs : number of run files spilled), the model itself is only in the files
+def build_model_external(labeled_data, directory='.', filter_threshold=0.03, memory_budget=256 * 2 ** 20,
+                         spill_dir=None):
+    spill_directory = tempfile.mkdtemp(prefix='make_model_', dir=spill_dir)
+    try:
+        start = perf_counter()
+        num_docs, runs = _spill_counts(labeled_data, spill_directory, memory_budget)
+        counted = perf_counter()
+
+        _merge_categories(num_docs, runs, spill_directory, directory, filter_threshold)
+        _merge_doc_frequencies(num_docs, spill_directory, directory)
+        _write_term_frequencies(num_docs, spill_directory, directory)
+    finally:
+        shutil.rmtree(spill_directory)
+
+    if metrics.enabled:
+        metrics.time('build_count', counted - start)
+        metrics.time('build_threshold', perf_counter() - counted)
+        metrics.count('build_documents', sum(num_docs.values()))
+    return {'filter_threshold': filter_threshold,
+            'runs': runs}
+
+
+# Estimated bytes of one (word : count) entry of a category's Counter, the word included
+COUNT_ENTRY_BYTES = 120
+
+
+# Counts of documents by category (in order of first appearance) are kept, word counts are spilled to run files
+# run_<run>_<category index>, one line per word (word, tab, count) sorted by word
+def _spill_counts(labeled_data, spill_directory, memory_budget):
+    num_docs = dict()
+    categories = dict()
+    held = 0
+    runs = 0
+
+    for doc in labeled_data:
+        category = doc["Category"].lower()  # some of the labels are inconsistent in case
+        num_docs[category] = num_docs.get(category, 0) + 1
+        if category not in categories:
+            categories[category] = Counter()
+
+        counts = categories[category]
+        before = len(counts)
+        counts.update(normalizer.stems(doc["message"]))
+        held += (len(counts) - before) * COUNT_ENTRY_BYTES
+
+        if held > memory_budget:
+            _write_run(categories, num_docs, runs, spill_directory)
+            runs += 1
+            held = 0
+            # the memoized stems and segments grow with the same new words, up to their cache_size
+            normalizer.stem.cache_clear()
+            normalizer._segment.cache_clear()
+
+    _write_run(categories, num_docs, runs, spill_directory)
+    return num_docs, runs + 1
+
+
+def _write_run(categories, num_docs, run, spill_directory):
+    for c, category in enumerate(num_docs):
+        counts = categories.get(category)
+        if counts:
+            with open(_run_file(spill_directory, run, c), 'w', encoding='utf-8', newline='\n') as fi:
+                for word in sorted(counts):
+                    fi.write(word + '\t' + str(counts[word]) + '\n')
+    categories.clear()
+
+
+def _run_file(spill_directory, run, category_index):
+    return os.path.join(spill_directory, 'run_' + str(run) + '_' + str(category_index))
+
+
+# (word, count) of a run (or merged) file, in file order
+def _read_counts(file_name):
+    with open(file_name, 'r', encoding='utf-8', newline='\n') as fi:
+        for line in fi:
+            word, count = line[:-1].rsplit('\t', 1)
+            yield word, int(count)
+
+
+# (word, summed count) of sorted streams of (word, count), sorted by word
+def _merge_sorted(streams):
+    for word, group in groupby(heapq.merge(*streams, key=itemgetter(0)), key=itemgetter(0)):
+        yield word, sum(count for _, count in group)
+
+
+# Writes category_counts.json while merging the runs of each category, the merged counts of each category
+# (merged_<category index>) for _merge_doc_frequencies, and the counts kept by filter_threshold (kept_<category index>)
+# for _write_term_frequencies
+def _merge_categories(num_docs, runs, spill_directory, directory, filter_threshold):
+    category_ids = {category: c for c, category in enumerate(num_docs)}
+
+    def merged_counts(category):
+        c = category_ids[category]
+        streams = [_read_counts(_run_file(spill_directory, run, c)) for run in range(runs)
+                   if os.path.exists(_run_file(spill_directory, run, c))]
+        with open(os.path.join(spill_directory, 'merged_' + str(c)), 'w', encoding='utf-8', newline='\n') as merged, \
+                open(os.path.join(spill_directory, 'kept_' + str(c)), 'w', encoding='utf-8', newline='\n') as kept:
+            for word, count in _merge_sorted(streams):
+                merged.write(word + '\t' + str(count) + '\n')
+                if count / num_docs[category] >= filter_threshold:
+                    kept.write(word + '\t' + str(count) + '\n')
+                yield word, count
+
+    with open(os.path.join(directory, "category_counts.json"), 'w') as fi:
+        fi.write('{\n    "categories": ')
+        _dump_sorted(fi, ((category, category) for category in sorted(num_docs)), 1,
+                     partial(_write_category, num_docs, merged_counts))
+        fi.write(',\n    "filter_threshold": ' + json.dumps(filter_threshold) + '\n}')
+
+
+# Writes a category as json.dump would at nesting level depth, its counts (sorted by word) from counts(category)
+def _write_category(num_docs, counts, fi, category, depth):
+    fi.write('{\n' + ' ' * 4 * (depth + 1) + '"counts": ')
+    _dump_sorted(fi, counts(category), depth + 1)
+    fi.write(',\n' + ' ' * 4 * (depth + 1) + '"num_docs": ' + json.dumps(num_docs[category]) + '\n'
+             + ' ' * 4 * depth + '}')
+
+
+# term_frequencies.json from the counts kept by _merge_categories
+def _write_term_frequencies(num_docs, spill_directory, directory):
+    category_ids = {category: c for c, category in enumerate(num_docs)}
+
+    def kept_counts(category):
+        return _read_counts(os.path.join(spill_directory, 'kept_' + str(category_ids[category])))
+
+    with open(os.path.join(directory, "term_frequencies.json"), 'w') as fi:
+        _dump_sorted(fi, ((category, category) for category in sorted(num_docs)), 0,
+                     partial(_write_category, num_docs, kept_counts))
+
+
+# Number of categories of each word, from the merged counts of every category
+def _merge_doc_frequencies(num_docs, spill_directory, directory):
+    streams = [_read_counts(os.path.join(spill_directory, 'merged_' + str(c))) for c in range(len(num_docs))]
+    doc_freqs = ((word, len(list(group))) for word, group in groupby(heapq.merge(*streams, key=itemgetter(0)),
+                                                                     key=itemgetter(0)))
+    with open(os.path.join(directory, "doc_frequencies.json"), 'w') as fi:
+        _dump_sorted(fi, doc_freqs)
+
+
+# Writes items (key, value), already sorted by key, the way json.dump(dict(items), fi, indent=4, sort_keys=True)
+# would at nesting level depth, without holding them; write_value(fi, value, depth) writes a value if given
+def _dump_sorted(fi, items, depth=0, write_value=None):
+    first = True
+    for key, value in items:
+        fi.write(('{\n' if first else ',\n') + ' ' * 4 * (depth + 1) + json.dumps(key) + ': ')
+        if write_value is None:
+            fi.write(json.dumps(value))
+        else:
+            write_value(fi, value, depth + 1)
+        first = False
+    fi.write('{}' if first else '\n' + ' ' * 4 * depth + '}')
+
+
+# Runs in its own (spawned) process, so peak RSS is that of one build
+def _timed_build(que, labeled_data, directory, external, memory_budget, spill_dir):
+    start = time()
+    with open(labeled_data) as csv_file:
+        if external:
+            build_model_external(csv.DictReader(csv_file, delimiter=','), directory, memory_budget=memory_budget,
+                                 spill_dir=spill_dir)
+        else:
+            write_model(build_model(csv.DictReader(csv_file, delimiter=',')), directory)
+    try:
+        import resource  # Unix only
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    except ImportError:
+        peak_rss = None
+    que.put((time() - start, peak_rss))
+
+
+# Builds labeled_data in memory (into a temporary directory) and out of core (into the current directory),
+# reports time and peak RSS of both and whether their files are identical
+def compare_external(labeled_data, memory_budget, spill_dir=None):
+    in_memory_directory = tempfile.mkdtemp(prefix='make_model_')
+    try:
+        results = []
+        for directory, external in [(in_memory_directory, False), ('.', True)]:
+            context = get_context('spawn')
+            que = context.Queue()
+            proc = context.Process(target=_timed_build,
+                                   args=(que, labeled_data, directory, external, memory_budget, spill_dir))
+            proc.start()
+            results.append(que.get())
+            proc.join()
+
+        identical = True
+        for file_name in ["term_frequencies.json", "doc_frequencies.json", "category_counts.json"]:
+            with open(os.path.join(in_memory_directory, file_name), 'rb') as in_memory, open(file_name, 'rb') as fi:
+                identical = identical and in_memory.read() == fi.read()
+    finally:
+        shutil.rmtree(in_memory_directory)
+
+    for name, (seconds, peak_rss) in zip(["In memory", "Out of core"], results):
+        print(name, "build took", seconds, "sec, peak RSS", "n/a" if peak_rss is None else str(peak_rss) + " kB")
+    print("Identical output:", identical)
+
+
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: ./make_model labeledData.csv")
-        exit(1)
+    parser = argparse.ArgumentParser(usage="./make_model labeledData.csv [--workers N] [--compare | --update |"
+                                           " --channels DIR] [--external [--memory-budget MB] [--spill-dir DIR]]"
+                                           " [--hashed BUCKETS [--unsigned]]")
+    parser.add_argument("labeled_data")
+    parser.add_argument("--workers", type=int, default=1, help="number of processes counting the labeled data")
+    parser.add_argument("--compare", action="store_true",
+                        help="also run the serial build, check the output is identical and report speedup")
+    parser.add_argument("--update", action="store_true",
+                        help="add labeled_data to the model in the current directory instead of building a new one")
+    parser.add_argument("--channels", metavar="DIR",
+                        help="build one model per channel (first column) in one pass, written under DIR")
+    parser.add_argument("--external", action="store_true",
+                        help="out of core build, counts over the memory budget are spilled to disk (with --compare, "
+                             "the in memory build also runs and the peak RSS of both is reported)")
+    parser.add_argument("--memory-budget", type=float, default=256, help="MB of counts held in memory by --external")
+    parser.add_argument("--spill-dir", help="directory of the run files of --external, default is the system's "
+                                            "temporary directory")
+    parser.add_argument("--hashed", type=int, metavar="BUCKETS",
+                        help="also write hashed_model.bin, the model hashed into BUCKETS buckets (see hashed_model.py)")
+    parser.add_argument("--unsigned", action="store_true", help="unsigned hashing for --hashed")
+    args = parser.parse_args()
+
+    if args.compare + args.update + (args.channels is not None) > 1:
+        parser.error("--compare, --update and --channels can't be used together")
+    if args.external and (args.update or args.channels is not None or args.workers > 1):
+        parser.error("--external can't be used with --update, --channels or --workers")
+    if args.hashed is not None and (args.external or args.channels is not None):
+        parser.error("--hashed can't be used with --external or --channels")
+
+    def write_hashed(model):
+        if args.hashed is not None:
+            from hashed_model import write_hashed_model
+            write_hashed_model(model['term_frequencies'], model['doc_frequencies'], 'hashed_model.bin', args.hashed,
+                               not args.unsigned)
+
+    if args.external:
+        budget = int(args.memory_budget * 2 ** 20)
+        if args.compare:
+            compare_external(args.labeled_data, budget, args.spill_dir)
+            exit(0)
+
+        start = time()
+        with open(args.labeled_data) as csv_file:
+            external_model = build_model_external(csv.DictReader(csv_file, delimiter=','), memory_budget=budget,
+                                                  spill_dir=args.spill_dir)
+        print("Built model out of core in", time() - start, "sec,", external_model['runs'], "run(s)")
+        exit(0)
+
+    if args.channels is not None:
+        start = time()
+        with open(args.labeled_data) as csv_file:
+            channel_models = build_channel_models(csv.DictReader(csv_file, delimiter=','), workers=args.workers)
+        print("Built", len(channel_models), "channel models with", args.workers, "worker(s) in", time() - start, "sec")
+        write_channel_models(channel_models, args.channels)
+        exit(0)
+
+    if args.update:
+        my_model = load_model()
+        start = time()
+        with open(args.labeled_data) as csv_file:
+            update(my_model, csv.DictReader(csv_file, delimiter=','), workers=args.workers)
+        print("Updated model in", time() - start, "sec")
+        write_model(my_model)
+        write_hashed(my_model)
+        exit(0)
 
-    # Need to load here so that library calls above work correctly
-    wordsegment.load()
+    start = time()
+    with open(args.labeled_data) as csv_file:
+        my_model = build_model(csv.DictReader(csv_file, delimiter=','), workers=args.workers)
+    elapsed = time() - start
+    print("Built model with", args.workers, "worker(s) in", elapsed, "sec")
+    if args.workers == 1:
+        print("Normalization:", normalizer.get_stats())
 
-    with open(sys.argv[1]) as csv_file:
-        term_frequencies, doc_frequencies = generate_frequencies(csv.DictReader(csv_file, delimiter=','))
+    if args.compare:
+        start = time()
+        with open(args.labeled_data) as csv_file:
+            serial_frequencies = generate_frequencies(csv.DictReader(csv_file, delimiter=','))
+        serial_elapsed = time() - start
 
-    with open("term_frequencies.json", 'w') as fi:
-        json.dump(term_frequencies, fi, indent=4, sort_keys=True)
+        identical = (json.dumps(serial_frequencies, indent=4, sort_keys=True) ==
+                     json.dumps((my_model['term_frequencies'], my_model['doc_frequencies']), indent=4, sort_keys=True))
+        print("Serial build took", serial_elapsed, "sec, speedup:", serial_elapsed / elapsed,
+              ", identical output:", identical)
 
-    with open("doc_frequencies.json", 'w') as fi:
-        json.dump(doc_frequencies, fi, indent=4, sort_keys=True)
+    write_model(my_model)
+    write_hashed(my_model)
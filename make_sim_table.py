@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# Compiles a semantic resource (SEWordSim database or Stack Overflow word2vec model) against a trained model
+#
+# Input: term_frequencies.json (from make_model), labeledData.csv, name of the resource (see classify_test)
+# Output: <resource>_table.json.gz, loaded by classify.SimTable
+#
+# Every token of the labeled data is looked up once, as classify would (stemmed or not depending on the resource)
+# Only neighbours that stem into the model vocabulary can ever add to a score, so only those are stored
+# (neighbours outside it are kept as a score only, they still count towards num_similar)
+# Lookups are made for num_similar = limit, the largest value the table can answer, except for resources that filter
+# on similarity first (SimDB), which are asked for every neighbour so any min_similarity can be answered
+# (with the resource's own range test, see SimDB's apply_range)
+#
+# Note: Table is only valid for models with the same or a larger vocabulary (ie. the same or a lower filter_threshold)
+
+import sys
+import csv
+import gzip
+import json
+from time import time
+
+from classify import filter_words, SimTable
+from normalize import normalizer
+from classify_test import valid_models
+
+
+def compile_sim_table(sim_func, stemmed_database, messages, vocabulary, limit=10):
+    if isinstance(sim_func, SimTable):
+        raise ValueError("resource is a compiled table already, compile the resource it was made from")
+
+    keys = set()
+    for message in messages:
+        for wd in filter_words(message, segment=True):  # segmented tokens are a superset of unsegmented ones
+            if wd.isalnum():
+                keys.add(normalizer.stem(wd) if stemmed_database else wd)
+
+    # Resources with ranked() return their top neighbours before filtering on similarity (Word2Vec)
+    # otherwise the similarity range is applied first (SimDB), so ask for the whole range and every neighbour
+    if hasattr(sim_func, 'ranked'):
+        mode = 'ranked'
+    else:
+        mode = 'filtered'
+
+    words = []
+    word_ids = {}
+    table = {}
+    for key in sorted(keys):
+        if mode == 'ranked':
+            res = sim_func.ranked(key, limit)
+        else:
+            res = sim_func.scored(key, -1, 0.0, 1.0)  # SQLite reads limit -1 as no limit
+
+        entries = []
+        for word, score in res:
+            if normalizer.stem(word) in vocabulary:
+                if word not in word_ids:
+                    word_ids[word] = len(words)
+                    words.append(word)
+                entries.append([word_ids[word], float(score)])
+            else:
+                entries.append([-1, float(score)])
+
+        # Trailing neighbours outside the vocabulary can't change an answer
+        while entries and entries[-1][0] == -1:
+            entries.pop()
+
+        if entries:
+            table[key] = entries
+
+    return {'mode': mode,
+            'limit': limit,
+            'apply_range': getattr(sim_func, 'apply_range', False),
+            'stemmed_database': stemmed_database,
+            'words': words,
+            'table': table}
+
+
+if __name__ == "__main__":
+    # Fused answers are ranked across its resources for each num_similar, they don't reduce to one table
+    # and tables are compiled already
+    resources = [name for name in valid_models if name not in ['Raw', 'Fused'] and not name.endswith('Table')]
+    if len(sys.argv) not in [4, 5] or sys.argv[3] not in resources:
+        print("Usage: ./make_sim_table term_frequencies.json labeledData.csv [" + " | ".join(resources) + "] [limit]")
+        exit(1)
+
+    with open(sys.argv[1], 'r') as fi:
+        term_frequencies = json.load(fi)
+
+    model_vocabulary = set()
+    for cat in term_frequencies:
+        model_vocabulary.update(term_frequencies[cat]['counts'])
+
+    with open(sys.argv[2], 'r') as fi:
+        labeled_messages = [doc["message"] for doc in csv.DictReader(fi, delimiter=',')]
+
+    loading_func, stemmed = valid_models[sys.argv[3]]
+    num_similar_limit = int(sys.argv[4]) if len(sys.argv) == 5 else 10
+
+    start = time()
+    sim_table = compile_sim_table(loading_func(), stemmed, labeled_messages, model_vocabulary, num_similar_limit)
+    print(len(sim_table['table']), "terms,", len(sim_table['words']), "neighbours, took", time() - start, "sec")
+
+    with gzip.open(sys.argv[3] + "_table.json.gz", 'wt') as fi:
+        json.dump(sim_table, fi)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# Builds a small Word2VecSE model holding only the words that can take part in classification
+# 1) words whose stem is in the trained vocabulary (doc_frequencies.json), the only neighbours that can add to a score
+# 2) words of a sample of traffic (the labeled messages), the only words that are ever looked up
+#
+# Output: SO_vectors_subset (KeyedVectors, memory mapped by load_w2v) and SO_vectors_subset_annoy_index,
+# loaded by the Word2VecSESubset option of classify_test
+#
+# Note: Neighbours are searched among the subset only, a neighbour outside it no longer takes up one of the
+# num_similar places, so a word can be expanded into more (and other) vocabulary words than with the full model
+# Note: Subset is only valid for models with the same or a smaller vocabulary, and traffic like the sample
+#
+# Usage: ./make_w2v_subset doc_frequencies.json labeledData.csv [--trees 100] [--report]
+#        --report compares load time, memory and accuracy of Word2VecSE and Word2VecSESubset
+
+import argparse
+import csv
+import json
+from multiprocessing import get_context
+from time import time
+
+from binary_model import memory_usage
+from classify import classify_batch
+from classify_server import load_model
+from classify_test import valid_models
+from normalize import normalizer
+
+SUBSET_MODEL = 'SO_vectors_subset'
+SUBSET_INDEX = 'SO_vectors_subset_annoy_index'
+
+
+# Words of model (in model order) that stem into vocabulary or are looked up by messages
+def subset_words(model_words, vocabulary, messages):
+    queries = set()
+    for message in messages:
+        for wd in normalizer.tokens(message, segment=True):  # segmented tokens are a superset of unsegmented ones
+            if wd.isalpha():
+                queries.add(wd)
+
+    # stemmer is called directly, millions of model words would only churn the shared memoized stems
+    stemmer = normalizer.get_stemmer()
+    return [word for word in model_words if word in queries or stemmer.stem(word) in vocabulary]
+
+
+def build_subset(model, words, num_trees=100):
+    from gensim.models import KeyedVectors
+    from gensim.similarities.index import AnnoyIndexer
+
+    # gensim 4 renamed add() to add_vectors() and vocab to key_to_index
+    if hasattr(model, 'key_to_index'):
+        word_ids = model.key_to_index
+    else:
+        word_ids = {word: vocab.index for word, vocab in model.vocab.items()}
+
+    subset = KeyedVectors(model.vector_size)
+    add = subset.add_vectors if hasattr(subset, 'add_vectors') else subset.add
+    add(words, model.vectors[[word_ids[word] for word in words]])
+    subset.save(SUBSET_MODEL)
+
+    annoy_index = AnnoyIndexer(subset, num_trees)
+    annoy_index.save(SUBSET_INDEX)
+
+
+# Runs in its own (spawned) process, so each resource is measured from the same empty state
+def _measure(que, resource, rows):
+    normalizer.load()
+    tf_idf = load_model()
+    tf_idf.get_score_matrix()
+
+    loading_func, stemmed_database = valid_models[resource]
+    rss_before, dirty_before = memory_usage()
+    start = time()
+    sim_func = loading_func()
+    loaded = time() - start
+
+    start = time()
+    results = classify_batch(tf_idf, [row['message'] for row in rows], sim_func, num_similar=3, min_similarity=0.2,
+                             stemmed_database=stemmed_database)
+    classified = time() - start
+    rss_after, dirty_after = memory_usage()
+
+    categories = [category for category, score in results]
+    que.put((loaded, classified / len(rows),
+             rss_after - rss_before if rss_before is not None else None,
+             dirty_after - dirty_before if dirty_before is not None else None,
+             categories))
+
+
+def report(rows):
+    expected = [row['Category'].lower() for row in rows]  # some of the labels are inconsistent in case
+
+    print('Resource, Load sec, Sec/Document, RSS kB, Private dirty kB, Accuracy percentage, Agreement percentage')
+    first = None
+    for resource in ['Word2VecSE', 'Word2VecSESubset']:
+        context = get_context('spawn')
+        que = context.Queue()
+        proc = context.Process(target=_measure, args=(que, resource, rows))
+        proc.start()
+        loaded, per_document, rss, dirty, categories = que.get()
+        proc.join()
+
+        if first is None:
+            first = categories
+        accuracy = 100 * sum(1 for got, want in zip(categories, expected) if got == want) / len(rows)
+        agreement = 100 * sum(1 for got, want in zip(categories, first) if got == want) / len(rows)
+        print(resource, loaded, per_document, rss, dirty, accuracy, agreement, sep=', ')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="./make_w2v_subset doc_frequencies.json labeledData.csv [--trees 100]"
+                                           " [--report]")
+    parser.add_argument("doc_frequencies")
+    parser.add_argument("labeled_data")
+    parser.add_argument("--trees", type=int, default=100, help="trees of the Annoy index")
+    parser.add_argument("--report", action='store_true', help="compare against the full model after building")
+    args = parser.parse_args()
+
+    with open(args.doc_frequencies, 'r') as fi:
+        doc_frequencies = json.load(fi)
+
+    with open(args.labeled_data, 'r') as csv_file:
+        labeled_rows = list(csv.DictReader(csv_file, delimiter=','))
+
+    full_model = valid_models['Word2VecSE'][0]().model
+    model_vocabulary = full_model.index_to_key if hasattr(full_model, 'index_to_key') else full_model.index2word
+
+    start_time = time()
+    kept = subset_words(model_vocabulary, doc_frequencies, [row['message'] for row in labeled_rows])
+    build_subset(full_model, kept, args.trees)
+    print("Kept", len(kept), "of", len(model_vocabulary), "words in", time() - start_time, "sec")
+    del full_model
+
+    if args.report:
+        report(labeled_rows)
@@ -0,0 +1,169 @@
+# Optional instrumentation of the hot paths (classify_batch, build_model, similarity lookups)
+#
+# Instrumented code checks metrics.enabled before doing any work, so while no sink is set the cost is one attribute
+# test per stage
+# Sinks have record_time(stage, seconds) and record_count(name, value), Aggregator (in process) is the default one,
+# prometheus_text() renders an Aggregator in the Prometheus text exposition format
+#
+# Stages timed by classify_batch: tokenize, segment, filter, stem (from the normalizer), similarity, expand, score
+# (expand includes the similarity lookups of functors without a many() method, made one token at a time)
+# FusedSim also times similarity_<backend> (time its lookups waited on each backend) and counts similarity_timeouts
+# Counts: messages, tokens, lookups, substitutes, sim_cache_hits, sim_cache_misses
+# Stages timed by build_model: build_count, build_threshold, count: build_documents (number of labeled messages)
+#
+# profiling(mode) is a context manager for a whole run, 'cprofile' (deterministic, every call) or 'sampling'
+# (stacks of the profiled thread every interval seconds, cheaper on long runs)
+
+import cProfile
+import io
+import pstats
+import sys
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+
+class Aggregator(object):
+    def __init__(self):
+        self.times = Counter()
+        self.calls = Counter()
+        self.counts = Counter()
+        self.lock = threading.Lock()
+
+    def record_time(self, stage, seconds):
+        with self.lock:
+            self.times[stage] += seconds
+            self.calls[stage] += 1
+
+    def record_count(self, name, value=1):
+        with self.lock:
+            self.counts[name] += value
+
+    # Totals, plus the ratios asked about most (per message and per token averages, similarity cache hit rate)
+    def get_stats(self):
+        with self.lock:
+            stats = {'times': dict(self.times), 'calls': dict(self.calls), 'counts': dict(self.counts)}
+
+        counts = Counter(stats['counts'])
+        if counts['messages']:
+            stats['tokens_per_message'] = counts['tokens'] / counts['messages']
+            stats['sec_per_message'] = {stage: seconds / counts['messages'] for stage, seconds in stats['times'].items()
+                                        if not stage.startswith('build_')}
+        if counts['lookups']:
+            stats['substitutes_per_lookup'] = counts['substitutes'] / counts['lookups']
+        if counts['sim_cache_hits'] + counts['sim_cache_misses']:
+            stats['sim_cache_hit_rate'] = counts['sim_cache_hits'] / (counts['sim_cache_hits']
+                                                                      + counts['sim_cache_misses'])
+        return stats
+
+    def reset(self):
+        with self.lock:
+            self.times.clear()
+            self.calls.clear()
+            self.counts.clear()
+
+
+def prometheus_text(aggregator, prefix='tfidf_'):
+    lines = ['# TYPE ' + prefix + 'stage_seconds_total counter']
+    with aggregator.lock:
+        for stage in sorted(aggregator.times):
+            lines.append(prefix + 'stage_seconds_total{stage="' + stage + '"} ' + repr(aggregator.times[stage]))
+        lines.append('# TYPE ' + prefix + 'stage_calls_total counter')
+        for stage in sorted(aggregator.calls):
+            lines.append(prefix + 'stage_calls_total{stage="' + stage + '"} ' + str(aggregator.calls[stage]))
+        for name in sorted(aggregator.counts):
+            lines.append('# TYPE ' + prefix + name + '_total counter')
+            lines.append(prefix + name + '_total ' + str(aggregator.counts[name]))
+    return '\n'.join(lines) + '\n'
+
+
+class Metrics(object):
+    def __init__(self):
+        self.enabled = False
+        self.sink = None
+
+    # returns the sink, a new Aggregator if none is given
+    def enable(self, sink=None):
+        self.sink = Aggregator() if sink is None else sink
+        self.enabled = True
+        return self.sink
+
+    def disable(self):
+        self.enabled = False
+        self.sink = None
+
+    def time(self, stage, seconds):
+        self.sink.record_time(stage, seconds)
+
+    def count(self, name, value=1):
+        self.sink.record_count(name, value)
+
+
+# Stacks of thread, sampled every interval seconds by a background thread
+# Stacks are kept in the collapsed format of flame graph tools ('outer;inner;innermost' : samples)
+class SamplingProfiler(object):
+    def __init__(self, thread=None, interval=0.005):
+        self.thread_id = (thread or threading.current_thread()).ident
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.sampler.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.sampler.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(frame.f_code.co_name + ' (' + frame.f_code.co_filename.split('/')[-1] + ':'
+                             + str(frame.f_lineno) + ')')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def report(self, limit=20):
+        total = sum(self.stacks.values())
+        lines = [str(total) + ' samples']
+        for stack, samples in self.stacks.most_common(limit):
+            lines.append(str(samples) + ' ' + stack)
+        return '\n'.join(lines)
+
+
+# Profiles the body of the with statement, writes the report to output (default stderr) when it ends
+# mode is None (no profiling), 'cprofile' or 'sampling'
+@contextmanager
+def profiling(mode='cprofile', output=None, limit=20):
+    if mode is None:
+        yield None
+        return
+
+    output = sys.stderr if output is None else output
+    if mode == 'sampling':
+        profiler = SamplingProfiler()
+        profiler.start()
+        try:
+            yield profiler
+        finally:
+            profiler.stop()
+            print(profiler.report(limit), file=output)
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(limit)
+        print(text.getvalue(), file=output)
+
+
+# Shared by classify, make_model and the similarity functors
+metrics = Metrics()
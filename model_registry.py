@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+# Many tf-idf models (one per channel or team) in one process, under a memory budget
+#
+# Models share one TermTable, every term is interned and given an id once for all models; a model only keeps
+# an array from term id to its own row, and its weights as arrays (see SharedTFidF), instead of its own dictionaries
+# Models are loaded on first use (load(name) returns its term/doc frequencies), the least recently used ones are
+# evicted once the loaded models add up to more than max_bytes, and loaded again if asked for later
+# reload(name) and put(name, ...) build the new version of a model before swapping it in under the lock, so
+# classifications that already got the old version from get() finish on it and nothing waits for the build
+#
+# Note: Terms are never removed from the TermTable, it grows to the vocabulary of every model loaded so far
+# Note: A model only keeps the terms that can score (kept by the filter threshold of some category), so its
+# get_doc_frequencies() is limited to those
+#
+# Usage: ./model_registry models labeledData.csv [--budget MB] (models written by ./make_model --channels models)
+#        classifies every labeled message with the model of its channel, reports accuracy and memory per channel
+
+import argparse
+import csv
+import json
+import os
+import sys
+import threading
+from collections import OrderedDict
+from time import time
+
+import numpy as np
+
+from classify import TFidF, ScoreMatrix, classify_batch
+
+
+# Terms of every model of a registry, a term's position is its id in all of them
+class TermTable(object):
+    def __init__(self):
+        self.ids = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, word, default=None):
+        return self.ids.get(word, default)
+
+    # ids of words, new words are added
+    def add(self, words):
+        with self.lock:
+            for word in words:
+                if word not in self.ids:
+                    self.ids[sys.intern(word)] = len(self.ids)
+            return [self.ids[word] for word in words]
+
+
+# Rows of one model, get(word) returns the row of word (or None) as ScoreMatrix wants
+# rows covers the ids of the table when the model was built, terms added later are in other models only
+class ModelTerms(object):
+    def __init__(self, terms, rows):
+        self.terms = terms
+        self.rows = rows
+
+    def get(self, word, default=None):
+        term_id = self.terms.get(word)
+        if term_id is None or term_id >= len(self.rows) or self.rows[term_id] < 0:
+            return default
+        return int(self.rows[term_id])
+
+
+# TFidF over a shared TermTable, with counts and tf-idf weights as arrays (one column per category)
+# get_term_frequencies() and get_doc_frequencies() rebuild the dictionaries on first use, classifying doesn't need them
+class SharedTFidF(TFidF):
+    def __init__(self, term_freqs, doc_freqs, terms):
+        self.categories = list(term_freqs.keys())
+        self.category_ids = {cat: c for c, cat in enumerate(self.categories)}
+        self.num_docs = [term_freqs[cat]['num_docs'] for cat in self.categories]
+
+        vocabulary = list(dict.fromkeys(word for cat in self.categories for word in term_freqs[cat]['counts']))
+        term_ids = terms.add(vocabulary)
+        self.vocabulary = [sys.intern(word) for word in vocabulary]
+        self.rows = np.full(len(terms), -1, dtype=np.int32)
+        self.rows[term_ids] = np.arange(len(vocabulary), dtype=np.int32)
+
+        # weights are computed by TFidF itself, so both score exactly the same
+        tf_idf = TFidF(term_freqs, doc_freqs)
+        self.doc_freqs = np.array([doc_freqs[word] for word in vocabulary], dtype=np.int32)
+        self.counts = np.zeros((len(vocabulary), len(self.categories)), dtype=np.int32)
+        self.weights = np.zeros((len(vocabulary), len(self.categories)))
+        for c, cat in enumerate(self.categories):
+            for word, count in term_freqs[cat]['counts'].items():
+                row = self.rows[terms.get(word)]
+                self.counts[row, c] = count
+                self.weights[row, c] = tf_idf(word, cat)
+
+        self.terms = ModelTerms(terms, self.rows)
+        self.nbytes = (self.rows.nbytes + self.doc_freqs.nbytes + self.counts.nbytes + self.weights.nbytes
+                       + sys.getsizeof(self.vocabulary))
+        self.version = None
+
+        super().__init__(None, None)
+        self.score_matrix = ScoreMatrix(self.categories, self.terms, self.weights)
+
+    def __call__(self, word, category):
+        row = self.terms.get(word)
+        cat_id = self.category_ids.get(category)
+        if row is None or cat_id is None or self.counts[row, cat_id] == 0:
+            return 0
+        return float(self.weights[row, cat_id])
+
+    def get_categories(self):
+        return self.categories
+
+    def get_term_frequencies(self):
+        if self.term_frequencies is None:
+            self.term_frequencies = {}
+            for c, cat in enumerate(self.categories):
+                present = np.flatnonzero(self.counts[:, c])
+                self.term_frequencies[cat] = {'num_docs': self.num_docs[c],
+                                              'counts': {self.vocabulary[i]: int(self.counts[i, c]) for i in present}}
+        return self.term_frequencies
+
+    def get_doc_frequencies(self):
+        if self.doc_frequencies is None:
+            self.doc_frequencies = {word: int(doc_freq) for word, doc_freq in zip(self.vocabulary, self.doc_freqs)}
+        return self.doc_frequencies
+
+
+# Models by name, load(name) returns the pair (term frequencies, doc frequencies) of a model, see channel_loader
+# get() returns a SharedTFidF, its version counts the times name was loaded or put
+class ModelRegistry(object):
+    def __init__(self, load, max_bytes=256 * 2 ** 20, terms=None):
+        self.load = load
+        self.max_bytes = max_bytes
+        self.terms = TermTable() if terms is None else terms
+        self.models = OrderedDict()  # least recently used first
+        self.versions = {}
+        self.loading = {}  # name -> Lock, so concurrent first uses of a name load it once
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def get(self, name):
+        with self.lock:
+            if name in self.models:
+                self.models.move_to_end(name)
+                self.hits += 1
+                return self.models[name]
+            load_lock = self.loading.setdefault(name, threading.Lock())
+
+        with load_lock:
+            with self.lock:
+                if name in self.models:
+                    self.models.move_to_end(name)
+                    self.hits += 1
+                    return self.models[name]
+            return self.reload(name)
+
+    # Loads name again, returns the new version (already swapped in)
+    def reload(self, name):
+        term_freqs, doc_freqs = self.load(name)
+        with self.lock:
+            self.loads += 1
+        return self.put(name, term_freqs, doc_freqs)
+
+    # Builds a model from term/doc frequencies and swaps it in as the current version of name
+    def put(self, name, term_freqs, doc_freqs):
+        model = SharedTFidF(term_freqs, doc_freqs, self.terms)
+
+        with self.lock:
+            model.version = self.versions.get(name, 0) + 1
+            self.versions[name] = model.version
+            self.models[name] = model
+            self.models.move_to_end(name)
+
+            # the model just put is the most recently used, it stays even on its own over budget
+            total = sum(loaded.nbytes for loaded in self.models.values())
+            while total > self.max_bytes and len(self.models) > 1:
+                evicted_name, evicted = self.models.popitem(last=False)
+                total -= evicted.nbytes
+                self.evictions += 1
+
+        return model
+
+    def discard(self, name):
+        with self.lock:
+            self.models.pop(name, None)
+
+    def get_stats(self):
+        with self.lock:
+            return {'models': list(self.models),
+                    'bytes': sum(model.nbytes for model in self.models.values()),
+                    'max_bytes': self.max_bytes,
+                    'terms': len(self.terms),
+                    'hits': self.hits,
+                    'loads': self.loads,
+                    'evictions': self.evictions}
+
+
+# Loader of the models written by ./make_model --channels directory, channels.json is read again on every load so
+# channels added since are found
+def channel_loader(directory):
+    def load(name):
+        with open(os.path.join(directory, 'channels.json'), 'r') as fi:
+            model_directory = os.path.join(directory, json.load(fi)[name])
+
+        with open(os.path.join(model_directory, 'term_frequencies.json'), 'r') as fi:
+            term_frequencies = json.load(fi)
+
+        with open(os.path.join(model_directory, 'doc_frequencies.json'), 'r') as fi:
+            doc_frequencies = json.load(fi)
+
+        return term_frequencies, doc_frequencies
+
+    return load
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="./model_registry models labeledData.csv [--budget MB]")
+    parser.add_argument("models", help="directory written by ./make_model --channels")
+    parser.add_argument("labeled_data")
+    parser.add_argument("--budget", type=float, default=256, help="MB of models kept loaded")
+    args = parser.parse_args()
+
+    registry = ModelRegistry(channel_loader(args.models), int(args.budget * 2 ** 20))
+
+    with open(args.labeled_data, 'r') as csv_file:
+        by_channel = OrderedDict()
+        for row in csv.DictReader(csv_file, delimiter=','):
+            by_channel.setdefault(row['Channel'], []).append(row)
+
+    print('Channel, Documents, Accuracy percentage, Model kB, Sec/Document')
+    for channel, rows in by_channel.items():
+        start = time()
+        channel_model = registry.get(channel)
+        results = classify_batch(channel_model, [row['message'] for row in rows])
+        elapsed = time() - start
+
+        num_match = sum(1 for (category, score), row in zip(results, rows) if category == row['Category'].lower())
+        print(channel, len(rows), 100 * num_match / len(rows), channel_model.nbytes / 1024, elapsed / len(rows),
+              sep=', ')
+
+    print(registry.get_stats())
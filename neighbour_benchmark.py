@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+# Word2VecSE neighbour lookups, per token against batched (see BatchedWord2Vec)
+# annoy: Word2Vec.ranked once per token of every message, as classify does without batching
+# batched annoy: one ranked_many per batch of messages, each distinct word asked once
+# batched exact: one ranked_many per batch of messages, matrix products over the memory mapped vectors
+#
+# Recall is the share of the exact num_similar neighbours that the Annoy index also finds, averaged over words
+# Words are the unstemmed lookups of the labeled messages (Word2VecSE doesn't use a stemmed database)
+#
+# Usage: ./neighbour_benchmark labeledData.csv [num_messages] [batch_size]
+
+import csv
+import sys
+from collections import Counter
+from time import perf_counter
+
+from classify import BatchedWord2Vec, lookup_words
+from classify_test import load_w2v
+from normalize import normalizer
+
+NUM_SIMILAR = 10
+
+
+def benchmark(messages, batch_size=64):
+    annoy = load_w2v()
+    batched_annoy = BatchedWord2Vec(annoy.model, annoy.index, exact=False)
+    batched_exact = BatchedWord2Vec(annoy.model)
+
+    batches = []
+    for i in range(0, len(messages), batch_size):
+        batches.append([lookup_words(Counter(normalizer.pairs(message)), False)
+                        for message in messages[i:i + batch_size]])
+    num_tokens = sum(len(words) for batch in batches for words in batch)
+
+    start = perf_counter()
+    found = {}
+    for batch in batches:
+        for words in batch:
+            for wd in words:
+                found[wd] = annoy.ranked(wd, NUM_SIMILAR)
+    annoy_time = perf_counter() - start
+
+    timings = []
+    for sim_func in [batched_annoy, batched_exact]:
+        exact = {}
+        start = perf_counter()
+        for batch in batches:
+            words = list(dict.fromkeys(wd for words in batch for wd in words))
+            exact.update(sim_func.ranked_many(words, NUM_SIMILAR))
+        timings.append(perf_counter() - start)
+
+    recalls = []
+    for wd, neighbours in exact.items():
+        if neighbours:
+            expected = set(word for word, score in neighbours)
+            recalls.append(len(expected.intersection(word for word, score in found[wd])) / len(expected))
+
+    print('Path, Tokens/sec, Sec/Message')
+    for name, seconds in [('annoy', annoy_time), ('batched annoy', timings[0]), ('batched exact', timings[1])]:
+        print(name, num_tokens / seconds, seconds / len(messages), sep=', ')
+    print('Annoy recall@' + str(NUM_SIMILAR) + ', ' + str(sum(recalls) / len(recalls) if recalls else 0.0))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [2, 3, 4]:
+        print("Usage: ./neighbour_benchmark labeledData.csv [num_messages] [batch_size]")
+        exit(1)
+
+    with open(sys.argv[1], 'r') as csv_file:
+        labeled_messages = [row['message'] for row in csv.DictReader(csv_file, delimiter=',')]
+    if len(sys.argv) >= 3:
+        labeled_messages = labeled_messages[:int(sys.argv[2])]
+
+    benchmark(labeled_messages, int(sys.argv[3]) if len(sys.argv) == 4 else 64)
@@ -0,0 +1,160 @@
+# Text normalization shared by make_model (training) and classify
+# lowercase -> word_tokenize -> wordsegment.segment -> stop word / alphanumeric filter -> PorterStemmer.stem
+#
+# Segmentation and stemming results are memoized per token (LRU, bounded by cache_size), the same few thousand
+# tokens make up most of every message
+# Time spent in each stage is accumulated, see get_stats()
+#
+# NLTK and the segmentation data are loaded on first use (importing nltk alone takes about a second), so importing
+# this module is cheap and segmentation data is never loaded while segment is False
+# Segmentation uses the memory mapped tables of segment_table.py if segment_tables exists, else wordsegment's own
+# (parsed from its text files), both segment the same
+
+import os
+import re
+import threading
+from collections import Counter
+from functools import lru_cache
+from time import perf_counter
+
+# Written by ./segment_table
+SEGMENT_TABLES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'segment_tables.bin')
+
+# re's \w is str.isalnum() plus the underscore, so this finds any alphanumeric character
+alnum_pattern = re.compile(r'[^\W_]')
+
+
+def has_alnum(wd):
+    return alnum_pattern.search(wd) is not None
+
+
+class Normalizer(object):
+    def __init__(self, cache_size=100000, segment_tables=SEGMENT_TABLES):
+        self.segment_tables = segment_tables
+        self.tokenizer = None
+        self.stop_words = None
+        self.stemmer = None
+        self.segmenter = None
+        self.lock = threading.Lock()
+
+        self.stem = lru_cache(maxsize=cache_size)(lambda wd: self.get_stemmer().stem(wd))
+        self._segment = lru_cache(maxsize=cache_size)(lambda wd: tuple(self.get_segmenter().segment(wd)))
+
+        self.times = Counter()
+        self.counts = Counter()
+
+    def get_tokenizer(self):
+        if self.tokenizer is None:
+            from nltk.tokenize import word_tokenize
+            # from nltk.tokenize import RegexpTokenizer
+            self.tokenizer = word_tokenize
+        return self.tokenizer
+
+    def get_stop_words(self):
+        if self.stop_words is None:
+            from nltk.corpus import stopwords
+            self.stop_words = set(stopwords.words('english'))
+        return self.stop_words
+
+    def get_stemmer(self):
+        if self.stemmer is None:
+            from nltk.stem.snowball import PorterStemmer
+            self.stemmer = PorterStemmer()
+        return self.stemmer
+
+    # Locked, so threads classifying their first messages together load the data once
+    def get_segmenter(self):
+        if self.segmenter is None:
+            with self.lock:
+                if self.segmenter is None:
+                    if self.segment_tables is not None and os.path.exists(self.segment_tables):
+                        from segment_table import MappedSegmenter
+                        segmenter = MappedSegmenter(self.segment_tables)
+                    else:
+                        import wordsegment
+                        segmenter = wordsegment.Segmenter()
+                    segmenter.load()
+                    self.segmenter = segmenter
+        return self.segmenter
+
+    # Loads everything up front, for long running processes that would rather not pay on their first message
+    def load(self, segment=True):
+        self.get_tokenizer()
+        self.get_stop_words()
+        self.get_stemmer()
+        if segment:
+            self.get_segmenter()
+
+    # Segments of wd, example 'artstation' --> ('art', 'station')
+    def segment(self, wd):
+        return self._segment(wd)
+
+    # Generator of the (unstemmed) words of message that take part in classification
+    # Words with segments are followed by their segments, if segment is True
+    def tokens(self, message, segment=True):
+        yield from self._filtered(message, segment)
+
+    # List version of tokens
+    def _filtered(self, message, segment=True):
+        start = perf_counter()
+        # NOTE: 2/27/20 -- Found forgot to call lower here
+        words = self.get_tokenizer()(message.lower().strip())
+        tokenized = perf_counter()
+
+        if segment:
+            segmented_words = []
+            for wd in words:
+                segmented_words.append(wd)
+                segments = self._segment(wd)
+                if len(segments) > 1:
+                    segmented_words.extend(segments)
+        else:
+            segmented_words = words
+        segmented = perf_counter()
+
+        # leaves non word things like '?', and "`" out
+        stop_words = self.get_stop_words()
+        filtered = [wd for wd in segmented_words if wd not in stop_words and has_alnum(wd)]
+        end = perf_counter()
+
+        self.times['tokenize'] += tokenized - start
+        self.times['segment'] += segmented - tokenized
+        self.times['filter'] += end - segmented
+        self.counts['messages'] += 1
+        self.counts['tokens'] += len(words)
+        self.counts['segmented'] += len(segmented_words)
+        self.counts['filtered'] += len(filtered)
+
+        return filtered
+
+    # Generator of (word, stemmed word) pairs of message
+    def pairs(self, message, segment=True):
+        filtered = self._filtered(message, segment)
+
+        start = perf_counter()
+        stemmed = [self.stem(wd) for wd in filtered]
+        self.times['stem'] += perf_counter() - start
+
+        yield from zip(filtered, stemmed)
+
+    # Generator of the stemmed words of message, as counted by make_model
+    def stems(self, message, segment=True):
+        for wd, stem in self.pairs(message, segment):
+            yield stem
+
+    # Accumulated seconds per stage, counts of messages/tokens and hit rates of the memoized stages
+    def get_stats(self):
+        stats = {'times': dict(self.times), 'counts': dict(self.counts)}
+        for name, cached in [('stem', self.stem), ('segment', self._segment)]:
+            info = cached.cache_info()
+            total = info.hits + info.misses
+            stats[name + '_cache_hit_rate'] = info.hits / total if total else 0.0
+        return stats
+
+    def reset_stats(self):
+        self.times.clear()
+        self.counts.clear()
+
+
+# Shared by classify and make_model, so both reuse the same memoized results
+normalizer = Normalizer()
@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+
+# Per message latency of the two scoring paths of classify_batch, as the number of categories grows
+# matrix: one sparse matrix product per message (batch of 1)
+# postings: walk of the inverted index, with and without early stopping
+#
+# Models are synthetic (see binary_model.synthetic_model), messages are random expansions of num_terms terms,
+# so only scoring is timed (no normalization or thesaurus lookups)
+#
+# Usage: ./scoring_benchmark [num_categories ...]
+
+import sys
+import random
+from time import perf_counter
+
+from binary_model import synthetic_model
+from classify import TFidF, score_expansions
+
+
+def random_expansions(vocabulary, num_messages=500, num_terms=20, seed=1):
+    rand = random.Random(seed)
+    return [{word: rand.choice([1, 1, 1, 4, 9]) for word in rand.sample(vocabulary, num_terms)}
+            for _ in range(num_messages)]
+
+
+def time_per_message(score, expansions):
+    start = perf_counter()
+    for expansion in expansions:
+        score(expansion)
+    return (perf_counter() - start) / len(expansions)
+
+
+def benchmark(category_counts=(9, 50, 100, 200, 500), num_terms=20000):
+    print('Categories, Matrix us/message, Postings us/message, Postings early stop us/message')
+    for num_categories in category_counts:
+        term_frequencies, doc_frequencies = synthetic_model(num_terms, num_categories)
+        tf_idf = TFidF(term_frequencies, doc_frequencies)
+        posting_index = tf_idf.get_posting_index()
+        tf_idf.get_score_matrix()
+
+        expansions = random_expansions(list(doc_frequencies))
+        timings = [time_per_message((lambda expansion: score_expansions(tf_idf, [expansion])), expansions),
+                   time_per_message((lambda expansion: posting_index.score(expansion, early_stop=False)), expansions),
+                   time_per_message((lambda expansion: posting_index.score(expansion, early_stop=True)), expansions)]
+        print(num_categories, *[1e6 * t for t in timings], sep=', ')
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        benchmark([int(arg) for arg in sys.argv[1:]])
+    else:
+        benchmark()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# Startup cost of each entry point (classify, classify_test, classify_gui, make_model), each run in a fresh process
+# Import sec: importing the entry point module
+# First sec: its first classification (for make_model, counting the first labeled message), which loads NLTK and,
+#            when segmenting, the segmentation data
+# Second sec: the next message, the warm cost to compare against
+#
+# Each entry point runs segmenting and not segmenting, and when segment_tables.bin exists (see segment_table.py)
+# with the mapped tables and with wordsegment's own text files
+# The model (json, built from labeledData.csv once) is loaded between import and first classification, not timed
+#
+# Usage: ./startup_benchmark labeledData.csv [--repeat 3]
+
+import argparse
+import csv
+import json
+import os
+import shutil
+import tempfile
+from multiprocessing import get_context
+from time import perf_counter
+
+ENTRY_POINTS = ['classify', 'classify_test', 'classify_gui', 'make_model']
+
+
+# Runs in its own (spawned) process, so nothing is imported or loaded yet
+def _measure(que, entry_point, directory, rows, segment, tables):
+    import importlib
+
+    start = perf_counter()
+    module = importlib.import_module(entry_point)
+    imported = perf_counter() - start
+
+    from normalize import normalizer
+    if not tables:
+        normalizer.segment_tables = None
+
+    if entry_point == 'make_model':
+        def first_use(row):
+            module.count_documents([row])
+    else:
+        from classify import load_tf_idf, classify
+        tf_idf = load_tf_idf([os.path.join(directory, 'term_frequencies.json'),
+                              os.path.join(directory, 'doc_frequencies.json')])
+
+        def first_use(row):
+            classify(tf_idf, row['message'], segment=segment)
+
+    timings = []
+    for row in rows[:2]:
+        start = perf_counter()
+        first_use(row)
+        timings.append(perf_counter() - start)
+
+    que.put((imported, timings[0], timings[1]))
+
+
+def measure(entry_point, directory, rows, segment, tables, repeat=3):
+    best = None
+    for _ in range(repeat):
+        context = get_context('spawn')
+        que = context.Queue()
+        proc = context.Process(target=_measure, args=(que, entry_point, directory, rows, segment, tables))
+        proc.start()
+        result = que.get()
+        proc.join()
+        best = result if best is None else tuple(min(pair) for pair in zip(best, result))
+    return best
+
+
+def benchmark(labeled_rows, repeat=3):
+    from make_model import generate_frequencies
+    from normalize import SEGMENT_TABLES
+
+    directory = tempfile.mkdtemp(prefix='startup_')
+    try:
+        term_frequencies, doc_frequencies = generate_frequencies(labeled_rows)
+        with open(os.path.join(directory, 'term_frequencies.json'), 'w') as fi:
+            json.dump(term_frequencies, fi)
+        with open(os.path.join(directory, 'doc_frequencies.json'), 'w') as fi:
+            json.dump(doc_frequencies, fi)
+
+        rows = [{'Category': row['Category'], 'message': row['message']} for row in labeled_rows[:2]]
+        table_options = [True, False] if os.path.exists(SEGMENT_TABLES) else [False]
+        configurations = [(True, tables) for tables in table_options] + [(False, False)]
+
+        print('Entry point, Segment, Segment tables, Import sec, First sec, Second sec')
+        for entry_point in ENTRY_POINTS:
+            for segment, tables in configurations:
+                if entry_point == 'make_model' and not segment:
+                    continue  # make_model always segments
+                imported, first, second = measure(entry_point, directory, rows, segment, tables, repeat)
+                print(entry_point, segment, tables, imported, first, second, sep=', ')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage="./startup_benchmark labeledData.csv [--repeat 3]")
+    parser.add_argument("labeled_data")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per row, the fastest of each column is kept")
+    args = parser.parse_args()
+
+    with open(args.labeled_data, 'r') as csv_file:
+        benchmark(list(csv.DictReader(csv_file, delimiter=',')), args.repeat)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+# Parallel version of the classify_test.py experiments (same columns), over a process pool
+#
+# Work shared by every cell of the grid is done once, before the pool starts:
+# 1) labeled data is read, counted (unfiltered) and normalized (tokenized, segmented, filtered, stemmed) once
+# 2) the semantic resource is compiled into an in memory table (see make_sim_table.py) at the largest num_similar,
+#    which answers every smaller num_similar and min_similarity exactly
+# 3) models for each filter threshold are derived from the one set of unfiltered counts (see apply_threshold)
+#
+# Cells (filter threshold x num similar x min similarity) are then spread across the pool, rows are appended to the
+# output csv as cells finish, and a sweep started again with the same output skips the cells already in it
+# Sec/Document only covers the work of the cell (expansion and scoring), not the shared steps above
+#
+# Usage: ./sweep labeledData.csv [Raw | WordSimSEDB | Word2VecSE] [True | False] [--workers N] [--output sweep.csv]
+#                [--thresholds 0 10 ...]
+
+import argparse
+import csv
+import os
+from collections import Counter
+from multiprocessing import Pool
+from time import time
+
+from classify import TFidF, SimTable, expand_words, score_expansions
+from classify_test import valid_models
+from make_model import count_documents, apply_threshold
+from make_sim_table import compile_sim_table
+from normalize import normalizer
+
+COLUMNS = ['Accuracy percentage', 'Zeros percentage', 'Average score', 'Filter Threshold %', 'Num similar terms',
+           'Min similarity %', 'Sec/Document']
+
+# Same grid as classify_test.py
+NUM_SIMILAR = range(1, 11, 1)
+MIN_SIMILARITY = range(0, 101, 10)
+
+# Shared data of the worker processes, set by _init_worker
+_shared = {}
+
+
+# filter_threshold is in the units of classify_test.py (0 to 100, times 0.0001)
+# Counts of the cell over documents start to end: docs, matches, zeros, the sum of scores and the seconds it took
+def count_cell(shared, models, filter_threshold, num_similar, min_similarity, start=0, end=None):
+    if filter_threshold not in models:
+        term_frequencies, doc_frequencies = apply_threshold(shared['categories'], filter_threshold * 0.0001)
+        models[filter_threshold] = TFidF(term_frequencies, doc_frequencies)
+    my_idf = models[filter_threshold]
+
+    began = time()
+    expansions = [expand_words(words, shared['sim_func'], num_similar, 0.01 * min_similarity,
+                               shared['stemmed_database'])
+                  for words in shared['documents'][start:end]]
+    results = score_expansions(my_idf, expansions)
+    elapsed = time() - began
+
+    return {'docs': len(results),
+            'matches': sum(1 for (category, score), expected in zip(results, shared['expected'][start:end])
+                           if category == expected),
+            'zeros': sum(1 for category, score in results if score == 0),
+            'score': sum(score for category, score in results),
+            'seconds': elapsed}
+
+
+# Row of COLUMNS from the counts of a whole cell
+def cell_row(filter_threshold, num_similar, min_similarity, counts):
+    num_docs = counts['docs']
+    return [100 * counts['matches'] / num_docs, 100 * counts['zeros'] / num_docs, counts['score'] / num_docs,
+            filter_threshold / 100, num_similar, min_similarity, counts['seconds'] / num_docs]
+
+
+def evaluate_cell(shared, models, filter_threshold, num_similar, min_similarity):
+    return cell_row(filter_threshold, num_similar, min_similarity,
+                    count_cell(shared, models, filter_threshold, num_similar, min_similarity))
+
+
+def prepare(labeled_data, resource, segment, limit=max(NUM_SIMILAR)):
+    expected = [doc["Category"].lower() for doc in labeled_data]  # some of the labels are inconsistent in case
+    messages = [doc["message"] for doc in labeled_data]
+
+    categories = count_documents(labeled_data)
+    documents = [Counter(normalizer.pairs(message, segment)) for message in messages]
+
+    loading_func, stemmed_database = valid_models[resource]
+    sim_func = loading_func()
+    if sim_func is not None:
+        vocabulary = set()
+        for cat in categories:
+            vocabulary.update(categories[cat]['counts'])
+        sim_func = SimTable(compile_sim_table(sim_func, stemmed_database, messages, vocabulary, limit))
+
+    return {'categories': categories,
+            'documents': documents,
+            'expected': expected,
+            'sim_func': sim_func,
+            'stemmed_database': stemmed_database}
+
+
+def _init_worker(shared):
+    _shared.update(shared)
+    _shared['models'] = {}
+
+
+def _evaluate(cell):
+    return evaluate_cell(_shared, _shared['models'], *cell)
+
+
+# Cells already in output, as (filter threshold, num similar, min similarity)
+# A row cut short by an interrupted sweep is removed, its cell runs again
+def finished_cells(output):
+    if not os.path.exists(output):
+        return set()
+
+    with open(output, 'r') as fi:
+        content = fi.read()
+    if content and not content.endswith('\n'):
+        with open(output, 'w') as fi:
+            fi.write(content[:content.rfind('\n') + 1])
+
+    with open(output, 'r') as fi:
+        return {(round(float(row['Filter Threshold %']) * 100), int(row['Num similar terms']),
+                 int(row['Min similarity %']))
+                for row in csv.DictReader(fi)}
+
+
+# Cells of the grid not in output yet, in the order of classify_test.py
+def remaining_cells(output, thresholds=(0,)):
+    done = finished_cells(output)
+    return [(filter_threshold, num_similar, min_similarity)
+            for filter_threshold in thresholds
+            for num_similar in NUM_SIMILAR
+            for min_similarity in MIN_SIMILARITY
+            if (filter_threshold, num_similar, min_similarity) not in done]
+
+
+def run_sweep(shared, output, thresholds=(0,), workers=1):
+    cells = remaining_cells(output, thresholds)
+
+    new_file = not os.path.exists(output) or os.path.getsize(output) == 0  # killed before the header was written
+    with open(output, 'a', newline='') as fi:
+        writer = csv.writer(fi)
+        if new_file:
+            writer.writerow(COLUMNS)
+
+        with Pool(workers, initializer=_init_worker, initargs=(shared,)) as pool:
+            for row in pool.imap_unordered(_evaluate, cells):
+                writer.writerow(row)
+                fi.flush()
+                print(*row, sep=", ")
+
+    return len(cells)
+
+
+if __name__ == "__main__":
+    # the resource is compiled to a table (see prepare), which Fused answers can't be
+    resources = [name for name in valid_models if name != 'Fused']
+    parser = argparse.ArgumentParser(usage="./sweep labeledData.csv [" + " | ".join(resources) + "]"
+                                           " [True | False] [--workers N] [--output sweep.csv] [--thresholds 0 10 ...]")
+    parser.add_argument("labeled_data")
+    parser.add_argument("resource", choices=resources)
+    parser.add_argument("segment", choices=['True', 'False'])
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--output", default='sweep.csv')
+    parser.add_argument("--thresholds", type=int, nargs='+', default=[0],
+                        help="filter thresholds, in classify_test.py units (0 to 100)")
+    args = parser.parse_args()
+
+    print("Preparing shared data")
+    start_time = time()
+    with open(args.labeled_data, 'r') as csv_file:
+        rows = list(csv.DictReader(csv_file, delimiter=','))
+    shared_data = prepare(rows, args.resource, args.segment == 'True')
+    print("Took", time() - start_time, "sec\n")
+
+    print(*COLUMNS, sep=", ")
+    start_time = time()
+    num_cells = run_sweep(shared_data, args.output, args.thresholds, args.workers)
+    print("\n" + str(num_cells), "cells in", time() - start_time, "sec")
@@ -0,0 +1,5 @@
+# The modules under test live in the project directory, next to this one
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,331 @@
+# Checks that the code paths meant to give the same answers do: scoring by matrix and by postings, classify and
+# classify_batch, SimCache and the functor it wraps, the ways of building a model, and a SimTable, an IndexedSimDB and
+# the SimDB they stand in for
+# Models are synthetic (see binary_model.synthetic_model) and semantic resources are fakes, so no data files are needed
+#
+# Usage: python -m pytest tests
+
+import filecmp
+import os
+import random
+import sqlite3
+from collections import Counter
+
+import pytest
+
+from binary_model import synthetic_model
+from classify import (TFidF, SimDB, IndexedSimDB, SimCache, SimTable, PartialAnswer, classify, classify_batch,
+                      classify_ranked, score_expansions)
+from make_model import build_model, build_model_external, count_documents_parallel, threshold_model, update, \
+    write_model
+from make_sim_table import compile_sim_table
+from normalize import normalizer
+
+NUM_TERMS = 300
+
+
+# Up to 10 neighbours of 'termN', similarities in steps of 0.1 so neighbours often tie, some of them outside the model
+def fake_neighbours(wd):
+    if not wd.startswith('term'):
+        return []
+    rand = random.Random(wd)
+    neighbours = []
+    for i in range(rand.randint(0, 10)):
+        word = 'term' + str(rand.randrange(NUM_TERMS)) if rand.random() < 0.8 else 'other' + str(rand.randrange(50))
+        neighbours.append((word, round(1.0 - 0.1 * (i // 2), 1)))
+    return neighbours
+
+
+# Filtered on similarity, then limited (like SimDB)
+class FakeSim(object):
+    prefix_limited = True
+
+    def __init__(self):
+        self.calls = 0
+
+    def scored(self, wd, num_similar, min_similarity, max_similarity=1.0):
+        self.calls += 1
+        found = [(word, score) for word, score in fake_neighbours(wd) if min_similarity <= score <= max_similarity]
+        return found if num_similar < 0 else found[:num_similar]
+
+    def __call__(self, wd, num_similar, min_similarity, max_similarity=1.0):
+        return [word for word, score in self.scored(wd, num_similar, min_similarity, max_similarity)]
+
+    def many(self, words, num_similar, min_similarity, max_similarity=1.0):
+        return {wd: self(wd, num_similar, min_similarity, max_similarity) for wd in words}
+
+
+# Limited, then filtered on similarity (like Word2Vec)
+class FakeRankedSim(object):
+    def __init__(self):
+        self.calls = 0
+
+    def ranked(self, wd, num_similar):
+        self.calls += 1
+        return fake_neighbours(wd)[:num_similar]
+
+    def __call__(self, wd, num_similar, min_similarity, max_similarity=1.0):
+        return [word for word, score in self.ranked(wd, num_similar) if min_similarity <= score <= max_similarity]
+
+
+# Neither ranked nor prefix_limited, every query is its own entry in a SimCache
+class FakePlainSim(FakeSim):
+    prefix_limited = False
+
+
+# Always missing part of its answer (like a FusedSim whose backend timed out)
+class FakePartialSim(FakeSim):
+    def __call__(self, wd, num_similar, min_similarity, max_similarity=1.0):
+        return PartialAnswer(FakeSim.__call__(self, wd, num_similar, min_similarity, max_similarity))
+
+
+# Few categories and small whole counts, so scores often tie exactly or to within rounding
+def tie_model(seed):
+    rand = random.Random(seed)
+    categories = ['c' + str(c) for c in range(40)]
+    term_freqs = {cat: {'num_docs': 10, 'counts': {}} for cat in categories}
+    doc_freqs = {}
+    for t in range(80):
+        word = 't' + str(t)
+        in_categories = rand.sample(categories, rand.randint(1, 8))
+        for cat in in_categories:
+            term_freqs[cat]['counts'][word] = rand.choice([1, 2, 3, 7, 10])
+        doc_freqs[word] = len(in_categories)
+    return TFidF(term_freqs, doc_freqs)
+
+
+def random_expansions(rand, vocabulary, count):
+    return [Counter({wd: rand.randint(1, 3) for wd in rand.sample(vocabulary, rand.randint(1, 15))})
+            for _ in range(count)]
+
+
+def random_messages(rand, count):
+    words = ['term' + str(t) for t in range(NUM_TERMS)] + ['other1', 'the', 'is', '?']
+    return [' '.join(rand.choice(words) for _ in range(rand.randint(0, 12))) for _ in range(count)]
+
+
+@pytest.fixture(scope='module')
+def model():
+    return TFidF(*synthetic_model(NUM_TERMS, num_categories=12, seed=1))
+
+
+# Scores of the same category agree to within rounding, and the category does unless the best two scores do
+def assert_same_result(expected, found):
+    if found[0] != expected[0]:
+        assert found[1] == pytest.approx(expected[1], rel=1e-9)
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_postings_match_matrix(seed):
+    tf_idf = tie_model(seed)
+    rand = random.Random(seed)
+    expansions = random_expansions(rand, list(tf_idf.get_doc_frequencies()) + ['unknown'], 100)
+    posting_index = tf_idf.get_posting_index()
+
+    # more than ScoreMatrix.dense_batch expansions go through the sparse product, one at a time through the dense path
+    batched = score_expansions(tf_idf, expansions)
+    for expansion, expected in zip(expansions, batched):
+        assert score_expansions(tf_idf, [expansion])[0] == expected
+
+        walked = posting_index.score(expansion, early_stop=False)
+        assert_same_result(expected, walked)
+        assert_same_result(walked, posting_index.score(expansion))
+
+
+@pytest.mark.parametrize('sim_func', [None, FakeSim(), FakeRankedSim()], ids=['Raw', 'filtered', 'ranked'])
+def test_classify_matches_batch(model, sim_func):
+    messages = random_messages(random.Random(2), 40)
+    options = {'sim_func': sim_func, 'num_similar': 3, 'min_similarity': 0.5, 'stemmed_database': False,
+               'segment': False}
+
+    batched = classify_batch(model, messages, **options)
+    walked = classify_batch(model, messages, scoring='postings', **options)
+    for message, expected, found in zip(messages, batched, walked):
+        assert classify(model, message, **options) == expected
+        assert_same_result(expected, found)
+
+        ranked = classify_ranked(model, message, top_k=3, **options)
+        assert (ranked[0][:2] if ranked else (None, 0)) == expected
+
+
+def test_sim_cache_plain():
+    sim_func = FakePlainSim()
+    cache = SimCache(sim_func)
+    for wd in ['term1', 'term2', 'term1']:
+        assert cache(wd, 5, 0.3) == sim_func(wd, 5, 0.3)
+    assert cache('term1', 4, 0.3) == sim_func('term1', 4, 0.3)
+
+    # every query but the repeated one was a miss, and looked up once
+    assert cache.get_stats()['hits'] == 1
+    assert cache.get_stats()['misses'] == 3
+    assert sim_func.calls == 3 + 4
+
+
+def test_sim_cache_truncates_prefix_limited():
+    sim_func = FakeSim()
+    cache = SimCache(sim_func)
+    cache('term1', 8, 0.5)
+    for num_similar in range(9):
+        assert cache('term1', num_similar, 0.5) == sim_func('term1', num_similar, 0.5)
+    assert cache.get_stats()['hits'] == 9
+
+    # other bounds, or more neighbours than the entry holds, are looked up again
+    assert cache('term1', 8, 0.7) == sim_func('term1', 8, 0.7)
+    assert cache('term1', 10, 0.5) == sim_func('term1', 10, 0.5)
+    assert cache.get_stats()['misses'] == 3
+
+    assert cache.many(['term1', 'term2'], 4, 0.5) == sim_func.many(['term1', 'term2'], 4, 0.5)
+    assert cache('term2', 2, 0.5) == sim_func('term2', 2, 0.5)
+    assert cache.get_stats()['hits'] == 11
+
+
+def test_sim_cache_truncates_ranked():
+    sim_func = FakeRankedSim()
+    cache = SimCache(sim_func)
+    cache('term3', 10, 0.0)
+    for num_similar in range(11):
+        for min_similarity in [0.0, 0.55, 0.8]:
+            assert cache('term3', num_similar, min_similarity) == sim_func('term3', num_similar, min_similarity)
+    assert cache.get_stats()['misses'] == 1
+
+
+def test_sim_cache_skips_partial_answers():
+    sim_func = FakePartialSim()
+    cache = SimCache(sim_func)
+    calls = sim_func.calls
+    assert cache('term4', 3, 0.5) == sim_func('term4', 3, 0.5)
+    assert cache('term4', 3, 0.5) == sim_func('term4', 3, 0.5)
+    assert cache.get_stats() == {'hits': 0, 'misses': 2, 'hit_rate': 0.0, 'size': 0}
+    assert sim_func.calls == calls + 4
+
+
+def test_sim_cache_dump_load(tmp_path):
+    sim_func = FakeSim()
+    cache = SimCache(sim_func)
+    cache.many(['term1', 'term2', 'term3'], 6, 0.5)
+    cache.dump(str(tmp_path / 'cache.json'))
+
+    loaded = SimCache(sim_func)
+    loaded.load(str(tmp_path / 'cache.json'))
+    assert loaded.entries == cache.entries
+
+    # entries of a prefix_limited functor don't fit a ranked one
+    ranked = SimCache(FakeRankedSim())
+    ranked.load(str(tmp_path / 'cache.json'))
+    assert ranked.get_stats()['size'] == 0
+
+
+@pytest.fixture(scope='module')
+def labeled_data():
+    rand = random.Random(3)
+    categories = ['Bug', 'bug', 'Feature', 'question', 'Docs']
+    return [{'Category': rand.choice(categories), 'message': message} for message in random_messages(rand, 300)]
+
+
+def plain(model):
+    return {'filter_threshold': model['filter_threshold'],
+            'categories': {cat: {'num_docs': category['num_docs'], 'counts': dict(category['counts'])}
+                           for cat, category in model['categories'].items()},
+            'term_frequencies': {cat: {'num_docs': category['num_docs'], 'counts': dict(category['counts'])}
+                                 for cat, category in model['term_frequencies'].items()},
+            'doc_frequencies': dict(model['doc_frequencies'])}
+
+
+def test_parallel_build_matches_serial(labeled_data):
+    model = build_model(labeled_data, filter_threshold=0.05)
+    assert plain(build_model(labeled_data, filter_threshold=0.05, workers=2)) == plain(model)
+
+    counted = count_documents_parallel(labeled_data, 2, shard_size=7)
+    assert list(counted) == list(model['categories'])  # categories in order of first appearance
+    assert plain(threshold_model(counted, 0.05)) == plain(model)
+
+
+def test_update_matches_build(labeled_data):
+    model = build_model(labeled_data[:100], filter_threshold=0.05)
+    update(model, labeled_data[100:200])
+    update(model, labeled_data[200:], workers=2)
+    assert plain(model) == plain(build_model(labeled_data, filter_threshold=0.05))
+
+
+def test_external_build_matches_build(labeled_data, tmp_path):
+    os.mkdir(str(tmp_path / 'memory'))
+    os.mkdir(str(tmp_path / 'external'))
+    write_model(build_model(labeled_data, filter_threshold=0.05), str(tmp_path / 'memory'))
+
+    # a budget of a few counts spills many runs
+    built = build_model_external(labeled_data, str(tmp_path / 'external'), filter_threshold=0.05, memory_budget=4000)
+    assert built['runs'] > 1
+
+    for file_name in ['term_frequencies.json', 'doc_frequencies.json', 'category_counts.json']:
+        assert filecmp.cmp(str(tmp_path / 'memory' / file_name), str(tmp_path / 'external' / file_name),
+                           shallow=False)
+
+
+# Word_Similarity table as in SEWordSim-r1.db, neighbours of 'termN' by stem, with many ties
+def sim_rows():
+    rows = []
+    for t in range(NUM_TERMS):
+        rows.extend(('term' + str(t), word, score) for word, score in fake_neighbours('term' + str(t)))
+    random.Random(4).shuffle(rows)  # ties come back in rowid order, not in the order of fake_neighbours
+    return rows
+
+
+def write_sim_db(conn):
+    conn.execute("create table Word_Similarity (term_1 text, term_2 text, similarity real)")
+    conn.executemany("insert into Word_Similarity values (?, ?, ?)", sim_rows())
+    conn.commit()
+
+
+@pytest.fixture(scope='module')
+def sim_db_file(tmp_path_factory):
+    file_name = str(tmp_path_factory.mktemp('sim') / 'sim.db')
+    conn = sqlite3.connect(file_name)
+    write_sim_db(conn)
+    conn.close()
+    return file_name
+
+
+QUERIES = [(num_similar, min_similarity) for num_similar in [0, 1, 3, 10] for min_similarity in [0.0, 0.45, 0.8]]
+
+
+@pytest.mark.parametrize('apply_range', [False, True])
+@pytest.mark.parametrize('in_memory', [True, False])
+def test_indexed_sim_db_matches_sim_db(sim_db_file, apply_range, in_memory):
+    conn = sqlite3.connect(sim_db_file)
+    sim_db = SimDB(conn.cursor(), apply_range)
+    indexed = IndexedSimDB(sim_db_file, in_memory=in_memory, apply_range=apply_range)
+    try:
+        words = ['term' + str(t) for t in range(0, NUM_TERMS, 7)] + ['unknown']
+        for num_similar, min_similarity in QUERIES:
+            expected = {wd: sim_db(wd, num_similar, min_similarity) for wd in words}
+            assert {wd: indexed(wd, num_similar, min_similarity) for wd in words} == expected
+            assert indexed.many(words, num_similar, min_similarity) == expected
+    finally:
+        indexed.close()
+        conn.close()
+
+
+@pytest.mark.parametrize('apply_range', [False, True])
+def test_sim_table_matches_sim_db(model, apply_range):
+    conn = sqlite3.connect(':memory:')
+    write_sim_db(conn)
+    sim_db = SimDB(conn.cursor(), apply_range)
+    check_sim_table(model, sim_db)
+    conn.close()
+
+
+def test_sim_table_matches_ranked(model):
+    check_sim_table(model, FakeRankedSim())
+
+
+# The table answers as its source does, less the neighbours outside the model vocabulary
+def check_sim_table(model, sim_func):
+    vocabulary = set(model.get_doc_frequencies())
+    messages = [' '.join('term' + str(t) for t in range(start, NUM_TERMS, 10)) for start in range(10)]
+    table = SimTable(compile_sim_table(sim_func, False, messages, vocabulary))
+
+    for wd in ['term' + str(t) for t in range(0, NUM_TERMS, 3)] + ['unknown']:
+        for num_similar, min_similarity in QUERIES:
+            expected = [word for word in sim_func(wd, num_similar, min_similarity)
+                        if normalizer.stem(word) in vocabulary]
+            assert table(wd, num_similar, min_similarity) == expected